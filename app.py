@@ -1,13 +1,46 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import bisect
+import csv
+import functools
+import io
 import os
 import re
-import pandas as pd
 import sys
 import random
 import json
-from openai import OpenAI
-from typing import Literal
+import math
+import time
+import hashlib
+import unicodedata
+import sqlite3
+import argparse
+import importlib.util
+import statistics
+import subprocess
+import tempfile
+import threading
+import uuid
+import weakref
+import zlib
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager, contextmanager, nullcontext
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as wait_futures
+from dataclasses import asdict, dataclass
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterator, Literal, TypeVar
 import streamlit as st
-import httpx # Required for custom timeout configuration
+
+# Heavy dependencies (numpy, pandas, openai, httpx) are imported where they are first needed,
+# which keeps them off the cold-start path of every new Streamlit process.
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    from openai import AsyncOpenAI, OpenAI
 
 # ======================================================================
 # 1. ENVIRONMENT AND API CONFIGURATION
@@ -15,9 +48,102 @@ import httpx # Required for custom timeout configuration
 
 # Using the user-specified model
 MODEL_ID = "mistralai/mistral-small-3.1-24b-instruct:free"
+TEMPERATURE = 0.5
+MAX_TOKENS = 1024
+SHORT_ANSWER_MAX_TOKENS = 200 # Follow-up questions asked mid-reading
+
+# Token budgets: max_tokens (and the prompt's length guidance) is learned per (voice, request kind)
+TOKEN_BUDGET_WINDOW = 200 # Recent completion lengths remembered per (voice, kind)
+TOKEN_BUDGET_MIN_SAMPLES = 5 # Until then, calls use the fixed MAX_TOKENS / SHORT_ANSWER_MAX_TOKENS
+TOKEN_BUDGET_HEADROOM = 1.25 # max_tokens = 95th percentile of recent lengths x headroom
+TOKEN_BUDGET_SESSION = int(os.environ.get("TOKEN_BUDGET_SESSION", 0)) # Tokens one visitor session may use (0 = unlimited)
+TOKEN_BUDGET_GLOBAL_PER_HOUR = int(os.environ.get("TOKEN_BUDGET_GLOBAL_PER_HOUR", 0)) # Per process, rolling hour (0 = unlimited)
+
+# How readings are requested: "prose" (labelled Part 1-3 text) or "json" (an object with part1/part2/part3 fields)
+READING_OUTPUT_FORMAT = os.environ.get("READING_OUTPUT_FORMAT", "prose")
+
+# Persistent reading cache (shared by every session in the process)
+READING_CACHE_PATH = os.environ.get("READING_CACHE_PATH", "reading_cache.sqlite3")
+READING_CACHE_TTL_SECONDS = int(os.environ.get("READING_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+READING_CACHE_MAX_ENTRIES = int(os.environ.get("READING_CACHE_MAX_ENTRIES", 5000))
+
+# What a generic turn (navigation or voice command, no question) sends as USER INPUT, however the visitor
+# phrased it, so "next plant", "yes" and "move on" share one cached, prefetched or pre-generated reading
+GENERIC_READING_INPUT = "start the reading"
+
+# Speculative prefetch of the next plant (per-process limits protect the upstream rate limit)
+PREFETCH_MAX_WORKERS = int(os.environ.get("PREFETCH_MAX_WORKERS", 2))
+PREFETCH_MAX_PENDING = int(os.environ.get("PREFETCH_MAX_PENDING", 16))
+
+# Batched generation: readings packed into one LLM call by prefetch and pre-generation (1 = one call per reading)
+READING_BATCH_SIZE = int(os.environ.get("READING_BATCH_SIZE", 3))
+
+# Offline pre-generated readings, served for generic (navigation/voice) turns without an LLM call
+PREGENERATED_READINGS_PATH = os.environ.get("PREGENERATED_READINGS_PATH", "pregenerated_readings.jsonl")
+PREGENERATED_FORMAT_VERSION = 1
+
+# Shared LLM client: one keep-alive connection pool per process (see LLMClientManager)
+OPENROUTER_BASE_URL = os.environ.get("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_REQUEST_TIMEOUT_SECONDS = 120.0  # Generous, to handle complex generation
+LLM_CONNECT_TIMEOUT_SECONDS = 30.0
+LLM_POOL_MAX_CONNECTIONS = int(os.environ.get("LLM_POOL_MAX_CONNECTIONS", 32))
+LLM_POOL_MAX_KEEPALIVE = int(os.environ.get("LLM_POOL_MAX_KEEPALIVE", 16))
+LLM_POOL_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get("LLM_POOL_KEEPALIVE_EXPIRY_SECONDS", 120.0))
+
+# Resilient LLM calls: ordered fallbacks after MODEL_ID (comma-separated), retries, circuit breaker and hedging
+LLM_FALLBACK_MODELS = [m.strip() for m in os.environ.get("LLM_FALLBACK_MODELS", "").split(",") if m.strip()]
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2)) # Per model, after the first attempt
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 8.0
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get("LLM_ATTEMPT_TIMEOUT_SECONDS", LLM_REQUEST_TIMEOUT_SECONDS)) # Cut to what is left of the deadline
+LLM_CALL_DEADLINE_SECONDS = float(os.environ.get("LLM_CALL_DEADLINE_SECONDS", LLM_REQUEST_TIMEOUT_SECONDS)) # All attempts of one call
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 0)) # Duplicate a request still running past this percentile of the model's recent latencies (0 = never)
+LLM_HEDGE_WINDOW = 200 # Recent successful latencies remembered per model
+LLM_HEDGE_MIN_SAMPLES = 20 # No hedging until this many latencies are known
+LLM_BREAKER_FAILURE_THRESHOLD = 3
+LLM_BREAKER_COOLDOWN_SECONDS = 30.0
+
+# Async agent: process-wide upstream limits (the free tier allows ~20 requests per minute)
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 20))
+ASYNC_TURN_WORKERS = int(os.environ.get("ASYNC_TURN_WORKERS", 64))
+
+# External plant catalogue (.txt in the DOC_TEXT layout, .jsonl or .csv); empty uses the built-in DOC_TEXT
+PLANT_CATALOGUE_PATH = os.environ.get("PLANT_CATALOGUE_PATH", "")
+
+# Chat history per session: messages rendered on every rerun, and the most kept in total (oldest dropped beyond it)
+HISTORY_VISIBLE_MESSAGES = int(os.environ.get("HISTORY_VISIBLE_MESSAGES", 20))
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", 1000))
+HISTORY_PAGE_SIZE = 50 # Older messages are compressed, and loaded in the UI, this many at a time
+
+# Local intent routing: below this confidence, an input is treated as an open question for the LLM
+INTENT_MIN_CONFIDENCE = float(os.environ.get("INTENT_MIN_CONFIDENCE", 0.75))
+INTENT_MIN_MARGIN = float(os.environ.get("INTENT_MIN_MARGIN", 0.1)) # Over the next-best reading of the input (another command, or none)
+
+# Multi-worker deployment: share session state between worker processes through this SQLite file
+# (e.g. on a volume every worker mounts); empty keeps each session in its own process only
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "")
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 24 * 3600))
 
-# The global client will be initialized in run_streamlit_app
-client: OpenAI = None
+# Headless HTTP API (`python app.py serve-api`)
+API_MAX_LIVE_SESSIONS = int(os.environ.get("API_MAX_LIVE_SESSIONS", 1000)) # Agents kept in memory per worker
+API_MAX_BODY_BYTES = 64 * 1024
+
+# Semantic cache: answers to free-form questions reused for paraphrases, per (plant, voice)
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.85)) # Cosine similarity needed for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 200)) # Per (plant, voice, kind)
+SEMANTIC_CACHE_TTL_SECONDS = int(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", 24 * 3600)) # Older answers are not reused (0 = no expiry)
+SEMANTIC_CACHE_DIMENSIONS = 2048 # Hashed feature space of the question vectors
+QUESTION_LOG_PATH = os.environ.get("QUESTION_LOG_PATH", "") # JSONL of free-form questions, for eval-semantic-cache
+
+# Cross-plant questions answered from the local catalogue index
+CATALOGUE_SEARCH_TOP_K = 5 # Plants listed in a local answer
+CATALOGUE_NARRATION_ROWS = 3 # Matching plants' rows given to the LLM when an answer needs narrating
+CATALOGUE_MIN_SCORE = float(os.environ.get("CATALOGUE_MIN_SCORE", 1.0)) # BM25 score a field needs to count as an answer
+
+# Per-turn traces: metrics stay in memory unless TRACE_LOG_PATH names a JSONL file (one line per turn)
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", "")
+TRACE_LOG_MAX_BYTES = int(os.environ.get("TRACE_LOG_MAX_BYTES", 50_000_000)) # Then it is rotated to <path>.1 (0 = never)
 
 # ======================================================================
 # 2. CONSTANTS AND DATA MAPPING
@@ -34,6 +160,79 @@ VOICE_MAPPING = {
     'evidence': 'Evidence-Based Herbalist'
 }
 
+# Extra ways visitors name the voices and plants (Latin names are added from the catalogue)
+VOICE_SYNONYMS = {
+    'elder': ['elderly', 'grandmother', 'grandma', 'grandfather', 'grandpa', 'wise', 'old one', 'older one'],
+    'child': ['kid', 'kids', 'children', 'young one', 'little one'],
+    'evidence': ['evidence based', 'scientific', 'science', 'scientist', 'research'],
+}
+PLANT_SYNONYMS = {
+    'cacao': ['cocoa', 'chocolate'],
+    'tea': ['camellia', 'green tea', 'black tea', 'white tea'],
+    'mate': ['yerba mate', 'yerba'],
+    'lemon': ['lemons'],
+    'cardamom': ['cardamon'],
+    'ginger': ['ginger root'],
+    'black pepper': ['pepper', 'peppercorn', 'peppercorns'],
+    'osmanthus': ['sweet osmanthus'],
+    'frankincense': ['olibanum'],
+    'bay leaf': ['bay leaves', 'bay laurel', 'laurel'],
+}
+CONTINUE_PHRASES = ['continue', 'next reading', 'next part', 'more', 'tell me more', 'go on', 'keep going', 'carry on']
+NEXT_PLANT_PHRASES = ['next plant', 'another plant', 'move on', 'next one', 'next']
+PREVIOUS_PLANT_PHRASES = ['previous plant', 'previous', 'last plant', 'plant before', 'go back', 'back']
+AFFIRMATIVE_PHRASES = ['yes', 'yes please', 'yeah', 'yep', 'sure', 'ok', 'okay', 'ready', "i'm ready", "let's go"]
+# Words that carry no intent of their own ("switch to the kid voice please")
+INTENT_FILLER_WORDS = frozenset({
+    'a', 'an', 'the', 'to', 'about', 'me', 'tell', 'please', 'go', 'lets', 'let', 's', 'us', 'show',
+    'switch', 'change', 'use', 'voice', 'persona', 'herbalist', 'now', 'i', 'want', 'would', 'like',
+    'can', 'you', 'with', 'on', 'plant', 'move', 'jump', 'take', 'back', 'visit', 'and', 'more', 'talk',
+    'hear', 'from', 'one', 'again', 'instead', 'then', 'as', 'be', 'could', 'we', 'do',
+})
+
+# A clause with one of these negates the commands in it ("I don't want to continue", "no more please")
+INTENT_NEGATION_PATTERN = re.compile(
+    r"\b(?:no|not|never|nope|nah|dont|doesnt|didnt|cant|cannot|wont|(?:don|doesn|didn|can|won|isn|aren|shouldn|wouldn) t)\b"
+)
+
+# Questions about the whole garden rather than the current plant ("which plants have caffeine?")
+CATALOGUE_QUESTION_PHRASES = [
+    'which plants', 'which plant', 'which of', 'which ones', 'what plants', 'any plants', 'any of',
+    'all plants', 'all the plants', 'these plants', 'plants that', 'plants with', 'plants have',
+    'plants contain', 'plants are', 'what s safe', 'whats safe', 'what is safe', 'what should i avoid',
+]
+CATALOGUE_SAFETY_WORDS = frozenset({'safe', 'safety', 'unsafe', 'avoid', 'caution', 'careful', 'risk', 'risky', 'danger', 'dangerous', 'harmful'})
+CATALOGUE_NARRATION_WORDS = frozenset({'why', 'how', 'explain', 'describe', 'compare', 'difference', 'differ'})
+# Words that don't name a topic: a note matching only these ("doesn't taste good") does not answer the question
+CATALOGUE_VAGUE_WORDS = frozenset({
+    'good', 'bad', 'best', 'better', 'great', 'help', 'helpful', 'use', 'used', 'useful', 'make', 'made',
+    'work', 'well', 'like', 'really', 'very', 'also', 'some', 'thing', 'way', 'people', 'feel', 'get',
+})
+CATALOGUE_STOP_WORDS = frozenset({
+    'a', 'an', 'the', 'of', 'in', 'on', 'for', 'to', 'with', 'and', 'or', 'is', 'are', 'be', 'it', 'its',
+    'which', 'what', 'whats', 's', 'plant', 'plants', 'these', 'those', 'them', 'ones', 'one', 'any', 'all',
+    'have', 'has', 'contain', 'contains', 'do', 'does', 'can', 'i', 'me', 'you', 'our', 'your', 'there',
+    'that', 'this', 'should', 'tell', 'about', 'list', 'show', 'garden', 'during', 'if', 'when', 'from', 'by',
+})
+CATALOGUE_TERM_ALIASES = {'pregnant': 'pregnancy', 'kid': 'child', 'kids': 'child', 'children': 'child', 'caffeinated': 'caffeine'}
+# "-ves" plurals fold to "-f" ("leaves" -> "leaf") except these, whose singular ends in "-ve" or "-fe"
+CATALOGUE_VE_SINGULARS = frozenset({
+    'clove', 'olive', 'chive', 'glove', 'dove', 'hive', 'valve', 'nerve', 'curve', 'groove', 'wave', 'cave',
+    'grave', 'stove', 'sleeve', 'drive', 'move', 'serve', 'reserve', 'preserve', 'love', 'knife', 'life', 'wife',
+})
+
+# Question wording that should not tell paraphrases apart, and phrasings folded into one term
+SEMANTIC_STOP_WORDS = frozenset({
+    'a', 'an', 'the', 'is', 'are', 'was', 'be', 'it', 'its', 'this', 'that', 'of', 'for', 'to', 'in', 'on',
+    'with', 'and', 'or', 'do', 'does', 'did', 'can', 'could', 'would', 'will', 'i', 'me', 'my', 'you', 'your',
+    'we', 'us', 'please', 'tell', 'about', 'really', 'actually', 'any', 'some', 's', 'there', 'what', 'whats',
+})
+# Only true synonyms and inflections: folding related topics ("awake" -> "caffeine") serves answers to other questions
+SEMANTIC_PHRASE_ALIASES = {
+    'queasy': 'nausea', 'nauseous': 'nausea', 'nauseated': 'nausea', 'help with': 'good for', 'helps with': 'good for',
+    'kids': 'children', 'kid': 'children', 'child': 'children', 'pregnant': 'pregnancy',
+}
+
 # The document content (omitted for brevity, assume it is unchanged from previous versions)
 DOC_TEXT = """
 ---
@@ -132,445 +331,4622 @@ Evidence-Based Herbalist: Bay leaf (Laurus nobilis) contains essential oils and
 # 3. DATA LOADING & PARSING
 # ======================================================================
 
-def load_and_structure_plant_data(doc_text: str, sequence: list, voice_map: dict) -> pd.DataFrame:
-    """Parses the text, extracts details, and creates a DataFrame with one row per plant/voice combination."""
+@dataclass(frozen=True, slots=True)
+class PlantRecord:
+    """One (plant, voice) combination: the short note to expand plus the plant's fixed info."""
+    plant: str
+    voice: str
+    note: str
+    latin_name: str
+    origin: str
+    parts_used: str
+    contraindications: str
 
-    plant_blocks = re.split(r'\n---\n\s*\d+\.\s', doc_text)[1:]
-    data_list = []
 
-    try:
-        for block in plant_blocks:
-            lines = block.strip().split('\n')
+class PlantIndex:
+    """
+    Immutable (plant, voice) -> PlantRecord lookup used by the agent on every turn.
+    Pandas is only involved when a DataFrame is requested for analysis or export.
+    """
 
-            plant_name_line = lines[0].split('(')[0].strip().lower()
-            plant_name = next((p for p in sequence if p in plant_name_line), plant_name_line.split(' ')[0])
-            if plant_name == 'yerba': plant_name = 'mate'
+    __slots__ = ('records', '_by_key', '__weakref__')
 
-            # Extract fixed info
-            info = {line.split(':')[0].strip(): line.split(':')[-1].strip()
-                            for line in lines if ':' in line and not line.startswith(tuple(voice_map.values()))}
+    def __init__(self, records):
+        self.records = tuple(records)
+        self._by_key = MappingProxyType({(r.plant, r.voice): r for r in self.records})
 
-            # Extract specific notes for each voice
-            for short_voice, long_voice in voice_map.items():
-                try:
-                    note_start_index = next(i for i, line in enumerate(lines) if line.startswith(long_voice))
-                    single_note = lines[note_start_index].split(':', 1)[-1].strip()
-                except StopIteration:
-                    single_note = "ERROR: Note not found in document."
-
-                # Store one row for each (plant, voice) combination
-                data_list.append({
-                    'plant': plant_name,
-                    'voice': short_voice,
-                    'note': single_note, # This is the short note we'll expand
-                    'latin_name': info.get('Latin Name', 'N/A'),
-                    'origin': info.get('Native Region', 'N/A'),
-                    'parts_used': info.get('Plant Part Used', 'N/A'),
-                    'contraindications': info.get('Contraindications', 'None known'),
-                })
+    def get(self, plant: str, voice: str) -> PlantRecord | None:
+        return self._by_key.get((plant, voice))
 
-        return pd.DataFrame(data_list)
-    except Exception as e:
-        print(f"\n[CRITICAL ERROR] Failed to load plant data. Check DOC_TEXT structure.")
-        print(f"Details: {e}")
-        sys.exit(1)
+    def __iter__(self):
+        return iter(self.records)
 
+    def __len__(self) -> int:
+        return len(self.records)
 
-# ======================================================================
-# 4. AGENT CLASS (LOGIC & FLOW)
-# ======================================================================
+    def to_dataframe(self) -> pd.DataFrame:
+        """One row per plant/voice combination, for analysis and export."""
+        import pandas as pd
+        return pd.DataFrame([asdict(record) for record in self.records])
 
-class BotanicalGuideAgent:
 
-    def __init__(self, plant_data: pd.DataFrame, sequence: list, voice_options: list):
-        self.plant_data = plant_data
-        self.plant_sequence = sequence
-        self.voice_options = voice_options
+def normalize_text(text: str) -> str:
+    """Lowercase, accent-free, punctuation-free text ("Yerba Maté!" -> "yerba mate")."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", stripped).split())
 
-        # State Tracking
-        self.current_voice = None
-        self.current_plant = sequence[0]
-        self.current_plant_index = 0
 
-        # State Tracking for reading parts
-        self.current_reading_step = 0
-        self.expanded_readings: list[str] = []
+# Catalogue field labels (as in DOC_TEXT) and the column/key spellings accepted for them in JSONL and CSV
+CATALOGUE_FIELD_ALIASES = {
+    'name': 'Name', 'plant': 'Name', 'common_name': 'Name',
+    'latin_name': 'Latin Name', 'scientific_name': 'Latin Name',
+    'native_region': 'Native Region', 'region': 'Native Region', 'origin': 'Native Region',
+    'plant_part_used': 'Plant Part Used', 'parts_used': 'Plant Part Used',
+    'contraindications': 'Contraindications',
+}
 
-        self.REDIRECT_RESPONSES = [
-            "Interesting thought! These plants adapt in their own ways too. Let's return to {plant}.",
-            "Ha, that's a good one. Speaking of growth, {plant} has its own story…",
-            "Noted. Our tour is focused on the plants—here's more about {plant}."
-        ]
 
-    def _build_system_prompt(self, current_plant_row, user_input: str) -> str:
-        """
-        Builds the system prompt to enforce a structured prose output (Part 1, Part 2, Part 3)
-        and guides the LLM on how to handle the user's input while maintaining guardrails.
-        """
+@dataclass(frozen=True, slots=True)
+class CatalogueIssue:
+    """A catalogue entry (or part of one) that was skipped, and where it is in the source."""
+    source: str
+    position: int # Line number of the block (text, JSONL) or row number (CSV)
+    message: str
 
-        plant_name = current_plant_row['plant'].capitalize()
-        target_voice = current_plant_row['voice']
+    def __str__(self) -> str:
+        return f"{self.source}:{self.position}: {self.message}"
 
-        # Format the core instruction and data
-        prompt = (
-            f"You are a Botanical Garden Tour Guide for the plant **{plant_name}**. "
-            f"Your persona is the **{target_voice.upper()}** herbalist. "
-            f"Your role is to deliver a three-part scripted reading based on your 'notecards'. "
-            f"Your sole purpose is to provide structured information on the current plant.\n\n"
 
-            f"DATA:\n"
-            f"Latin Name: {current_plant_row['latin_name']}\n"
-            f"Region: {current_plant_row['origin']}\n"
-            f"Parts Used: {current_plant_row['parts_used']}\n"
-            f"Contraindications: {current_plant_row['contraindications']}\n"
-            f"Short Note: {current_plant_row['note']}\n\n"
+def iter_text_entries(lines) -> Iterator[tuple[int, str]]:
+    """Streams the '---'-separated plant blocks of a DOC_TEXT-style document as (line number, block)."""
+    block: list[str] = []
+    start = 1
+    for number, line in enumerate(lines, 1):
+        if line.strip() == '---':
+            if any(part.strip() for part in block):
+                yield start, "".join(block)
+            block, start = [], number + 1
+        else:
+            block.append(line)
+    if any(part.strip() for part in block):
+        yield start, "".join(block)
 
-            f"USER INPUT: '{user_input}'\n\n"
 
-            f"INSTRUCTIONS:\n"
-            f"1. **Primary Guardrail:** Your response MUST stay focused on the plant. If the USER INPUT is off-topic (e.g., about movies, weather, or pricing), give a very brief, gentle acknowledgment, and immediately proceed to the structured reading.\n"
-            f"2. **Flow Control:** If the USER INPUT contains commands related to state change (like 'next plant', 'ginger', or another 'voice'), **ignore those commands** as the main application handles navigation. Only focus on interpreting general questions.\n"
-            f"3. **Your response MUST follow this exact, labeled structure** and contain ONLY the three parts of the reading:\n"
-            f"    - **Part 1: History and Origin**\n"
-            f"    - **Part 2: Key Features and Uses**\n"
-            f"    - **Part 3: Scientific Details and Context**\n"
-            f"4. **Do not include any other text** (no ending summary, no markdown wrappers)."
+def iter_jsonl_entries(lines) -> Iterator[tuple[int, str]]:
+    """Streams one JSON object per non-blank line as (line number, line)."""
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            yield number, line
+
+
+def iter_csv_entries(lines) -> Iterator[tuple[int, str | csv.Error]]:
+    """
+    Streams CSV rows (header row first) as (row number, row re-encoded as a JSON object).
+    A row the csv module cannot read (e.g. a field over its size limit) comes back as the
+    csv.Error instead, so the rows after it are still read.
+    """
+    reader = csv.DictReader(lines)
+    number = 1
+    while True:
+        number += 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield number, e
+            continue
+        yield number, json.dumps(row, ensure_ascii=False)
+
+
+def parse_text_entry(block: str) -> dict:
+    """'3. Yerba Maté' followed by 'Label: value' lines -> {'Name': ..., label: value}."""
+    lines = [line.strip() for line in block.strip().splitlines() if line.strip()]
+    fields = {'Name': re.sub(r'^\d+\.\s*', '', lines[0])}
+    for line in lines[1:]:
+        if ':' not in line:
+            raise ValueError(f"expected 'Label: value', got {line[:60]!r}")
+        label, value = line.split(':', 1)
+        fields[label.strip()] = value.strip()
+    return fields
+
+
+def parse_record_entry(raw: str) -> dict:
+    """A JSON object (a JSONL line or re-encoded CSV row) -> the same labels the text format uses."""
+    entry = json.loads(raw)
+    if not isinstance(entry, dict):
+        raise ValueError("expected a JSON object")
+
+    fields = {}
+    for key, value in entry.items():
+        if key == 'notes' and isinstance(value, dict):  # {"elder": "...", "child": "..."}
+            for voice, note in value.items():
+                if note not in (None, ""):
+                    fields[VOICE_MAPPING.get(voice, f"{str(voice).capitalize()} Herbalist")] = str(note).strip()
+            continue
+        label = CATALOGUE_FIELD_ALIASES.get(re.sub(r'[^a-z0-9]+', '_', str(key).lower()).strip('_'), str(key).strip())
+        if value not in (None, ""):
+            fields[label] = str(value).strip()
+    return fields
+
+
+@functools.lru_cache(maxsize=8)
+def _plant_name_matchers(sequence: tuple) -> tuple[re.Pattern, dict]:
+    """One whole-name pattern for the known plant keys plus a synonym -> plant map, built once per sequence."""
+    pattern = re.compile("|".join(map(re.escape, sequence))) if sequence else re.compile(r"(?!)")
+    synonyms = {normalize_text(synonym): plant for plant, names in PLANT_SYNONYMS.items() for synonym in names}
+    return pattern, synonyms
+
+
+def canonical_plant_name(name: str, sequence: list) -> str:
+    """
+    Catalogue heading -> the tour's plant key ('Tea (Camellia)' -> 'tea', 'Yerba Maté' -> 'mate').
+    Only the whole heading or an exact synonym counts, so 'Lemon Balm' stays a plant of its own.
+    """
+    text = normalize_text(name.split('(')[0])
+    pattern, synonyms = _plant_name_matchers(tuple(sequence))
+    if pattern.fullmatch(text):
+        return text
+    return synonyms.get(text, text)
+
+
+def voice_for_label(label: str, voice_map: dict) -> str:
+    """'Elder Herbalist' -> 'elder'; labels not in the mapping become new voices ('Forager Herbalist' -> 'forager')."""
+    for short_voice, long_voice in voice_map.items():
+        if long_voice.lower() == label.lower():
+            return short_voice
+    return normalize_text(label).split()[0]
+
+
+def build_plant_records(fields: dict, sequence: list, voice_map: dict) -> tuple[str, list[PlantRecord], list[str]]:
+    """
+    Validates one parsed entry and builds a record per voice note it contains. Raises
+    ValueError if the entry is unusable; returns warnings for the parts that were skipped.
+    """
+
+    name = fields.get('Name', '').strip()
+    if not name:
+        raise ValueError("entry has no plant name")
+    plant_name = canonical_plant_name(name, sequence)
+    if not plant_name:
+        raise ValueError(f"cannot derive a plant key from {name!r}")
+
+    notes = {label: note for label, note in fields.items() if label.lower().endswith('herbalist')}
+    if not any(note.strip() for note in notes.values()):
+        raise ValueError(f"{plant_name}: entry has no herbalist notes")
+
+    warnings = [f"{plant_name}: missing {long_voice} note" for long_voice in voice_map.values() if not notes.get(long_voice, '').strip()]
+    records = [
+        PlantRecord(
+            plant=plant_name,
+            voice=voice_for_label(label, voice_map),
+            note=note.strip(), # This is the short note we'll expand
+            latin_name=fields.get('Latin Name', 'N/A'),
+            origin=fields.get('Native Region', 'N/A'),
+            parts_used=fields.get('Plant Part Used', 'N/A'),
+            contraindications=fields.get('Contraindications', 'None known'),
         )
+        for label, note in notes.items() if note.strip()
+    ]
+    return plant_name, records, warnings
 
-        return prompt
 
-    def _get_expanded_reading(self, user_input: str) -> tuple[str, dict]:
-        """
-        Collects data, sends the prompt, and splits the LLM's prose response
-        into three parts based on the labeled structure.
-        """
+class PlantCatalogue:
+    """
+    The plant catalogue, streamed entry by entry from DOC_TEXT or an external .txt/.jsonl/.csv
+    file. Bad entries are reported as issues and skipped instead of aborting the load.
+    Parsed entries are remembered by content hash, so `refresh()` after an edit re-parses
+    only the blocks that changed (and does nothing if the file itself is unchanged).
+    The tour order and voice mapping are the configured ones, extended with any new plants
+    and voices found in the data.
+    """
 
-        try:
-            plant_row = self.plant_data[
-                (self.plant_data['plant'] == self.current_plant) &
-                (self.plant_data['voice'] == self.current_voice)
-            ].iloc[0]
-        except IndexError:
-            return "Error: Plant data not found for the current plant and voice.", {}
+    MAX_PRINTED_ISSUES = 20
 
-        # 1. Generate the LLM System Prompt with the user's raw input
-        system_prompt = self._build_system_prompt(plant_row, user_input)
+    def __init__(self, path: str | None = None, doc_text: str = DOC_TEXT,
+                 sequence: list = PLANT_SEQUENCE, voice_map: dict = VOICE_MAPPING):
+        self.path = path
+        self.doc_text = doc_text
+        self.base_sequence = list(sequence)
+        self.base_voice_map = dict(voice_map)
 
-        # 2. Call the LLM to generate the structured readings (raw prose string)
-        prose_string_raw = generate_llm_response(system_prompt)
+        self.index = PlantIndex(())
+        self.plant_sequence: list[str] = []
+        self.voice_mapping: dict[str, str] = dict(voice_map)
+        self.issues: list[CatalogueIssue] = []
+        self.version = 0
+        self.last_load = {'parsed': 0, 'reused': 0}
 
-        # --- ROBUST PROSE PARSING FIX ---
-        # Look for the predefined Part labels to split the response
-        parts = re.split(r'(?:\*\*|)\s*Part\s+\d+:\s+.*?(?:\*\*|)', prose_string_raw.strip(), re.DOTALL)
+        self._parsed: dict[str, tuple[str, list[PlantRecord], list[str]]] = {}  # content hash -> parse result
+        self._signature = None
+        self._lock = threading.Lock()
 
-        # Fallback list for error cases
-        self.expanded_readings = []
-        reading_text = ""
+    @property
+    def source(self) -> str:
+        return self.path or "DOC_TEXT"
 
-        # Check if the split produced the expected number of sections
-        if len(parts) >= 4:
-            # Store the three main parts (indices 1, 2, 3)
-            self.expanded_readings = [p.strip() for p in parts[1:4]]
+    @property
+    def voice_options(self) -> list[str]:
+        return list(self.voice_mapping)
 
-            if self.expanded_readings[0]:
-                reading_text = self.expanded_readings[0] # Part 1 content
-                self.current_reading_step = 1 # Set to start at the first reading
+    def _source_signature(self):
+        if self.path is None:
+            return hashlib.sha256(self.doc_text.encode("utf-8")).hexdigest()
+        status = os.stat(self.path)
+        return (status.st_mtime_ns, status.st_size)
+
+    @contextmanager
+    def _entries(self):
+        """(position, raw entry, parser) for each entry, read lazily from the source."""
+        if self.path is None:
+            yield ((position, raw, parse_text_entry) for position, raw in iter_text_entries(io.StringIO(self.doc_text)))
+            return
+
+        extension = os.path.splitext(self.path)[1].lower()
+        # Bytes that are not UTF-8 are replaced (U+FFFD) and reported per entry, not fatal to the load
+        with open(self.path, encoding="utf-8", errors="replace", newline="") as source:
+            if extension in (".jsonl", ".ndjson"):
+                yield ((position, raw, parse_record_entry) for position, raw in iter_jsonl_entries(source))
+            elif extension == ".csv":
+                yield ((position, raw, parse_record_entry) for position, raw in iter_csv_entries(source))
             else:
-                reading_text = f"[LLM STRUCTURE ERROR] The guide generated structure but Part 1 was empty. Raw output begins: {prose_string_raw[:200]}..."
-        else:
-            # The model failed to adhere to the Part structure, or returned an error/empty content
-            reading_text = f"[LLM STRUCTURE ERROR] The guide failed to generate the reading correctly. Raw output begins: {prose_string_raw[:200]}..."
+                yield ((position, raw, parse_text_entry) for position, raw in iter_text_entries(source))
 
-        # Extract fixed info for local formatting
-        fixed_info = {
-            'Latin Name': plant_row['latin_name'],
-            'Region of Origin': plant_row['origin'],
-            'Parts Used': plant_row['parts_used'],
-            'Contraindications': plant_row['contraindications'],
-        }
+    def refresh(self) -> PlantIndex:
+        """Loads the catalogue, or reloads it if the source changed; returns the current index."""
+        with self._lock:
+            try:
+                signature = self._source_signature()
+            except OSError as e:
+                print(f"[CATALOGUE ERROR] Cannot read {self.source}: {e}. Keeping the current catalogue.")
+                return self.index
+            if signature != self._signature:
+                self._load()
+                self._signature = signature
+            return self.index
 
-        return reading_text, fixed_info
+    def _load(self) -> None:
+        parsed: dict[str, tuple[str, list[PlantRecord], list[str]]] = {}
+        records_by_plant: dict[str, list[PlantRecord]] = {}
+        issues: list[CatalogueIssue] = []
+        counts = {'parsed': 0, 'reused': 0}
 
-    def _get_next_reading_part(self) -> str:
-        """Retrieves and increments the reading part counter."""
+        with self._entries() as entries:
+            for position, raw, parse in entries:
+                if isinstance(raw, csv.Error):  # A row the csv module could not read at all
+                    issues.append(CatalogueIssue(self.source, position, f"unreadable CSV row: {raw}"))
+                    continue
+                if "\ufffd" in raw:
+                    issues.append(CatalogueIssue(self.source, position, "entry is not valid UTF-8; unreadable characters were replaced"))
 
-        if self.current_reading_step < len(self.expanded_readings):
-            next_part_content = self.expanded_readings[self.current_reading_step]
-            self.current_reading_step += 1
-            return next_part_content
-        else:
-            # All parts have been read
-            self.current_reading_step = 0 # Reset state
-            self.expanded_readings = []
-            return f"That concludes the full reading on **{self.current_plant.capitalize()}**. **Ready for the next plant?**"
+                digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+                result = parsed.get(digest) or self._parsed.get(digest)
+                if result is None:
+                    try:
+                        result = build_plant_records(parse(raw), self.base_sequence, self.base_voice_map)
+                    except (ValueError, csv.Error) as e:  # Includes json.JSONDecodeError
+                        issues.append(CatalogueIssue(self.source, position, str(e)))
+                        continue
+                    counts['parsed'] += 1
+                else:
+                    counts['reused'] += 1
+                parsed[digest] = result
 
+                plant_name, records, warnings = result
+                issues.extend(CatalogueIssue(self.source, position, warning) for warning in warnings)
+                if plant_name in records_by_plant:
+                    issues.append(CatalogueIssue(self.source, position, f"{plant_name}: duplicate entry replaces the earlier one"))
+                records_by_plant[plant_name] = records
 
-    def _generate_reading(self, user_input: str) -> str:
-        """Calls the LLM data fetcher and formats the first part of the reading."""
+        voice_mapping = dict(self.base_voice_map)
+        for records in records_by_plant.values():
+            for record in records:
+                voice_mapping.setdefault(record.voice, f"{record.voice.capitalize()} Herbalist")
 
-        narrative, fixed_info = self._get_expanded_reading(user_input)
+        self._parsed = parsed
+        self.index = PlantIndex(record for records in records_by_plant.values() for record in records)
+        self.plant_sequence = [p for p in self.base_sequence if p in records_by_plant] + [p for p in records_by_plant if p not in self.base_sequence]
+        self.voice_mapping = voice_mapping
+        self.issues = issues
+        self.last_load = counts
+        self.version += 1
 
-        # Build the formatted response with fixed info
-        response = ""
-        response += f"***\n"
-        response += f"**Latin Name:** {fixed_info.get('Latin Name', 'N/A')} | "
-        response += f"**Region:** {fixed_info.get('Region of Origin', 'N/A')} | "
-        response += f"**Parts Used:** {fixed_info.get('Parts Used', 'N/A')}\n"
-        response += f"***\n\n"
+        print(f"[CATALOGUE] Loaded {len(records_by_plant)} plants from {self.source} "
+              f"({counts['parsed']} parsed, {counts['reused']} unchanged, {len(issues)} issues).")
+        for issue in issues[:self.MAX_PRINTED_ISSUES]:
+            print(f"[CATALOGUE WARNING] {issue}")
+        if not records_by_plant:
+            print(f"\n[CRITICAL ERROR] No usable plant entries in {self.source}. Check its structure.")
 
-        # Check if an error occurred during expansion
-        if "[LLM STRUCTURE ERROR]" in narrative:
-            response += narrative
-            response += "\n\n**Please try another command or quit.**"
-            return response
 
-        # If successful, format the first part
-        response += f"**[Expanded Reading Part 1/3 - {self.current_voice.upper()} Persona]**\n"
-        response += narrative
+def load_and_structure_plant_data(doc_text: str, sequence: list, voice_map: dict) -> PlantIndex:
+    """Parses the text, extracts details, and builds the (plant, voice) index with one record per combination."""
+    return PlantCatalogue(doc_text=doc_text, sequence=sequence, voice_map=voice_map).refresh()
 
-        # We now ask for the NEXT reading.
-        if len(self.expanded_readings) > 1:
-            response += "\n\n**Continue reading this plant's story?**"
-        else:
-            response += "\n\n**Ready for the next plant?**"
 
-        return response
+# ======================================================================
+# 4. PROMPT ASSEMBLY (STATIC PREFIX + PER-TURN SUFFIX)
+# ======================================================================
 
-    # --- VOICE SELECTION ---
-    def _handle_select_voice(self, user_input: str) -> str:
-        """Sets the voice, resets step counter, and then performs a reading."""
+def build_system_prompt(current_plant_row: PlantRecord, output_format: str | None = None) -> str:
+    """
+    Builds the system prompt to enforce a structured output (Part 1, Part 2, Part 3, as labelled prose or JSON)
+    and guides the LLM on how to handle the user's input while maintaining guardrails.
+    The prompt depends only on the (plant, voice) row, so it is byte-identical on every
+    turn and provider-side prefix caching can reuse it; the user input follows separately.
+    """
 
-        new_voice = next((v for v in self.voice_options if v in user_input.lower()), None)
+    plant_name = current_plant_row.plant.capitalize()
+    target_voice = current_plant_row.voice
+    output_format = output_format or READING_OUTPUT_FORMAT
 
-        if not new_voice:
-            # Since the LLM handles interpretation, any non-voice command is treated as a redirect/question
-            return self._handle_redirect(user_input)
+    if output_format == "json":
+        structure_instructions = (
+            f"3. **Your response MUST be a single JSON object** with exactly these string fields:\n"
+            f"    - \"part1\": History and Origin\n"
+            f"    - \"part2\": Key Features and Uses\n"
+            f"    - \"part3\": Scientific Details and Context\n"
+            f"4. **Do not include any other text** (no markdown fences, nothing before or after the object)."
+        )
+    else:
+        structure_instructions = (
+            f"3. **Your response MUST follow this exact, labeled structure** and contain ONLY the three parts of the reading:\n"
+            f"    - **Part 1: History and Origin**\n"
+            f"    - **Part 2: Key Features and Uses**\n"
+            f"    - **Part 3: Scientific Details and Context**\n"
+            f"4. **Do not include any other text** (no ending summary, no markdown wrappers)."
+        )
 
-        # Reset reading state whenever voice or plant changes
-        self.current_reading_step = 0
-        self.expanded_readings = []
+    # Format the core instruction and data
+    prompt = (
+        f"You are a Botanical Garden Tour Guide for the plant **{plant_name}**. "
+        f"Your persona is the **{target_voice.upper()}** herbalist. "
+        f"Your role is to deliver a three-part scripted reading based on your 'notecards'. "
+        f"Your sole purpose is to provide structured information on the current plant.\n\n"
 
-        # The LLM prompt is now responsible for incorporating the user's conversational intent
+        f"DATA:\n"
+        f"Latin Name: {current_plant_row.latin_name}\n"
+        f"Region: {current_plant_row.origin}\n"
+        f"Parts Used: {current_plant_row.parts_used}\n"
+        f"Contraindications: {current_plant_row.contraindications}\n"
+        f"Short Note: {current_plant_row.note}\n\n"
 
-        if self.current_voice is None:
-            self.current_voice = new_voice
-            return f"Great choice! I'm excited to share our garden with you from the perspective of a **{new_voice}** herbalist. Let's begin with **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input)
+        f"INSTRUCTIONS:\n"
+        f"The visitor's message follows as USER INPUT.\n"
+        f"1. **Primary Guardrail:** Your response MUST stay focused on the plant. If the USER INPUT is off-topic (e.g., about movies, weather, or pricing), give a very brief, gentle acknowledgment, and immediately proceed to the structured reading.\n"
+        f"2. **Flow Control:** If the USER INPUT contains commands related to state change (like 'next plant', 'ginger', or another 'voice'), **ignore those commands** as the main application handles navigation. Only focus on interpreting general questions.\n"
+        + structure_instructions
+    )
 
-        elif new_voice != self.current_voice:
-            self.current_voice = new_voice
-            return f"Voice switched to **{new_voice.upper()}** persona. Here is the expanded note on **{self.current_plant.capitalize()}**:\n\n" + self._generate_reading(user_input)
+    return prompt
 
-        else:
-            # If same voice is selected, regenerate the reading for the current plant (or continue if reading is active)
-            if self.current_reading_step == 0:
-                return f"The voice is already set to **{self.current_voice}**. Let's start the reading on **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input)
-            else:
-                return self._handle_continue_reading(user_input)
 
+def build_messages(system_prompt: str, user_input: str) -> list[dict]:
+    """The static prefix as the system message, followed by the per-turn user message."""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"USER INPUT: '{user_input}'"},
+    ]
 
-    # --- NAVIGATION ---
-    def _handle_plant_navigation(self, user_input: str) -> str:
-        """Handles 'next plant' or 'plant by name', and then performs a reading."""
 
-        if self.current_voice is None:
-            return f"Please select your preferred herbalist persona: {', '.join(self.voice_options)}."
+def build_short_answer_prompt(current_plant_row: PlantRecord, reading_parts: list[str]) -> str:
+    """
+    Builds the system prompt for a brief answer to a question asked mid-reading, grounded in
+    the plant's DATA and the parts of the reading the visitor has already heard.
+    """
 
-        # 1. Check for 'next reading' command
-        if self.current_reading_step > 0 and any(w in user_input.lower() for w in ["next reading", "continue", "tell me more"]):
-            return self._handle_continue_reading(user_input)
+    plant_name = current_plant_row.plant.capitalize()
+    reading_so_far = "\n\n".join(part.strip() for part in reading_parts if part.strip()) or "(none yet)"
 
-        # 2. Check for 'next plant'
-        if "next plant" in user_input.lower():
-            if self.current_plant_index == len(self.plant_sequence) - 1:
-                return "We've completed the tour of all 10 plants. Please select a plant by name if you wish to re-visit one."
+    return (
+        f"You are a Botanical Garden Tour Guide for the plant **{plant_name}**. "
+        f"Your persona is the **{current_plant_row.voice.upper()}** herbalist. "
+        f"The visitor interrupted your reading with a question.\n\n"
 
-            # Reset reading state when moving to a new plant
-            self.current_reading_step = 0
-            self.expanded_readings = []
+        f"DATA:\n"
+        f"Latin Name: {current_plant_row.latin_name}\n"
+        f"Region: {current_plant_row.origin}\n"
+        f"Parts Used: {current_plant_row.parts_used}\n"
+        f"Contraindications: {current_plant_row.contraindications}\n"
+        f"Short Note: {current_plant_row.note}\n\n"
 
-            self.current_plant_index = (self.current_plant_index + 1) % len(self.plant_sequence)
-            self.current_plant = self.plant_sequence[self.current_plant_index]
+        f"READING SO FAR:\n{reading_so_far}\n\n"
 
-            return f"Moving to the next plant, **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input)
+        f"INSTRUCTIONS:\n"
+        f"The visitor's question follows as USER INPUT.\n"
+        f"1. Answer it in at most three sentences, in your persona, using only the DATA and the READING SO FAR.\n"
+        f"2. If the question is off-topic or not covered there, say so briefly and gently bring the visitor back to the plant.\n"
+        f"3. Do not start a new reading and do not use Part labels; the reading will resume afterwards."
+    )
 
-        # 3. Check for 'plant by name'
-        named_plant = next((p for p in self.plant_sequence if p in user_input.lower()), None)
-        if named_plant:
-            # Reset reading state when switching to a named plant
-            self.current_reading_step = 0
-            self.expanded_readings = []
 
-            self.current_plant = named_plant
-            self.current_plant_index = self.plant_sequence.index(named_plant)
-            return f"Switching focus to **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input)
+def build_catalogue_answer_prompt(rows: list[PlantRecord], voice: str) -> str:
+    """
+    Builds the system prompt for a question about several plants, grounded only in the rows
+    the local catalogue search ranked highest.
+    """
 
-        # If input was not a recognized command, it's a redirect.
-        return self._handle_redirect(user_input)
+    data = "\n\n".join(
+        f"Plant: {row.plant.capitalize()}\n"
+        f"Latin Name: {row.latin_name}\n"
+        f"Region: {row.origin}\n"
+        f"Parts Used: {row.parts_used}\n"
+        f"Contraindications: {row.contraindications}\n"
+        f"Short Note: {row.note}"
+        for row in rows
+    )
 
+    return (
+        f"You are a Botanical Garden Tour Guide. Your persona is the **{voice.upper()}** herbalist. "
+        f"The visitor asked a question about the plants in the garden.\n\n"
 
-    def _handle_continue_reading(self, user_input: str) -> str:
-        """Retrieves and formats the next part of the expanded reading."""
+        f"DATA (the plants that best match the question):\n{data}\n\n"
 
-        # If no reading is active, assume the user is asking a general question about the current plant
-        if not self.expanded_readings or self.current_reading_step == 0:
-            return self._generate_reading(user_input)
+        f"INSTRUCTIONS:\n"
+        f"The visitor's question follows as USER INPUT.\n"
+        f"1. Answer it in at most four sentences, in your persona, using only the DATA; name the plants you mean.\n"
+        f"2. If the DATA does not answer it, say so briefly.\n"
+        f"3. Do not start a reading and do not use Part labels."
+    )
 
-        # Retrieve the next part of the story
-        next_reading = self._get_next_reading_part()
 
-        if self.current_reading_step == 0:
-            return next_reading # Returns the "That concludes the full reading..." message
+def build_continuation_prompt(system_prompt: str, part_index: int, cut_off_text: str) -> str:
+    """Asks for the rest of a part whose generation was cut off by the token limit, as plain text."""
 
-        response = f"**[Expanded Reading Part {self.current_reading_step}/3 - {self.current_voice.upper()} Persona]**\n"
-        response += next_reading
+    return (
+        f"{system_prompt}\n\n"
+        f"CONTINUATION:\n"
+        f"Your previous response was cut off by the length limit in the middle of Part {part_index + 1}. "
+        f"It ended with:\n\n...{cut_off_text[-400:]}\n\n"
+        f"Continue Part {part_index + 1} from exactly where it stopped and finish it. "
+        f"Write only the continuation text (no label, no repetition of what was already written, no other parts)."
+    )
 
-        if self.current_reading_step < 3:
-            response += "\n\n**Continue reading this plant's story?**"
-        else:
-            response += "\n\nThat concludes the full reading on this plant. **Ready for the next plant?**"
-            self.current_reading_step = 0
-            self.expanded_readings = []
 
-        return response
+def build_repair_prompt(system_prompt: str, reading_parts: list[str]) -> str:
+    """
+    The reading's own system prompt plus a request for only the parts that were lost,
+    as JSON, so a partly malformed reading is completed instead of regenerated.
+    """
 
-    def _handle_redirect(self, user_input: str) -> str:
-        """
-        Handles inputs that are not clear navigation or voice commands.
-        Triggers a new reading but allows the LLM to interpret the user's question first.
-        """
-        if self.current_voice is None:
-            return f"Welcome! Please select your preferred herbalist persona: {', '.join(self.voice_options)}."
+    missing = [key for key, part in zip(READING_PART_KEYS, reading_parts) if not part]
+    delivered = "\n\n".join(f"{key}: {part}" for key, part in zip(READING_PART_KEYS, reading_parts) if part)
 
-        # Any conversational input that isn't a direct command is treated as a question about the current plant.
-        # This forces the LLM to process it (e.g., "what's the weather") and redirect, then deliver the script.
-        return self._generate_reading(user_input)
+    return (
+        f"{system_prompt}\n\n"
+        f"REPAIR:\n"
+        f"Your previous response was incomplete. These parts were already delivered to the visitor:\n\n"
+        f"{delivered}\n\n"
+        f"Write ONLY the missing parts, consistent with the delivered ones, as a single JSON object "
+        f"with the string fields: {', '.join(missing)}. No other text."
+    )
 
 
-    def respond(self, user_input: str) -> str:
-        """The main interaction method that executes the logic."""
-        user_input_lower = user_input.lower().strip()
+def build_batch_system_prompt(rows: list[PlantRecord]) -> str:
+    """
+    Builds one system prompt for the readings of several (plant, voice) records: the guide's
+    instructions once, then a numbered DATA block per reading. The output is the usual labelled
+    Part 1-3 structure per reading, each opened by a `=== READING n ===` delimiter line.
+    """
 
-        # 0. Initial Greeting / Persona Selection Prompt
-        if self.current_voice is None:
-            if any(v in user_input_lower for v in self.voice_options):
-                return self._handle_select_voice(user_input)
-            return f"Welcome! Please select your preferred herbalist persona: {', '.join(self.voice_options)}."
+    data = "\n\n".join(
+        f"READING {number}: **{row.plant.capitalize()}**, in the persona of the **{row.voice.upper()}** herbalist\n"
+        f"DATA:\n"
+        f"Latin Name: {row.latin_name}\n"
+        f"Region: {row.origin}\n"
+        f"Parts Used: {row.parts_used}\n"
+        f"Contraindications: {row.contraindications}\n"
+        f"Short Note: {row.note}"
+        for number, row in enumerate(rows, 1)
+    )
 
+    return (
+        f"You are a Botanical Garden Tour Guide. "
+        f"Your role is to deliver three-part scripted readings based on your 'notecards', here for {len(rows)} plants at once. "
+        f"Your sole purpose is to provide structured information on these plants.\n\n"
 
-        # 1. COMMAND: Continue Reading (High Priority)
-        if self.current_reading_step > 0 and any(w in user_input_lower for w in ["continue", "next reading", "more", "tell me more"]):
-            return self._handle_continue_reading(user_input)
+        f"{data}\n\n"
 
-        # 2. COMMAND: Change Voice
-        if any(v in user_input_lower for v in self.voice_options):
-            return self._handle_select_voice(user_input)
+        f"INSTRUCTIONS:\n"
+        f"The visitor's message follows as USER INPUT; it applies to every reading.\n"
+        f"1. **Primary Guardrail:** Each reading MUST stay focused on its plant. If the USER INPUT is off-topic (e.g., about movies, weather, or pricing), give a very brief, gentle acknowledgment at the start of the reading, and immediately proceed to the structured reading.\n"
+        f"2. **Flow Control:** If the USER INPUT contains commands related to state change (like 'next plant', 'ginger', or another 'voice'), **ignore those commands** as the main application handles navigation.\n"
+        f"3. **Write the {len(rows)} readings in order.** Start each one with its delimiter on a line of its own, exactly `=== READING n ===` (n is its number above), "
+        f"followed by ONLY the three parts of that reading, in its own persona, using only its own DATA:\n"
+        f"    - **Part 1: History and Origin**\n"
+        f"    - **Part 2: Key Features and Uses**\n"
+        f"    - **Part 3: Scientific Details and Context**\n"
+        f"4. **Do not include any other text** (no ending summary, no markdown wrappers)."
+    )
 
-        # 3. COMMAND: Next Plant or Plant by Name
-        plant_commands = ["next plant"] + self.plant_sequence
-        if any(p in user_input_lower for p in plant_commands):
-            return self._handle_plant_navigation(user_input)
 
-        # 4. Handle all other inputs (Redirect/Vague Question)
-        # This now routes ALL conversational inputs back to _generate_reading
-        # via _handle_redirect, allowing the LLM prompt to manage the guardrail and content delivery.
-        return self._handle_redirect(user_input)
+class PromptLibrary:
+    """
+    System prompts per (plant, voice) pair, all built once when the catalogue is loaded, so no
+    turn pays for one and concurrent sessions only ever read the dict.
+    """
+
+    def __init__(self, plant_data: PlantIndex):
+        self._prompts: dict[tuple[str, str], str] = {
+            (record.plant, record.voice): build_system_prompt(record) for record in plant_data
+        }
+
+    def get(self, plant: str, voice: str) -> str | None:
+        return self._prompts.get((plant, voice))
+
+    def __len__(self) -> int:
+        return len(self._prompts)
+
 
 # ======================================================================
-# 5. API INTERACTION FUNCTION
+# 5. INTENT CLASSIFICATION (LOCAL ROUTING)
 # ======================================================================
 
-def generate_llm_response(system_prompt_content: str) -> str:
-    """Sends the system prompt to the chosen LLM for prose generation (structured expansion)."""
+IntentKind = Literal['select_voice', 'continue', 'affirm', 'next_plant', 'previous_plant', 'goto_plant', 'open']
 
-    try:
-        response = client.chat.completions.create(
-            model=MODEL_ID,
-            messages=[
-                {"role": "system", "content": system_prompt_content},
-            ],
-            temperature=0.5,
-            max_tokens=1024
-        )
+# Tie-break between equally confident intents, mirroring the original routing order
+INTENT_PRIORITY = {'continue': 0, 'affirm': 1, 'select_voice': 2, 'next_plant': 3, 'previous_plant': 4, 'goto_plant': 5}
 
-        # Log success (only visible in Streamlit Cloud logs)
-        print(f"DEBUG A: LLM API call SUCCESS.")
 
-        raw_content = response.choices[0].message.content
+@dataclass(frozen=True, slots=True)
+class Intent:
+    """
+    What an input asks for: the kind, its argument (voice or plant) and how sure the match is.
+    An ambiguous intent is not clearly better than another reading of the input.
+    """
+    kind: IntentKind
+    value: str | None = None
+    confidence: float = 1.0
+    ambiguous: bool = False
 
-        # --- FAIL-SAFE CHECK ---
-        if not raw_content or raw_content.isspace():
-            print(f"[LLM CONTENT FAIL] Model returned empty or blank content for prompt.")
-            return "[EMPTY CONTENT ERROR] The LLM returned a blank response."
-        # ---------------------------
 
-        # Return the raw content
-        return raw_content
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance, giving up (returning limit + 1) as soon as it must exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
 
-    except Exception as e:
-        # Critical failure if the LLM can't generate the reading
-        print(f"\n[CRITICAL LLM ERROR] Failed to expand reading: {type(e).__name__} - {e}")
-        return f"[CRITICAL LLM ERROR] Failed to expand reading: {type(e).__name__} - {e}"
 
-# ======================================================================
-# 6. STREAMLIT UI RUNNER
-# ======================================================================
+class IntentClassifier:
+    """
+    Resolves command-like inputs locally, so routing never needs the LLM. Every alias (commands,
+    voices and their synonyms, plant names, synonyms and Latin names) is compiled into one
+    word-bounded regex; misspelled words are corrected against the alias vocabulary first.
+    Confidence reflects how much of the input the matched alias (plus filler words) explains,
+    so "is there evidence it lowers cholesterol?" stays an open question for the model. A command
+    must also beat the runner-up (another command, or the input read as a question) by a margin,
+    and commands in a negated clause ("I don't want to continue") do not count at all.
+    """
 
-def run_streamlit_app():
-    # 1. Configuration and Title
-    st.set_page_config(page_title="Botanical Guide Agent", layout="centered")
-    st.title("🌿 Interactive Botanical Guide")
-    st.markdown("---")
+    CORRECTION_CACHE_SIZE = 4096
 
-    # 2. API Key Loading (using Streamlit's secrets for security)
-    try:
-        openrouter_key = st.secrets["OPENROUTER_API_KEY"]
-    except KeyError:
-        st.error("API Key not found in Streamlit Secrets. Please configure `OPENROUTER_API_KEY`.")
-        return
+    def __init__(self, plant_sequence: list[str], voice_options: list[str], plant_data: PlantIndex | None = None):
+        self._aliases: dict[str, tuple[IntentKind, str | None]] = {}
 
-    # 3. Initialization and Agent Setup
-    if 'agent' not in st.session_state:
+        def add(kind: IntentKind, value: str | None, phrases) -> None:
+            for phrase in phrases:
+                self._aliases.setdefault(normalize_text(phrase), (kind, value))
 
-        # CRITICAL: Initialize the global client with the loaded secret
-        global client
-        client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_key,
-            # Increased request timeout to 120 seconds to handle complex generation
-            timeout=httpx.Timeout(120.0, connect=30.0)
-        )
+        add('continue', None, CONTINUE_PHRASES)
+        add('next_plant', None, NEXT_PLANT_PHRASES)
+        add('previous_plant', None, PREVIOUS_PLANT_PHRASES)
+        add('affirm', None, AFFIRMATIVE_PHRASES)
+        for voice in voice_options:
+            add('select_voice', voice, [voice, VOICE_MAPPING.get(voice, voice)] + VOICE_SYNONYMS.get(voice, []))
+        for plant in plant_sequence:
+            add('goto_plant', plant, [plant] + PLANT_SYNONYMS.get(plant, []))
+        for record in plant_data or ():
+            # "Boswellia serrata (or Boswellia sacra, ...)" -> "boswellia serrata"
+            latin_name = normalize_text(record.latin_name.split('(')[0])
+            if latin_name and latin_name != "n a":
+                add('goto_plant', record.plant, [latin_name, latin_name.split()[0]])  # Binomial and genus
+        self._aliases.pop("", None)
 
-        # Initialize the rest of the agent's state
-        PLANT_DATA = load_and_structure_plant_data(DOC_TEXT, PLANT_SEQUENCE, VOICE_MAPPING)
-        st.session_state.agent = BotanicalGuideAgent(PLANT_DATA, PLANT_SEQUENCE, VOICE_OPTIONS)
-        st.session_state.messages = []
-        st.session_state.messages.append(
-            {"role": "agent", "content": st.session_state.agent.respond("")}
-        )
+        alternatives = sorted(self._aliases, key=len, reverse=True)  # Longest alias wins ("tell me more" over "more")
+        self._pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, alternatives)) + r")\b")
+        self._vocabulary = {word for alias in self._aliases for word in alias.split() if len(word) >= 4}
+        self._known_words = INTENT_FILLER_WORDS | {word for alias in self._aliases for word in alias.split()}
+        self._corrections: dict[str, tuple[str, int]] = {}
 
-    # 4. Display Chat History
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    def _correct(self, word: str) -> tuple[str, int]:
+        """Closest alias word within one edit (two for longer words), and the number of edits."""
+        if word in self._known_words or len(word) < 4 or word.isdigit():
+            return word, 0
+        cached = self._corrections.get(word)
+        if cached is not None:
+            return cached
 
-    # 5. Handle User Input
-    if prompt := st.chat_input("Enter your command (e.g., 'elder', 'continue', 'next plant', 'ginger')..."):
-        # Add user prompt to history
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        limit = 1 if len(word) <= 6 else 2
+        best = (word, 0)
+        for candidate in self._vocabulary:
+            distance = bounded_edit_distance(word, candidate, limit)
+            if distance <= limit:
+                best, limit = (candidate, distance), distance - 1
+                if limit < 1:
+                    break
 
-        # Display user message immediately
-        with st.chat_message("user"):
-            st.markdown(prompt)
+        if len(self._corrections) >= self.CORRECTION_CACHE_SIZE:
+            self._corrections.clear()
+        self._corrections[word] = best
+        return best
 
-        # Get agent response
-        with st.chat_message("agent"):
-            # The agent's respond method handles all the logic and LLM calls
-            response = st.session_state.agent.respond(prompt)
-            st.markdown(response)
+    def _negated(self, user_input: str) -> set[tuple[IntentKind, str | None]]:
+        """The commands named (possibly misspelled) in a clause that also has a negation."""
+        negated = set()
+        for clause in re.split(r"[,.;:!?]+", user_input):
+            text = normalize_text(clause)
+            if INTENT_NEGATION_PATTERN.search(text):
+                text = " ".join(self._correct(word)[0] for word in text.split())
+                negated.update(self._aliases[match.group(0)] for match in self._pattern.finditer(text))
+        return negated
+
+    def _score(self, text: str, quality: float, negated: set = frozenset()) -> Intent | None:
+        words = text.split()
+        matched: dict[tuple[IntentKind, str | None], list[str]] = {}
+        for match in self._pattern.finditer(text):
+            if self._aliases[match.group(0)] not in negated:
+                matched.setdefault(self._aliases[match.group(0)], []).extend(match.group(0).split())
+        if not matched:
+            return None
+        if len({kind for kind, _ in matched}) > 1:
+            matched.pop(('affirm', None), None)  # "yes please, next plant": the other command says what the yes is for
+
+        # A candidate explains its own alias words plus any filler word elsewhere, including
+        # filler claimed by other aliases ("tell me more about ginger" is about ginger)
+        filler = sum(1 for word in words if word in INTENT_FILLER_WORDS)
+
+        candidates = []
+        for (kind, value), own_words in matched.items():
+            explained = len(own_words) + filler - sum(1 for word in own_words if word in INTENT_FILLER_WORDS)
+            coverage = min(1.0, explained / len(words))
+            candidates.append(Intent(kind, value, round(quality * (0.5 + 0.5 * coverage), 3)))
+        candidates.sort(key=lambda intent: (intent.confidence, -INTENT_PRIORITY[intent.kind]), reverse=True)
+        best = candidates[0]
+
+        # The runner-up: the next command, or the input as an open question (scored by what the best leaves unexplained)
+        as_question = round(quality * (1.5 - best.confidence / quality), 3)
+        runner_up = max([as_question] + [intent.confidence for intent in candidates[1:]])
+        if round(best.confidence - runner_up, 3) < INTENT_MIN_MARGIN:
+            return Intent(best.kind, best.value, best.confidence, ambiguous=True)
+        return best
+
+    def classify(self, user_input: str) -> Intent:
+        text = normalize_text(user_input)
+        if not text:
+            return Intent('open')
+
+        negated = self._negated(user_input)
+        intent = self._score(text, quality=1.0, negated=negated)
+        if intent is None or intent.confidence < 1.0:
+            corrections = [self._correct(word) for word in text.split()]
+            edits = sum(distance for _, distance in corrections)
+            if edits:
+                corrected = self._score(" ".join(word for word, _ in corrections), quality=max(0.5, 1.0 - 0.15 * edits), negated=negated)
+                if corrected is not None and (intent is None or corrected.confidence > intent.confidence):
+                    intent = corrected
+        return intent or Intent('open')
+
+
+# ======================================================================
+# 6. CATALOGUE SEARCH (BM25 INVERTED INDEX)
+# ======================================================================
+
+CATALOGUE_QUESTION_PATTERN = re.compile(r"\b(?:" + "|".join(re.escape(phrase) for phrase in CATALOGUE_QUESTION_PHRASES) + r")\b")
+
+
+def is_catalogue_question(user_input: str) -> bool:
+    """True for questions about the plants in general ("which plants have caffeine?")."""
+    return CATALOGUE_QUESTION_PATTERN.search(normalize_text(user_input)) is not None
+
+
+def catalogue_terms(text: str) -> list[str]:
+    """Index/query terms: normalized words, aliased, without stop words, with plurals folded ("leaves" -> "leaf")."""
+    terms = []
+    for word in normalize_text(text).split():
+        word = CATALOGUE_TERM_ALIASES.get(word, word)
+        if word in CATALOGUE_STOP_WORDS:
+            continue
+        terms.append(fold_plural(word))
+    return terms
+
+
+def fold_plural(word: str) -> str:
+    """The singular of a regular English plural ("berries" -> "berry", "leaves" -> "leaf", "cloves" -> "clove")."""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith("ves"):
+        for singular in (word[:-1], word[:-3] + "fe"):
+            if singular in CATALOGUE_VE_SINGULARS:
+                return singular
+        return word[:-3] + "f"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+@dataclass(frozen=True)
+class CatalogueMatch:
+    plant: str
+    score: float
+    field: str  # The label of the best-matching field, e.g. "Contraindications"
+    text: str
+    matched_terms: int = 0  # Distinct query terms found in that field
+
+
+class CatalogueSearchIndex:
+    """
+    BM25 over the catalogue's fixed fields and notes. Each field value is its own small
+    document, so a match can be reported with the field it came from and searches can be
+    restricted to some fields. sync() re-indexes only the plants whose fields changed.
+    """
+
+    FIELDS = (('latin_name', "Latin Name"), ('origin', "Region"), ('parts_used', "Parts Used"),
+              ('contraindications', "Contraindications"))
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, plant_data: PlantIndex | None = None):
+        self._lock = threading.Lock()
+        self._postings: dict[str, dict[int, int]] = {}  # term -> {document id: term frequency}
+        self._documents: dict[int, tuple[str, str, str, int]] = {}  # id -> (plant, field label, text, length)
+        self._plant_documents: dict[str, list[int]] = {}
+        self._signatures: dict[str, str] = {}
+        self._total_length = 0
+        self._next_id = 0
+        self._synced = None  # A weak reference to the PlantIndex indexed last
+        self.reindexed_plants = 0
+        if plant_data is not None:
+            self.sync(plant_data)
+
+    def _plant_fields(self, records: list[PlantRecord]) -> list[tuple[str, str]]:
+        fields = [(label, getattr(records[0], name)) for name, label in self.FIELDS]
+        fields += [(f"{record.voice.capitalize()} note", record.note) for record in records]
+        return [(label, text) for label, text in dict.fromkeys(fields) if text]
+
+    def sync(self, plant_data: PlantIndex) -> None:
+        """Brings the index up to date with plant_data, re-indexing only added or changed plants."""
+        if self._synced is not None and self._synced() is plant_data:
+            return
+
+        by_plant: dict[str, list[PlantRecord]] = {}
+        for record in plant_data:
+            by_plant.setdefault(record.plant, []).append(record)
+
+        with self._lock:
+            for plant in [plant for plant in self._plant_documents if plant not in by_plant]:
+                self._remove(plant)
+            for plant, records in by_plant.items():
+                fields = self._plant_fields(records)
+                signature = hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+                if self._signatures.get(plant) == signature:
+                    continue
+                self._remove(plant)
+                self._add(plant, fields)
+                self._signatures[plant] = signature
+                self.reindexed_plants += 1
+            self._synced = weakref.ref(plant_data)
+
+    def _add(self, plant: str, fields: list[tuple[str, str]]) -> None:
+        document_ids = self._plant_documents.setdefault(plant, [])
+        for label, text in fields:
+            terms = catalogue_terms(text)
+            document_id, self._next_id = self._next_id, self._next_id + 1
+            self._documents[document_id] = (plant, label, text, len(terms))
+            self._total_length += len(terms)
+            document_ids.append(document_id)
+            for term in terms:
+                postings = self._postings.setdefault(term, {})
+                postings[document_id] = postings.get(document_id, 0) + 1
+
+    def _remove(self, plant: str) -> None:
+        for document_id in self._plant_documents.pop(plant, ()):
+            _, _, text, length = self._documents.pop(document_id)
+            self._total_length -= length
+            for term in set(catalogue_terms(text)):
+                postings = self._postings[term]
+                postings.pop(document_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._signatures.pop(plant, None)
+
+    def search(self, terms: list[str], fields: tuple[str, ...] | None = None,
+               k: int = CATALOGUE_SEARCH_TOP_K) -> list[CatalogueMatch]:
+        """The k best plants for the query terms, each with its best-matching field (optionally only among `fields`)."""
+        with self._lock:
+            document_count = len(self._documents)
+            if not document_count:
+                return []
+            average_length = self._total_length / document_count
+
+            scores: dict[int, float] = {}
+            matched: dict[int, int] = {}
+            for term in set(terms):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for document_id, frequency in postings.items():
+                    length = self._documents[document_id][3]
+                    norm = self.K1 * (1 - self.B + self.B * length / average_length)
+                    scores[document_id] = scores.get(document_id, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+                    matched[document_id] = matched.get(document_id, 0) + 1
+
+            best: dict[str, CatalogueMatch] = {}
+            for document_id, score in scores.items():
+                plant, label, text, _ = self._documents[document_id]
+                if fields is not None and label not in fields:
+                    continue
+                if plant not in best or score > best[plant].score:
+                    best[plant] = CatalogueMatch(plant, score, label, text, matched[document_id])
+
+        # Fields matching more of the query first ("south america" over just "south"), then by score
+        return sorted(best.values(), key=lambda match: (-match.matched_terms, -match.score))[:k]
+
+    def field_text(self, plant: str, field: str) -> str | None:
+        with self._lock:
+            for document_id in self._plant_documents.get(plant, ()):
+                if self._documents[document_id][1] == field:
+                    return self._documents[document_id][2]
+        return None
+
+    @property
+    def plants(self) -> list[str]:
+        with self._lock:
+            return list(self._plant_documents)
+
+
+@st.cache_resource
+def get_catalogue_search() -> CatalogueSearchIndex:
+    """One index per process, kept in sync with the catalogue incrementally."""
+    return CatalogueSearchIndex()
+
+
+# ======================================================================
+# 7. READING CACHE (PERSISTENT, CONTENT-ADDRESSED)
+# ======================================================================
+
+class ReadingCache:
+    """
+    On-disk SQLite cache of parsed three-part readings. Entries are keyed by the
+    normalized system prompt plus the model settings, expire after a TTL, and the
+    least recently used entries are evicted once the size cap is reached.
+    """
+
+    def __init__(self, path: str = READING_CACHE_PATH, ttl_seconds: int = READING_CACHE_TTL_SECONDS,
+                 max_entries: int = READING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # One connection shared by all sessions; the lock serializes access to it
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS readings ("
+            "key TEXT PRIMARY KEY, parts TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS readings_last_access ON readings (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(system_prompt: str, user_input: str = "", model: str = MODEL_ID,
+                 temperature: float = TEMPERATURE) -> str:
+        """Hashes the whitespace/case-normalized prompt and input together with the model and temperature."""
+        normalized_prompt = " ".join(system_prompt.split()).lower()
+        normalized_input = " ".join(user_input.split()).lower()
+        payload = f"{model}\x1f{temperature}\x1f{normalized_prompt}\x1f{normalized_input}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> list[str] | None:
+        """Returns the cached parts, or None on a miss or an expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT parts, created_at FROM readings WHERE key = ?", (key,)).fetchone()
+
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM readings WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE readings SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def contains(self, key: str) -> bool:
+        """Checks for a live entry without counting a hit or miss."""
+        with self._lock:
+            row = self._conn.execute("SELECT created_at FROM readings WHERE key = ?", (key,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl_seconds
+
+    def put(self, key: str, parts: list[str]) -> None:
+        """Stores the parts and evicts expired and least recently used entries beyond the size cap."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO readings (key, parts, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(parts), now, now)
+            )
+            self._conn.execute("DELETE FROM readings WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM readings WHERE key IN ("
+                "SELECT key FROM readings ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size, for logging or display."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+
+# ======================================================================
+# 8. SEMANTIC CACHE (PARAPHRASED QUESTIONS)
+# ======================================================================
+
+SEMANTIC_PHRASE_PATTERN = re.compile(r"\b(?:" + "|".join(re.escape(phrase) for phrase in sorted(SEMANTIC_PHRASE_ALIASES, key=len, reverse=True)) + r")\b")
+
+
+def question_features(question: str, ignore: tuple[str, ...] = ()) -> list[str]:
+    """
+    Word unigrams and bigrams plus character trigrams of the normalized, aliased question,
+    without stop words or the words of `ignore` (the plant and voice the scope already fixes).
+    """
+    text = SEMANTIC_PHRASE_PATTERN.sub(lambda match: SEMANTIC_PHRASE_ALIASES[match.group(0)], normalize_text(question))
+    ignored = SEMANTIC_STOP_WORDS.union(*(normalize_text(name).split() for name in ignore))
+    words = [word for word in text.split() if word not in ignored]
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features += ["#" + padded[i:i + 3] for i in range(len(padded) - 2)]
+    return features
+
+
+def question_vector(question: str, dimensions: int = SEMANTIC_CACHE_DIMENSIONS, ignore: tuple[str, ...] = ()) -> np.ndarray:
+    """L2-normalized hashed feature vector; words count more than their character trigrams."""
+    import numpy as np
+
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature in question_features(question, ignore):
+        digest = zlib.crc32(feature.encode("utf-8"))
+        weight = 0.5 if feature.startswith("#") else 1.0
+        vector[digest % dimensions] += weight if digest & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@dataclass
+class SemanticEntry:
+    question: str
+    value: object  # Whatever was cached: an answer string or a list of reading parts
+    created_at: float
+    last_hit: float = 0.0
+    hits: int = 0
+
+
+class SemanticCache:
+    """
+    In-process cache of answers to free-form questions, reused for paraphrases. Questions are
+    hashed n-gram vectors; each (plant, voice, kind) scope keeps a matrix of them, and a lookup
+    is one matrix-vector product. A stored answer is reused when the best cosine similarity
+    reaches the threshold (configurable per (plant, voice)). Each scope holds at most
+    `max_entries`; the least-hit (then least recently hit) entry is evicted first. Entries
+    expire after `ttl_seconds`, and a scope is emptied once a newer catalogue version is used.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+                 dimensions: int = SEMANTIC_CACHE_DIMENSIONS, log_path: str | None = QUESTION_LOG_PATH,
+                 ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.dimensions = dimensions
+        self.ttl_seconds = ttl_seconds
+        self.thresholds: dict[tuple[str, str], float] = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors: dict[tuple, np.ndarray] = {}
+        self._entries: dict[tuple, list[SemanticEntry]] = {}
+        self._versions: dict[tuple, int] = {}  # The catalogue version each scope's answers were generated from
+        self._log = open(log_path, "a", encoding="utf-8", buffering=1) if log_path else None
+
+    def set_threshold(self, plant: str, voice: str, threshold: float) -> None:
+        self.thresholds[(plant, voice)] = threshold
+
+    def _current(self, scope: tuple, version: int, now: float) -> bool:
+        """
+        Drops the scope's expired entries, or all of them if they predate `version`. False if
+        the scope already holds answers from a newer catalogue than `version`. Call with the lock held.
+        """
+        stored = self._versions.setdefault(scope, version)
+        if stored > version:
+            return False
+        entries = self._entries.get(scope)
+        if stored < version:
+            keep = []
+            self._versions[scope] = version
+        elif entries and self.ttl_seconds > 0:
+            keep = [index for index, entry in enumerate(entries) if now - entry.created_at < self.ttl_seconds]
+        else:
+            return True
+        if entries is not None and len(keep) < len(entries):
+            if keep:
+                self._entries[scope] = [entries[index] for index in keep]
+                self._vectors[scope] = self._vectors[scope][keep]
+            else:
+                del self._entries[scope], self._vectors[scope]
+        return True
+
+    def get(self, plant: str, voice: str, kind: str, question: str, version: int = 0) -> object | None:
+        """The value stored for the most similar earlier question, if similar enough, unexpired and from `version`."""
+        if self._log is not None:
+            with self._lock:
+                self._log.write(json.dumps({'plant': plant, 'voice': voice, 'kind': kind, 'question': question, 'at': time.time()}) + "\n")
+
+        vector = question_vector(question, self.dimensions, ignore=(plant, voice))
+        with self._lock:
+            current = self._current((plant, voice, kind), version, time.time())
+            vectors = self._vectors.get((plant, voice, kind))
+            if current and vectors is not None:
+                similarities = vectors @ vector
+                best = int(similarities.argmax())
+                if similarities[best] >= self.thresholds.get((plant, voice), self.threshold):
+                    entry = self._entries[(plant, voice, kind)][best]
+                    entry.hits += 1
+                    entry.last_hit = time.time()
+                    self.hits += 1
+                    return entry.value
+            self.misses += 1
+        return None
+
+    def put(self, plant: str, voice: str, kind: str, question: str, value: object, version: int = 0) -> None:
+        import numpy as np
+
+        scope = (plant, voice, kind)
+        vector = question_vector(question, self.dimensions, ignore=(plant, voice))
+        with self._lock:
+            if not self._current(scope, version, time.time()):
+                return  # Generated from an older catalogue than the one already cached
+            vectors = self._vectors.get(scope)
+            entries = self._entries.setdefault(scope, [])
+            if vectors is not None and len(entries) >= self.max_entries:
+                evicted = min(range(len(entries)), key=lambda i: (entries[i].hits, entries[i].last_hit or entries[i].created_at))
+                entries[evicted] = SemanticEntry(question, value, time.time())
+                vectors[evicted] = vector
+                return
+            entries.append(SemanticEntry(question, value, time.time()))
+            self._vectors[scope] = vector[np.newaxis, :] if vectors is None else np.vstack([vectors, vector])
+
+    def entry_stats(self, plant: str, voice: str, kind: str) -> list[dict]:
+        """Per-entry hit counts for one scope, most hit first."""
+        with self._lock:
+            entries = list(self._entries.get((plant, voice, kind), ()))
+        return [
+            {'question': entry.question, 'hits': entry.hits, 'created_at': entry.created_at, 'last_hit': entry.last_hit}
+            for entry in sorted(entries, key=lambda entry: -entry.hits)
+        ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = sum(len(scope_entries) for scope_entries in self._entries.values())
+            scopes = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'scopes': scopes,
+        }
+
+
+@st.cache_resource
+def get_semantic_cache() -> SemanticCache:
+    """One semantic cache per process, shared by every session."""
+    return SemanticCache()
+
+
+def evaluate_semantic_cache(corpus_path: str, thresholds: list[float]) -> list[dict]:
+    """
+    Replays a logged question corpus (QUESTION_LOG_PATH format: plant, voice, kind, question;
+    an optional 'group' labels paraphrases of one question) through a fresh cache per threshold:
+    each miss is stored, each hit counted. With groups, hits on another group's answer are
+    reported as false hits.
+    """
+    with open(corpus_path, encoding="utf-8") as corpus:
+        questions = [json.loads(line) for line in corpus if line.strip()]
+
+    reports = []
+    for threshold in thresholds:
+        cache = SemanticCache(threshold=threshold, log_path=None)
+        false_hits = 0
+        for entry in questions:
+            label = entry.get('group', entry['question'])
+            cached = cache.get(entry['plant'], entry['voice'], entry.get('kind', "answer"), entry['question'])
+            if cached is None:
+                cache.put(entry['plant'], entry['voice'], entry.get('kind', "answer"), entry['question'], label)
+            elif 'group' in entry and cached != label:
+                false_hits += 1
+        report = {'threshold': threshold, 'questions': len(questions), **cache.stats()}
+        if any('group' in entry for entry in questions):
+            report['false_hits'] = false_hits
+        print(f"[SEMANTIC CACHE EVAL] {json.dumps(report)}")
+        reports.append(report)
+    return reports
+
+
+# ======================================================================
+# 9. READING PREFETCH (SPECULATIVE, BACKGROUND)
+# ======================================================================
+
+class ReadingPrefetcher:
+    """
+    Bounded background pool that generates upcoming readings before they are asked for.
+    Requests for the same prompt key share one job; a job that is still queued is
+    cancelled once no session is interested in it any more.
+    """
+
+    def __init__(self, max_workers: int = PREFETCH_MAX_WORKERS, max_pending: int = PREFETCH_MAX_PENDING):
+        self.max_pending = max_pending
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Future] = {}
+        self._interest: dict[str, int] = {}
+
+    def submit(self, key: str, fn, spare_only: bool = False) -> Future | None:
+        """
+        Schedules fn() under key, joining an existing job. Returns None when the queue is full,
+        or with spare_only, unless a worker is idle to start the job right away.
+        """
+        new_job = False
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is None or future.cancelled():
+                pending = sum(1 for f in self._jobs.values() if not f.done())
+                if pending >= (self.max_workers if spare_only else self.max_pending):
+                    return None  # Deprioritized: the live visitors' requests come first
+                future = self._executor.submit(fn)
+                self._jobs[key] = future
+                new_job = True
+            self._interest[key] = self._interest.get(key, 0) + 1
+
+        # Outside the lock: for a job that already finished, the callback (_forget) runs right here
+        if new_job:
+            future.add_done_callback(lambda _f, k=key: self._forget(k, _f))
+        return future
+
+    def __contains__(self, key: str) -> bool:
+        """True while a job for key is queued or running."""
+        with self._lock:
+            return key in self._jobs
+
+    def release(self, key: str) -> None:
+        """Drops one session's interest in key, cancelling the job if it has not started yet."""
+        with self._lock:
+            remaining = self._interest.get(key, 0) - 1
+            if remaining > 0:
+                self._interest[key] = remaining
+                return
+            self._interest.pop(key, None)
+            future = self._jobs.get(key)
+
+        # Outside the lock: cancel() runs the done-callback (_forget) synchronously
+        if future is not None:
+            future.cancel()
+
+    def shutdown(self) -> None:
+        """Drops queued jobs and waits for the running ones to finish."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _forget(self, key: str, future: Future) -> None:
+        with self._lock:
+            if self._jobs.get(key) is future:
+                self._jobs.pop(key, None)
+                self._interest.pop(key, None)
+
+
+# ======================================================================
+# 10. STREAMED READINGS (INCREMENTAL PART PARSING)
+# ======================================================================
+
+# The start of a Part label: "Part 2", with optional Markdown heading/bold markers and a ':' (or '.', '-')
+PART_LABEL_PATTERN = re.compile(
+    r'(?<![^\s#*_])(?P<heading>#{1,6}[ \t]*)?(?P<bold>\*\*|__)?[ \t]*Part[ \t]+(?P<number>\d)\b'
+    r'(?P<tail>(?:[ \t]*(?:\*\*|__|[:.\-\u2013\u2014]))*)[ \t]*'
+)
+PART_LABEL_MAX_LENGTH = 40  # How far back a label's start can be before the end of the buffer
+PART_TITLE_MAX_WORDS = 8  # Rest of a label line longer than this (or ending a sentence) is reading text
+PART_TITLE_SEPARATOR = re.compile(r'[ \t]+[-\u2013\u2014][ \t]+|:[ \t]+|\*\*|__')
+READING_PART_KEYS = ("part1", "part2", "part3") # Field names in the JSON output format
+READING_PART_TITLES = ("History and Origin", "Key Features and Uses", "Scientific Details and Context")
+# Shown in place of a later part that neither the reading nor its repair produced, so the others keep their numbers
+MISSING_PART_TEXT = "[LLM STRUCTURE ERROR] The guide could not generate this part of the reading."
+
+
+def part_label_end(text: str, match: re.Match) -> int | None:
+    """
+    Where the reading text after a Part label starts: after the ':' and an optional title (a
+    known part title, a title closed by '**' or followed by ' - ', or a short title line).
+    None while the label's line is still incomplete; -1 if the match is not a label after all
+    (e.g. "in Part 2 of the story", with no marker or separator).
+    """
+    end = match.end()
+    line_end = text.find("\n", end)
+    rest = text[end:] if line_end < 0 else text[end:line_end]
+    bold_closed = match.group('bold') is None or any(marker in match.group('tail') for marker in ("**", "__"))
+
+    # A title in bold runs to the closing marker
+    if not bold_closed:
+        close = min((i for i in (rest.find("**"), rest.find("__")) if i >= 0), default=-1)
+        if close >= 0:
+            return end + close + 2
+        return None if line_end < 0 else line_end
+
+    for title in READING_PART_TITLES:
+        if rest.lower().startswith(title.lower()):
+            after = end + len(title)
+            if line_end < 0 and len(text) - after < 3:
+                return None  # A separator may still follow
+            while after < len(text) and text[after] in " \t:.-*_\u2013\u2014":
+                after += 1
+            return after
+
+    if line_end < 0:
+        return None
+    if not (match.group('heading') or match.group('bold') or match.group('tail').strip() or not rest.strip()):
+        return -1
+    separator = PART_TITLE_SEPARATOR.search(rest)
+    if separator and len(rest[:separator.start()].split()) <= PART_TITLE_MAX_WORDS:
+        return end + separator.end()
+    if len(rest.split()) <= PART_TITLE_MAX_WORDS and not rest.rstrip().endswith(('.', '!', '?')):
+        return line_end  # The whole line is a title
+    return end  # No title: the reading text starts right after the label
+
+class IncrementalPartParser:
+    """Splits streamed prose on its Part labels as chunks arrive, without rescanning the whole buffer."""
+
+    def __init__(self):
+        self.raw = ""
+        self.parts: list[str] = []  # Finished parts, in order (a part waits for the ones before it)
+        self.found: dict[int, str] = {}  # Finished parts by their label number (0-based)
+        self._current_start = None  # Where the text of the part being generated begins
+        self._current_index = 0
+        self._scan_from = 0
+
+    def _close_part(self, end: int | None) -> None:
+        self.found.setdefault(self._current_index, self.raw[self._current_start:end].strip())
+        while len(self.parts) < len(READING_PART_KEYS) and len(self.parts) in self.found:
+            self.parts.append(self.found[len(self.parts)])
+
+    def feed(self, text: str) -> None:
+        self.raw += text
+
+        while (match := PART_LABEL_PATTERN.search(self.raw, self._scan_from)) is not None:
+            label_end = part_label_end(self.raw, match)
+            if label_end is None:
+                self._scan_from = match.start()  # Wait for the rest of the label's line
+                return
+            if label_end < 0:
+                self._scan_from = match.end()
+                continue
+            if self._current_start is not None:
+                self._close_part(match.start())
+            self._current_start = label_end
+            self._current_index = int(match.group('number')) - 1
+            self._scan_from = label_end
+
+        # Text further back than the longest label start can no longer begin one
+        self._scan_from = max(self._scan_from, len(self.raw) - PART_LABEL_MAX_LENGTH)
+
+    def finish(self) -> None:
+        """Closes the part being generated once the stream has ended."""
+        if self._current_start is not None:
+            self._close_part(None)
+            self._current_start = None
+
+    def abandon(self) -> None:
+        """Drops the part being generated: the stream failed part-way through it."""
+        self._current_start = None
+
+    def reading_parts(self) -> list[str]:
+        """Part 1-3 by label number, '' for any that never arrived."""
+        return [self.found.get(index, "") for index in range(len(READING_PART_KEYS))]
+
+    def open_part(self) -> tuple[int, str] | None:
+        """(index, text so far) of the part still being written, before finish()."""
+        if self._current_start is None:
+            return None
+        return self._current_index, self.raw[self._current_start:].strip()
+
+    def resume(self, continuation: str) -> None:
+        """Appends generated text to the open part."""
+        self.feed(" " + continuation.strip())
+
+    def active_text(self) -> str:
+        """The unfinished part so far, holding back a trailing line that may become the next label."""
+        if self._current_start is None or self._current_index != len(self.parts):
+            return ""
+
+        text = self.raw[self._current_start:]
+        tail_start = max(text.rfind('\n'), text.rfind('**'))
+        if tail_start >= 0 and "Part".startswith(text[tail_start + 1:].lstrip('#*_ \t')[:4]):
+            text = text[:tail_start]
+        return text.strip()
+
+
+class IncrementalJSONPartParser:
+    """
+    Tolerant, incremental reader for the JSON output format: picks the part1/part2/part3
+    string fields out of the stream as they complete, wherever they sit in the object,
+    ignoring markdown fences or chatter around it. A field cut off by the end of the
+    stream (or given a non-string value) simply counts as missing. Same interface as
+    IncrementalPartParser.
+    """
+
+    ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+
+    def __init__(self):
+        self.raw = ""
+        self.parts: list[str] = []  # Finished parts, in order (a part waits for the ones before it)
+        self.found: dict[int, str] = {}
+        self._pos = 0
+        self._in_string = False
+        self._escape = ""
+        self._chars: list[str] = []
+        self._value_index: int | None = None  # Part being decoded, if the open string is a part's value
+        self._last_string: str | None = None  # The most recent string outside a value: maybe a key
+        self._pending_index: int | None = None  # A part key followed by ':' whose value has not started
+
+    def feed(self, text: str) -> None:
+        self.raw += text
+        for char in text:
+            if self._in_string:
+                self._feed_string_char(char)
+            elif char == '"':
+                self._in_string = True
+                self._chars = []
+                self._value_index, self._pending_index = self._pending_index, None
+            elif char == ':':
+                if self._last_string in READING_PART_KEYS:
+                    self._pending_index = READING_PART_KEYS.index(self._last_string)
+                self._last_string = None
+            elif not char.isspace():
+                self._last_string = None
+                self._pending_index = None  # A non-string value: not a part
+
+    def _feed_string_char(self, char: str) -> None:
+        if self._escape:
+            self._escape += char
+            if self._escape[1] != 'u':
+                self._chars.append(self.ESCAPES.get(char, char))
+                self._escape = ""
+            elif len(self._escape) == 6:
+                try:
+                    self._chars.append(chr(int(self._escape[2:], 16)))
+                except ValueError:
+                    pass
+                self._escape = ""
+        elif char == '\\':
+            self._escape = char
+        elif char == '"':
+            self._in_string = False
+            value = "".join(self._chars).encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+            if self._value_index is None:
+                self._last_string = value
+            else:
+                self.found.setdefault(self._value_index, value.strip())
+                while len(self.parts) < len(READING_PART_KEYS) and len(self.parts) in self.found:
+                    self.parts.append(self.found[len(self.parts)])
+                self._value_index = None
+        else:
+            self._chars.append(char)
+
+    def finish(self) -> None:
+        """An unterminated string at the end of the stream is an incomplete part; drop it."""
+        self._in_string = False
+        self._value_index = None
+
+    abandon = finish
+
+    def active_text(self) -> str:
+        """The next part's text decoded so far, while its string is still open."""
+        if self._in_string and self._value_index == len(self.parts):
+            return "".join(self._chars).strip()
+        return ""
+
+    def reading_parts(self) -> list[str]:
+        return [self.found.get(index, "") for index in range(len(READING_PART_KEYS))]
+
+    def open_part(self) -> tuple[int, str] | None:
+        if not self._in_string or self._value_index is None:
+            return None
+        return self._value_index, "".join(self._chars).strip()
+
+    def resume(self, continuation: str) -> None:
+        """Appends generated text to the open part's string and closes it."""
+        self.feed(json.dumps(" " + continuation.strip())[1:])
+
+
+class ReadingFailure(str):
+    """The message returned instead of a reading's Part 1 when none could be had (LLM, structure or budget error)."""
+
+
+class StreamingReading:
+    """
+    Consumes a streamed completion on a background thread. `parts` fills up as each
+    Part label arrives, so later parts are ready (or nearly so) when the visitor continues.
+    """
+
+    def __init__(self, system_prompt: str, user_input: str, on_complete=None, max_tokens: int = MAX_TOKENS, call=None,
+                 upstream_slot=None):
+        self.json_output = READING_OUTPUT_FORMAT == "json"
+        self.parser = IncrementalJSONPartParser() if self.json_output else IncrementalPartParser()
+        self.parts = self.parser.parts
+        self.done = False
+        self.max_tokens = max_tokens
+        self.finish_reason: str | None = None  # Set with usage once the stream ends, like an LLMText
+        self.usage: dict = {}
+        self.error: str | None = None  # Set if the stream failed; such a reading is never cached
+        self._call = call  # For continuing a cut-off part and repairing missing ones
+        self._upstream_slot = upstream_slot
+        self._on_complete = on_complete
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, args=(system_prompt, user_input), name="reading-stream", daemon=True)
+
+    def start(self) -> "StreamingReading":
+        self._thread.start()
+        return self
+
+    def _finished(self, finish_reason: str | None, usage: dict) -> None:
+        self.finish_reason, self.usage = finish_reason, usage
+
+    def _run(self, system_prompt: str, user_input: str) -> None:
+        try:
+            try:
+                for chunk in generate_llm_response_stream(system_prompt, user_input, self.json_output, self.max_tokens,
+                                                          on_finish=self._finished, upstream_slot=self._upstream_slot):
+                    with self._cond:
+                        self.parser.feed(chunk)
+                        self._cond.notify_all()
+            except LLMStreamError as e:
+                # Keep the parts that arrived whole; the one that was interrupted is dropped
+                with self._cond:
+                    self.error = str(e)
+                    self.parser.abandon()
+
+            # Cut off by max_tokens: have the interrupted part finished rather than lose it
+            if self.finish_reason == 'length':
+                with self._cond:
+                    open_part = self.parser.open_part()
+                continuation = continue_cut_off_part(open_part, system_prompt, user_input, self._call)
+                if continuation:
+                    with self._cond:
+                        self.parser.resume(continuation)
+                        self._cond.notify_all()
+
+            with self._cond:
+                self.parser.feed("\n")  # A final label line needs its line break
+                self.parser.finish()
+
+            # Ask again for just the parts that did not arrive, then publish them in order
+            reading_parts = self.parser.reading_parts()
+            if reading_parts[0] and not all(reading_parts):
+                repaired = repair_reading_parts(system_prompt, user_input, reading_parts, call=self._call)
+                with self._cond:
+                    self.parts[:] = fill_missing_parts(repaired)  # In place: the agent holds this list
+        finally:
+            with self._cond:
+                self.parser.finish()
+                self.done = True
+                self._cond.notify_all()
+
+        if self._on_complete is not None:
+            self._on_complete(self)
+
+    def wait_for_part(self, index: int, on_progress=None) -> str | None:
+        """
+        Blocks until part `index` (0-based) is finished and returns it, or None if the
+        stream ended without it. on_progress receives the partial text while waiting.
+        """
+        shown = ""
+        while True:
+            with self._cond:
+                if len(self.parts) > index:
+                    return self.parts[index]
+                if self.done:
+                    return None
+                self._cond.wait(timeout=0.5)
+                text = self.parser.active_text() if len(self.parts) == index else ""
+
+            # Render outside the lock so the stream is never held up by the UI
+            if on_progress is not None and text and text != shown:
+                shown = text
+                on_progress(text)
+
+
+# ======================================================================
+# 11. TRACING & METRICS
+# ======================================================================
+
+class LatencyHistogram:
+    """Fixed, log-spaced buckets (0.1 ms to ~100 s): constant-time recording, approximate percentiles."""
+
+    BOUNDS_MS = [0.1 * 2 ** i for i in range(21)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, duration_ms: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, duration_ms)] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+
+    def percentile(self, pct: float) -> float:
+        """Upper bound of the bucket holding the pct-th percentile."""
+        target = pct / 100.0 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target and bucket_count:
+                return self.BOUNDS_MS[index] if index < len(self.BOUNDS_MS) else float('inf')
+        return 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': {f"<={bound:g}ms": n for bound, n in zip(self.BOUNDS_MS + [float('inf')], self.counts) if n},
+        }
+
+
+class TurnTrace:
+    """Spans and attributes collected while one visitor turn is handled."""
+
+    __slots__ = ('name', 'started_at', 'spans', 'attributes')
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.started_at = time.time()
+        self.spans: list[tuple[str, float]] = []
+        self.attributes = attributes
+
+
+class Tracer:
+    """
+    Lightweight always-on instrumentation: spans are timed with perf_counter, kept on a
+    per-thread turn trace, and folded into in-process histograms. Outcomes (cache hit,
+    prefetch miss, ...) are counted too. Given a log path, each finished turn is also written
+    as one JSONL line; past max_bytes the file is moved to <path>.1 and a new one started.
+    """
+
+    def __init__(self, log_path: str | None = TRACE_LOG_PATH, max_bytes: int = TRACE_LOG_MAX_BYTES):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.histograms: dict[str, LatencyHistogram] = {}
+        self.counters: dict[str, int] = {}
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self._log = open(log_path, "a", encoding="utf-8", buffering=1) if log_path else None
+
+    def current(self) -> TurnTrace | None:
+        return getattr(self._local, 'trace', None)
+
+    @contextmanager
+    def attach(self, trace: TurnTrace | None):
+        """Records into `trace` from another thread (e.g. a hedged request's worker)."""
+        previous, self._local.trace = self.current(), trace
+        try:
+            yield
+        finally:
+            self._local.trace = previous
+
+    @contextmanager
+    def turn(self, name: str = "turn", **attributes):
+        """Collects everything recorded on this thread into one trace, logged when the block exits."""
+        trace = TurnTrace(name, attributes)
+        previous, self._local.trace = self.current(), trace
+        started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            self._local.trace = previous
+            self.record_span(name, duration_ms)
+            if self._log is not None:
+                line = json.dumps({
+                    'turn': name, 'started_at': trace.started_at, 'duration_ms': round(duration_ms, 3),
+                    'spans': trace.spans, **trace.attributes,
+                })
+                with self._lock:
+                    self._log.write(line + "\n")
+                    if self.max_bytes and self._log.tell() >= self.max_bytes:
+                        self._rotate()
+
+    def _rotate(self) -> None:
+        """Keeps one previous file; called with the lock held."""
+        self._log.close()
+        os.replace(self.log_path, self.log_path + ".1")
+        self._log = open(self.log_path, "a", encoding="utf-8", buffering=1)
+
+    @contextmanager
+    def span(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, (time.perf_counter() - started) * 1000)
+
+    def record_span(self, name: str, duration_ms: float) -> None:
+        """Records an externally timed span (e.g. connect time reported by httpx)."""
+        trace = self.current()
+        if trace is not None:
+            trace.spans.append((name, round(duration_ms, 3)))
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(duration_ms)
+
+    def annotate(self, **attributes) -> None:
+        """Attaches attributes to the current turn; string values are also counted as outcomes."""
+        trace = self.current()
+        if trace is not None:
+            trace.attributes.update(attributes)
+        with self._lock:
+            for key, value in attributes.items():
+                if isinstance(value, str):
+                    counter = f"{key}={value}"
+                    self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'spans': {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    """The process-wide tracer, shared by every session and by the LLM call functions."""
+    return Tracer()
+
+
+def http_trace_hooks(is_async: bool = False) -> dict:
+    """httpx event hooks that time connection setup and time-to-first-byte of each upstream request."""
+
+    def make_trace_callback():
+        tracer = get_tracer()
+        request_started = time.perf_counter()
+        marks = {}
+
+        def on_event(event_name: str, info: dict) -> None:
+            now = time.perf_counter()
+            if event_name == "connection.connect_tcp.started":
+                marks['connect'] = now
+            elif event_name.endswith("send_request_headers.started") and 'connect' in marks:
+                tracer.record_span("llm.connect", (now - marks.pop('connect')) * 1000)  # TCP + TLS
+            elif event_name.endswith("receive_response_headers.complete"):
+                tracer.record_span("llm.ttfb", (now - request_started) * 1000)
+
+        return on_event
+
+    if is_async:
+        async def attach_trace(request):
+            on_event = make_trace_callback()
+
+            async def trace(event_name, info):
+                on_event(event_name, info)
+
+            request.extensions["trace"] = trace
+
+        return {'request': [attach_trace]}
+
+    def attach_trace(request):
+        request.extensions["trace"] = make_trace_callback()
+
+    return {'request': [attach_trace]}
+
+
+# ======================================================================
+# 12. TOKEN BUDGETS (ADAPTIVE MAX_TOKENS)
+# ======================================================================
+
+class TokenBudgeter:
+    """
+    Sizes each LLM call from what similar calls actually needed. Recent completion lengths are
+    kept per (voice, request kind); max_tokens is their 95th percentile plus headroom (never
+    above the fixed default), and the prompt asks for about the median length. A completion
+    cut off by max_tokens counts as at least that long, so a cap that is too tight grows back.
+    Token use is metered against a per-session and a rolling hourly global budget.
+    """
+
+    def __init__(self, window: int = TOKEN_BUDGET_WINDOW, min_samples: int = TOKEN_BUDGET_MIN_SAMPLES,
+                 headroom: float = TOKEN_BUDGET_HEADROOM, session_budget: int = TOKEN_BUDGET_SESSION,
+                 global_budget_per_hour: int = TOKEN_BUDGET_GLOBAL_PER_HOUR):
+        self.window = window
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.session_budget = session_budget
+        self.global_budget_per_hour = global_budget_per_hour
+        self.total_tokens = 0
+        self.truncations = 0
+        self._lock = threading.Lock()
+        self._lengths: dict[tuple[str, str], deque[int]] = {}
+        self._recent_usage: deque[tuple[float, int]] = deque()  # (time, tokens) within the last hour
+        self._recent_total = 0
+
+    def _sorted_lengths(self, voice: str | None, kind: str) -> list[int]:
+        with self._lock:
+            return sorted(self._lengths.get((voice, kind), ()))
+
+    def max_tokens(self, voice: str | None, kind: str, default: int = MAX_TOKENS) -> int:
+        lengths = self._sorted_lengths(voice, kind)
+        if len(lengths) < self.min_samples:
+            return default
+        p95 = lengths[min(len(lengths) - 1, int(len(lengths) * 0.95))]
+        return max(64, min(default, int(p95 * self.headroom)))
+
+    def length_guidance(self, voice: str | None, kind: str, per: str = "in total") -> str:
+        """A sentence for the end of the system prompt, or '' until enough lengths are known."""
+        lengths = self._sorted_lengths(voice, kind)
+        if len(lengths) < self.min_samples:
+            return ""
+        words = max(25, round(statistics.median(lengths) * 0.75 / 25) * 25)  # ~0.75 words per token, in steps of 25
+        return f"\n\nLENGTH: Aim for about {words} words {per}."
+
+    def observe(self, voice: str | None, kind: str | None, completion) -> int:
+        """
+        Charges a completion (LLMText, or a finished StreamingReading) to the global budget and,
+        given a kind, learns its length. Returns the tokens used, to charge to the session too.
+        """
+        usage = getattr(completion, 'usage', None) or {}
+        completion_tokens = usage.get('completion_tokens') or 0
+        tokens = (usage.get('prompt_tokens') or 0) + completion_tokens
+        now = time.time()
+        with self._lock:
+            if kind is not None and completion_tokens:
+                self._lengths.setdefault((voice, kind), deque(maxlen=self.window)).append(completion_tokens)
+            if getattr(completion, 'finish_reason', None) == 'length':
+                self.truncations += 1
+            self.total_tokens += tokens
+            self._recent_usage.append((now, tokens))
+            self._recent_total += tokens
+        return tokens
+
+    def tokens_last_hour(self) -> int:
+        cutoff = time.time() - 3600
+        with self._lock:
+            while self._recent_usage and self._recent_usage[0][0] < cutoff:
+                self._recent_total -= self._recent_usage.popleft()[1]
+            return self._recent_total
+
+    def allows(self, session_tokens: int = 0) -> bool:
+        """False once the session or the process has used up its budget."""
+        if self.session_budget and session_tokens >= self.session_budget:
+            return False
+        return not self.global_budget_per_hour or self.tokens_last_hour() < self.global_budget_per_hour
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = sorted(self._lengths, key=str)
+        return {
+            'total_tokens': self.total_tokens,
+            'tokens_last_hour': self.tokens_last_hour(),
+            'global_budget_per_hour': self.global_budget_per_hour,
+            'session_budget': self.session_budget,
+            'truncations': self.truncations,
+            'max_tokens': {f"{voice}/{kind}": self.max_tokens(voice, kind) for voice, kind in keys},
+        }
+
+
+@st.cache_resource
+def get_token_budgeter() -> TokenBudgeter:
+    """The process-wide token budgeter, shared by every session."""
+    return TokenBudgeter()
+
+
+# ======================================================================
+# 13. AGENT CLASS (LOGIC & FLOW)
+# ======================================================================
+
+@dataclass
+class AgentState:
+    """The serializable part of a BotanicalGuideAgent: enough to resume a tour in another process."""
+    voice: str | None
+    plant: str
+    plant_index: int
+    reading_step: int
+    expanded_readings: list[str]
+    reading_key: str | None = None  # Reading cache key, to complete a reading saved mid-stream
+    reading_input: str | None = None  # The input the reading answered, to regenerate parts that never arrived
+    tokens_used: int = 0  # Counted against TOKEN_BUDGET_SESSION
+
+
+class BotanicalGuideAgent:
+
+    def __init__(self, plant_data: PlantIndex, sequence: list, voice_options: list,
+                 reading_cache: ReadingCache | None = None, prefetcher: ReadingPrefetcher | None = None,
+                 streaming: bool = False, prompt_library: PromptLibrary | None = None,
+                 pregenerated: PregeneratedReadings | None = None, tracer: Tracer | None = None,
+                 intent_classifier: IntentClassifier | None = None, token_budgeter: TokenBudgeter | None = None,
+                 catalogue_search: CatalogueSearchIndex | None = None, semantic_cache: SemanticCache | None = None,
+                 catalogue_version: int = 0):
+        self.plant_data = plant_data
+        self.catalogue_version = catalogue_version  # Semantic cache answers from another catalogue are not reused
+        self.plant_sequence = sequence
+        self.voice_options = voice_options
+        self.reading_cache = reading_cache
+        self.semantic_cache = semantic_cache
+        self.prefetcher = prefetcher
+        self.prompt_library = prompt_library
+        self.pregenerated = pregenerated
+        self.tracer = tracer if tracer is not None else get_tracer()
+        self.intent_classifier = intent_classifier or IntentClassifier(sequence, voice_options, plant_data)
+        self.budgeter = token_budgeter or get_token_budgeter()
+        self.catalogue_search = catalogue_search or get_catalogue_search()
+        self.catalogue_search.sync(plant_data)
+        self.tokens_used = 0  # This session's LLM tokens (prompt + completion)
+        self._usage_lock = threading.Lock()  # Stream threads charge tokens_used too
+
+        # Streaming mode: Part 1 is returned as soon as it is complete, and the UI may set
+        # stream_handler to receive its partial text while it is being generated
+        self.streaming = streaming
+        self.stream_handler = None
+        self._stream: StreamingReading | None = None
+
+        # Held around each upstream request the agent makes off an event loop (streams, repairs, prefetches);
+        # the async agent sets it so those requests count against its AsyncLLMService limits too
+        self.upstream_slot = None
+
+        # State Tracking
+        self.current_voice = None
+        self.current_plant = sequence[0]
+        self.current_plant_index = 0
+
+        # State Tracking for reading parts
+        self.current_reading_step = 0
+        self.expanded_readings: list[str] = []
+        self._reading_key: str | None = None
+        self._reading_input: str | None = None
+
+        # Speculative reading for the next plant: (prompt cache key, future)
+        self._prefetch: tuple[str, Future] | None = None
+
+        self.REDIRECT_RESPONSES = [
+            "Interesting thought! These plants adapt in their own ways too. Let's return to {plant}.",
+            "Ha, that's a good one. Speaking of growth, {plant} has its own story…",
+            "Noted. Our tour is focused on the plants—here's more about {plant}."
+        ]
+
+    def export_state(self) -> AgentState:
+        """A snapshot of the tour state (a reading still streaming in is saved as far as it has got)."""
+        return AgentState(
+            voice=self.current_voice,
+            plant=self.current_plant,
+            plant_index=self.current_plant_index,
+            reading_step=self.current_reading_step,
+            expanded_readings=list(self.expanded_readings),
+            reading_key=self._reading_key if self.expanded_readings else None,
+            reading_input=self._reading_input if self.expanded_readings else None,
+            tokens_used=self.tokens_used,
+        )
+
+    def restore_state(self, state: AgentState) -> None:
+        """Resumes a tour saved by export_state, possibly in another process."""
+        self._cancel_prefetch()
+        self._stream = None
+        self.current_voice = state.voice if state.voice in self.voice_options else None
+
+        if state.plant in self.plant_sequence:
+            self.current_plant = state.plant
+            self.current_plant_index = self.plant_sequence.index(state.plant)
+        else:
+            # The catalogue changed since the state was saved: stay at the same position in the tour
+            self.current_plant_index = min(state.plant_index, len(self.plant_sequence) - 1)
+            self.current_plant = self.plant_sequence[self.current_plant_index]
+
+        self.current_reading_step = state.reading_step
+        self.expanded_readings = list(state.expanded_readings)
+        self._reading_key = state.reading_key
+        self._reading_input = state.reading_input
+        with self._usage_lock:
+            self.tokens_used = state.tokens_used
+
+        # Saved while the later parts were still streaming in: the shared cache has them once the stream finished
+        if (self.current_reading_step and len(self.expanded_readings) < len(READING_PART_KEYS)
+                and self._reading_key and self.reading_cache is not None):
+            cached_parts = self.reading_cache.get(self._reading_key)
+            if cached_parts and cached_parts[0] == self.expanded_readings[0]:
+                self.expanded_readings = cached_parts
+        # Parts still missing then (the stream was cut off with its worker) are regenerated on Continue
+
+    def _complete_restored_reading(self) -> None:
+        """Asks for the parts of a reading restored mid-stream that never reached any cache."""
+        plant_row = self._get_plant_row(self.current_plant, self.current_voice)
+        if plant_row is None or self._reading_input is None:
+            return
+        system_prompt = self._build_system_prompt(plant_row)
+        reading_parts = list(self.expanded_readings) + [""] * (len(READING_PART_KEYS) - len(self.expanded_readings))
+        repaired = repair_reading_parts(system_prompt, self._reading_input, reading_parts, call=self._call_llm_metered)
+        self.expanded_readings = fill_missing_parts(repaired)
+        if all(repaired) and self._reading_key is not None:
+            self._store_reading(self._reading_key, repaired)
+
+    def _build_system_prompt(self, current_plant_row: PlantRecord) -> str:
+        """Returns the static system prompt for a (plant, voice) record, precomputed when available."""
+        if self.prompt_library is not None:
+            return self.prompt_library.get(current_plant_row.plant, current_plant_row.voice)
+        return build_system_prompt(current_plant_row)
+
+    def _get_expanded_reading(self, user_input: str, use_cache: bool = True, generic: bool = False) -> tuple[str, dict]:
+        """
+        Collects data, sends the prompt, and splits the LLM's prose response
+        into three parts based on the labeled structure.
+        Parsed readings are served from / stored in the reading cache; pass
+        use_cache=False to skip the lookup for this call (the result is still stored).
+        Generic turns (navigation and voice commands, no question) are keyed and generated
+        with GENERIC_READING_INPUT, and may be served from the pre-generated readings.
+        """
+
+        with self.tracer.span("row_lookup"):
+            plant_row = self._get_plant_row(self.current_plant, self.current_voice)
+        if plant_row is None:
+            return ReadingFailure("Error: Plant data not found for the current plant and voice."), {}
+
+        # The wording of a navigation command carries nothing for the reading; key it by the canonical input
+        if generic:
+            user_input = GENERIC_READING_INPUT
+
+        # Extract fixed info for local formatting
+        fixed_info = {
+            'Latin Name': plant_row.latin_name,
+            'Region of Origin': plant_row.origin,
+            'Parts Used': plant_row.parts_used,
+            'Contraindications': plant_row.contraindications,
+        }
+
+        # 1. Fetch the static system prompt; the user's raw input is sent after it as its own message
+        with self.tracer.span("prompt_build"):
+            system_prompt = self._build_system_prompt(plant_row)
+
+        # 1a. A plain navigation turn needs no LLM call if the reading was pre-generated
+        if generic and use_cache and self.pregenerated is not None:
+            pregenerated_parts = self.pregenerated.get(plant_row.plant, plant_row.voice)
+            if pregenerated_parts:
+                self.tracer.annotate(source="pregenerated")
+                self.expanded_readings = list(pregenerated_parts)
+                self.current_reading_step = 1
+                self._schedule_prefetch()
+                return self.expanded_readings[0], fixed_info
+
+        # 1b. Serve an identical, previously parsed reading from the cache
+        cache_key = ReadingCache.make_key(system_prompt, user_input)
+        self._reading_key, self._reading_input = cache_key, user_input
+        if self.reading_cache is not None and use_cache:
+            cached_parts = self.reading_cache.get(cache_key)
+            self.tracer.annotate(cache="hit" if cached_parts else "miss")
+            if cached_parts:
+                self.tracer.annotate(source="cache")
+                self.expanded_readings = cached_parts
+                self.current_reading_step = 1
+                self._schedule_prefetch()
+                return self.expanded_readings[0], fixed_info
+
+        # 1b'. A question asked before in other words gets the reading generated for it
+        if not generic and use_cache and self.semantic_cache is not None:
+            similar_parts = self.semantic_cache.get(plant_row.plant, plant_row.voice, "reading", user_input, self.catalogue_version)
+            self.tracer.annotate(semantic_cache="hit" if similar_parts else "miss")
+            if similar_parts:
+                self.tracer.annotate(source="semantic_cache")
+                self.expanded_readings = list(similar_parts)
+                self.current_reading_step = 1
+                self._schedule_prefetch()
+                return self.expanded_readings[0], fixed_info
+
+        # 1c. Wait for a speculative prefetch of this exact prompt instead of asking again
+        prefetched_parts = self._take_prefetch(cache_key)
+        if prefetched_parts:
+            self.tracer.annotate(source="prefetch")
+            self.expanded_readings = prefetched_parts
+            self.current_reading_step = 1
+            self._schedule_prefetch()
+            return self.expanded_readings[0], fixed_info
+
+        if not self.budgeter.allows(self.tokens_used):
+            self.tracer.annotate(budget="exhausted")
+            return ReadingFailure("[TOKEN BUDGET] The guide has used up its reading allowance for now; readings already generated are still available."), fixed_info
+
+        # 2. Call the LLM to generate the structured readings (raw prose string), sized from past readings in this voice
+        self.tracer.annotate(source="llm")
+        max_tokens = self.budgeter.max_tokens(self.current_voice, "reading")
+        system_prompt += self.budgeter.length_guidance(self.current_voice, "reading")
+        semantic_key = None if generic else (plant_row.plant, plant_row.voice, "reading", user_input)
+        if self.streaming:
+            return self._get_streamed_reading(system_prompt, user_input, cache_key, max_tokens, semantic_key), fixed_info
+
+        json_output = READING_OUTPUT_FORMAT == "json"
+        with self.tracer.span("llm.call"):
+            prose_string_raw = self._call_llm(system_prompt, user_input, max_tokens, json_output)
+        self._charge(self.current_voice, "reading", prose_string_raw)
+
+        # --- ROBUST PROSE PARSING FIX ---
+        # Pick out Part 1-3 (by label, or by JSON field); continue a part cut off by max_tokens and re-ask for missing ones
+        with self.tracer.span("parse"):
+            reading_parts = complete_reading_parts(prose_string_raw, system_prompt, user_input, call=self._call_llm_metered)
+
+        # Fallback list for error cases
+        self.expanded_readings = []
+        reading_text = ""
+
+        if any(reading_parts):
+            if reading_parts[0]:
+                self.expanded_readings = fill_missing_parts(reading_parts)
+                reading_text = self.expanded_readings[0] # Part 1 content
+                self.current_reading_step = 1 # Set to start at the first reading
+                if all(reading_parts):
+                    self._store_reading(cache_key, self.expanded_readings, semantic_key)
+                self._schedule_prefetch()
+            else:
+                reading_text = ReadingFailure(f"[LLM STRUCTURE ERROR] The guide generated structure but Part 1 was empty. Raw output begins: {prose_string_raw[:200]}...")
+        else:
+            # The model failed to adhere to the Part structure, or returned an error/empty content
+            reading_text = ReadingFailure(f"[LLM STRUCTURE ERROR] The guide failed to generate the reading correctly. Raw output begins: {prose_string_raw[:200]}...")
+
+        return reading_text, fixed_info
+
+    def _charge(self, voice: str | None, kind: str | None, completion) -> None:
+        """Meters a completion against the budgets and adds its tokens to this session's total."""
+        tokens = self.budgeter.observe(voice, kind, completion)
+        with self._usage_lock:
+            self.tokens_used += tokens
+
+    def _call_llm(self, system_prompt: str, user_input: str, max_tokens: int = MAX_TOKENS, json_output: bool = False) -> str:
+        """The single place the agent asks the LLM for a reading (overridden by the async agent)."""
+        return generate_llm_response(system_prompt, user_input, max_tokens, json_output, upstream_slot=self.upstream_slot)
+
+    def _call_llm_metered(self, system_prompt: str, user_input: str, max_tokens: int = MAX_TOKENS, json_output: bool = False) -> str:
+        """_call_llm for follow-up calls (continuations, repairs): charged to the budgets, lengths not learned."""
+        completion = self._call_llm(system_prompt, user_input, max_tokens, json_output)
+        self._charge(self.current_voice, None, completion)
+        return completion
+
+    def _store_reading(self, cache_key: str, parts: list[str], semantic_key: tuple | None = None) -> None:
+        """Caches a complete reading by its exact prompt and, for a question, by the question's meaning."""
+        if self.reading_cache is not None:
+            self.reading_cache.put(cache_key, parts)
+        if self.semantic_cache is not None and semantic_key is not None:
+            self.semantic_cache.put(*semantic_key, parts, version=self.catalogue_version)
+
+    def _get_streamed_reading(self, system_prompt: str, user_input: str, cache_key: str, max_tokens: int = MAX_TOKENS,
+                              semantic_key: tuple | None = None) -> str:
+        """Streams the reading and returns Part 1 once complete; Parts 2-3 keep arriving in the background."""
+
+        voice = self.current_voice
+
+        def store_reading(reading: StreamingReading) -> None:
+            self._charge(voice, "reading", reading)
+            if reading.error is None and len(reading.parts) >= 3 and MISSING_PART_TEXT not in reading.parts:
+                self._store_reading(cache_key, reading.parts[:3], semantic_key)
+
+        self._stream = StreamingReading(system_prompt, user_input, on_complete=store_reading, max_tokens=max_tokens,
+                                        call=self._call_llm_metered, upstream_slot=self.upstream_slot).start()
+        self.expanded_readings = self._stream.parts
+
+        with self.tracer.span("llm.stream_part1"):
+            part_one = self._stream.wait_for_part(0, on_progress=self.stream_handler)
+        if part_one:
+            self.current_reading_step = 1
+            self._schedule_prefetch()
+            return part_one
+
+        prose_string_raw = self._stream.parser.raw
+        self.expanded_readings = []
+        if self._stream.error is not None:
+            return ReadingFailure(self._stream.error)
+        if part_one is not None:
+            return ReadingFailure(f"[LLM STRUCTURE ERROR] The guide generated structure but Part 1 was empty. Raw output begins: {prose_string_raw[:200]}...")
+        return ReadingFailure(f"[LLM STRUCTURE ERROR] The guide failed to generate the reading correctly. Raw output begins: {prose_string_raw[:200]}...")
+
+    def _stream_pending(self) -> bool:
+        """True while the current reading's later parts are still being streamed in."""
+        return (
+            self._stream is not None
+            and self._stream.parts is self.expanded_readings
+            and not self._stream.done
+        )
+
+    def _get_plant_row(self, plant: str, voice: str) -> PlantRecord | None:
+        """Returns the record for a (plant, voice) pair, or None if it is missing."""
+        return self.plant_data.get(plant, voice)
+
+    def _schedule_prefetch(self) -> None:
+        """
+        Starts generating the next plant's reading in the current voice in the background. With a
+        reading cache, the plants after it are generated too, READING_BATCH_SIZE per LLM call, into
+        the cache; the next plant keeps its own call, so waiting for it never waits for a batch.
+        """
+        if self.prefetcher is None or self.current_plant_index >= len(self.plant_sequence) - 1:
+            return
+
+        next_plant = self.plant_sequence[self.current_plant_index + 1]
+        next_row = self._get_plant_row(next_plant, self.current_voice)
+        if next_row is None:
+            return
+
+        system_prompt = self._build_system_prompt(next_row)
+        key = ReadingCache.make_key(system_prompt, GENERIC_READING_INPUT)
+        if self._prefetch is not None and self._prefetch[0] == key:
+            return
+
+        self._cancel_prefetch()
+        if self.reading_cache is not None and self.reading_cache.contains(key):
+            return  # Already cached, nothing to generate
+
+        joined = key in self.prefetcher  # e.g. a batch that the plants after this one are part of
+        future = self.prefetcher.submit(key, lambda: fetch_reading_parts(system_prompt, GENERIC_READING_INPUT, self.reading_cache,
+                                                                         next_row.voice, self.upstream_slot))
+        self.tracer.annotate(prefetch="scheduled" if future is not None else "deprioritized")
+        if future is not None:
+            self._prefetch = (key, future)
+            if not joined:
+                self._schedule_batch_prefetch()
+
+    def _schedule_batch_prefetch(self) -> None:
+        """
+        Generates the readings after the next plant in one batched call, into the reading cache,
+        when a prefetch worker is idle (a batch never queues ahead of next-plant prefetches).
+        The job is shared under the first reading's key, so a later prefetch of that plant joins it.
+        """
+        if self.reading_cache is None or READING_BATCH_SIZE < 2:
+            return
+
+        batch = []
+        for plant in self.plant_sequence[self.current_plant_index + 2:self.current_plant_index + 2 + READING_BATCH_SIZE]:
+            row = self._get_plant_row(plant, self.current_voice)
+            if row is None or self.reading_cache.contains(ReadingCache.make_key(self._build_system_prompt(row), GENERIC_READING_INPUT)):
+                break
+            batch.append(row)
+        if not batch:
+            return
+
+        key = ReadingCache.make_key(self._build_system_prompt(batch[0]), GENERIC_READING_INPUT)
+        future = self.prefetcher.submit(key, lambda: fetch_reading_batch(batch, GENERIC_READING_INPUT, self.reading_cache, self.prompt_library,
+                                                                         upstream_slot=self.upstream_slot)[0],
+                                        spare_only=True)
+        # Not released: nobody waits on it, but it must not be cancelled while queued
+        self.tracer.annotate(prefetch_batch=len(batch) if future is not None else "deprioritized")
+
+    def _take_prefetch(self, cache_key: str) -> list[str] | None:
+        """Returns the prefetched parts for cache_key (waiting if still generating), else None."""
+        if self._prefetch is None or self._prefetch[0] != cache_key:
+            return None
+
+        key, future = self._prefetch
+        self._prefetch = None
+        try:
+            self.tracer.annotate(prefetch="ready" if future.done() else "waited")
+            return future.result()
+        except Exception as e:
+            # Cancelled or failed in the background: the caller generates the reading itself
+            print(f"[PREFETCH MISS] {type(e).__name__} - {e}")
+            return None
+        finally:
+            self.prefetcher.release(key)
+
+    def _cancel_prefetch(self) -> None:
+        """Abandons the pending prefetch (e.g. after a voice switch or a jump by name)."""
+        if self._prefetch is not None:
+            self.prefetcher.release(self._prefetch[0])
+            self._prefetch = None
+
+    def _get_next_reading_part(self) -> str:
+        """Retrieves and increments the reading part counter."""
+
+        # A streamed reading may still be generating this part
+        if self._stream_pending():
+            self._stream.wait_for_part(self.current_reading_step)
+        elif self._stream is None and 0 < len(self.expanded_readings) < len(READING_PART_KEYS):
+            self._complete_restored_reading()  # Saved mid-stream by another worker
+
+        if self.current_reading_step < len(self.expanded_readings):
+            next_part_content = self.expanded_readings[self.current_reading_step]
+            self.current_reading_step += 1
+            return next_part_content
+        else:
+            # All parts have been read
+            self.current_reading_step = 0 # Reset state
+            self.expanded_readings = []
+            return f"That concludes the full reading on **{self.current_plant.capitalize()}**. **Ready for the next plant?**"
+
+
+    def _generate_reading(self, user_input: str, use_cache: bool = True, generic: bool = False) -> str:
+        """Calls the LLM data fetcher and formats the first part of the reading."""
+
+        narrative, fixed_info = self._get_expanded_reading(user_input, use_cache=use_cache, generic=generic)
+
+        # Build the formatted response with fixed info
+        response = ""
+        response += f"***\n"
+        response += f"**Latin Name:** {fixed_info.get('Latin Name', 'N/A')} | "
+        response += f"**Region:** {fixed_info.get('Region of Origin', 'N/A')} | "
+        response += f"**Parts Used:** {fixed_info.get('Parts Used', 'N/A')}\n"
+        response += f"***\n\n"
+
+        # Check if an error occurred during expansion (LLM, stream, structure or budget)
+        if isinstance(narrative, ReadingFailure):
+            response += narrative
+            response += "\n\n**Please try another command or quit.**"
+            return response
+
+        # If successful, format the first part
+        response += f"**[Expanded Reading Part 1/3 - {self.current_voice.upper()} Persona]**\n"
+        response += narrative
+
+        # We now ask for the NEXT reading.
+        if len(self.expanded_readings) > 1 or self._stream_pending():
+            response += "\n\n**Continue reading this plant's story?**"
+        else:
+            response += "\n\n**Ready for the next plant?**"
+
+        return response
+
+    # --- VOICE SELECTION ---
+    def _handle_select_voice(self, user_input: str, new_voice: str | None = None) -> str:
+        """Sets the voice, resets step counter, and then performs a reading."""
+
+        if new_voice is None:
+            intent = self.intent_classifier.classify(user_input)
+            new_voice = intent.value if intent.kind == 'select_voice' else None
+
+        if not new_voice:
+            # Since the LLM handles interpretation, any non-voice command is treated as a redirect/question
+            return self._handle_redirect(user_input)
+
+        # Reset reading state whenever voice or plant changes
+        self.current_reading_step = 0
+        self.expanded_readings = []
+
+        # The LLM prompt is now responsible for incorporating the user's conversational intent
+
+        # The predicted next reading was for the old voice
+        if new_voice != self.current_voice:
+            self._cancel_prefetch()
+
+        if self.current_voice is None:
+            self.current_voice = new_voice
+            return f"Great choice! I'm excited to share our garden with you from the perspective of a **{new_voice}** herbalist. Let's begin with **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input, generic=True)
+
+        elif new_voice != self.current_voice:
+            self.current_voice = new_voice
+            return f"Voice switched to **{new_voice.upper()}** persona. Here is the expanded note on **{self.current_plant.capitalize()}**:\n\n" + self._generate_reading(user_input, generic=True)
+
+        else:
+            # If same voice is selected, regenerate the reading for the current plant (or continue if reading is active)
+            if self.current_reading_step == 0:
+                return f"The voice is already set to **{self.current_voice}**. Let's start the reading on **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input, generic=True)
+            else:
+                return self._handle_continue_reading(user_input)
+
+
+    # --- NAVIGATION ---
+    def _move_to_plant(self, plant: str) -> None:
+        """Makes `plant` the current plant and clears the reading state."""
+        # Reset reading state when switching to a named plant
+        self.current_reading_step = 0
+        self.expanded_readings = []
+        if plant != self.current_plant:
+            self._cancel_prefetch()
+
+        self.current_plant = plant
+        self.current_plant_index = self.plant_sequence.index(plant)
+
+    def _handle_plant_navigation(self, user_input: str, intent: Intent | None = None) -> str:
+        """Handles 'next plant', 'previous plant' or 'plant by name', and then performs a reading."""
+
+        if self.current_voice is None:
+            return f"Please select your preferred herbalist persona: {', '.join(self.voice_options)}."
+
+        intent = intent or self.intent_classifier.classify(user_input)
+
+        # 1. Check for 'next reading' command
+        if self.current_reading_step > 0 and intent.kind == 'continue':
+            return self._handle_continue_reading(user_input)
+
+        # 2. Check for 'next plant'
+        if intent.kind == 'next_plant':
+            if self.current_plant_index == len(self.plant_sequence) - 1:
+                return f"We've completed the tour of all {len(self.plant_sequence)} plants. Please select a plant by name if you wish to re-visit one."
+
+            # Reset reading state when moving to a new plant
+            self.current_reading_step = 0
+            self.expanded_readings = []
+
+            self.current_plant_index = (self.current_plant_index + 1) % len(self.plant_sequence)
+            self.current_plant = self.plant_sequence[self.current_plant_index]
+
+            return f"Moving to the next plant, **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input, generic=True)
+
+        # 3. Check for 'previous plant'
+        if intent.kind == 'previous_plant':
+            if self.current_plant_index == 0:
+                return f"**{self.current_plant.capitalize()}** is the first plant of the tour. Say 'next plant' to move on, or name a plant to visit it."
+            self._move_to_plant(self.plant_sequence[self.current_plant_index - 1])
+            return f"Going back to **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input, generic=True)
+
+        # 4. Check for 'plant by name'
+        if intent.kind == 'goto_plant':
+            self._move_to_plant(intent.value)
+            return f"Switching focus to **{self.current_plant.capitalize()}**.\n\n" + self._generate_reading(user_input, generic=True)
+
+        # If input was not a recognized command, it's a redirect.
+        return self._handle_redirect(user_input)
+
+
+    def _handle_continue_reading(self, user_input: str) -> str:
+        """Retrieves and formats the next part of the expanded reading."""
+
+        # If no reading is active, assume the user is asking a general question about the current plant
+        if not self.expanded_readings or self.current_reading_step == 0:
+            return self._generate_reading(user_input, generic=True)
+
+        # Retrieve the next part of the story
+        next_reading = self._get_next_reading_part()
+
+        if self.current_reading_step == 0:
+            return next_reading # Returns the "That concludes the full reading..." message
+
+        response = f"**[Expanded Reading Part {self.current_reading_step}/3 - {self.current_voice.upper()} Persona]**\n"
+        response += next_reading
+
+        if self.current_reading_step < 3:
+            response += "\n\n**Continue reading this plant's story?**"
+        else:
+            response += "\n\nThat concludes the full reading on this plant. **Ready for the next plant?**"
+            self.current_reading_step = 0
+            self.expanded_readings = []
+
+        return response
+
+    def _handle_redirect(self, user_input: str) -> str:
+        """
+        Handles inputs that are not clear navigation or voice commands.
+        Triggers a new reading but allows the LLM to interpret the user's question first.
+        """
+        if self.current_voice is None:
+            return f"Welcome! Please select your preferred herbalist persona: {', '.join(self.voice_options)}."
+
+        # Questions about the whole garden are answered from the catalogue index, not a single-plant reading
+        if is_catalogue_question(user_input):
+            return self._answer_from_catalogue(user_input)
+
+        # Mid-reading, answer briefly from what has been generated and keep the reading where it is
+        if self.current_reading_step > 0 and self.expanded_readings:
+            return self._answer_question(user_input)
+
+        # Any conversational input that isn't a direct command is treated as a question about the current plant.
+        # This forces the LLM to process it (e.g., "what's the weather") and redirect, then deliver the script.
+        return self._generate_reading(user_input)
+
+    def _answer_question(self, user_input: str) -> str:
+        """Short answer grounded in the plant's DATA and the parts already shown; the reading then resumes."""
+
+        plant_row = self._get_plant_row(self.current_plant, self.current_voice)
+        if plant_row is None:
+            return "Error: Plant data not found for the current plant and voice."
+
+        # Only the parts the visitor has heard, so the answer never gets ahead of the reading
+        shown_parts = self.expanded_readings[:self.current_reading_step]
+        system_prompt = build_short_answer_prompt(plant_row, shown_parts)
+
+        # Answers are reused for paraphrases at the same point of the same reading
+        semantic_kind = f"answer@{self.current_reading_step}"
+        cache_key = ReadingCache.make_key(system_prompt, user_input)
+        cached = self.reading_cache.get(cache_key) if self.reading_cache is not None else None
+        similar = None
+        if not cached and self.semantic_cache is not None:
+            similar = self.semantic_cache.get(plant_row.plant, plant_row.voice, semantic_kind, user_input, self.catalogue_version)
+            self.tracer.annotate(semantic_cache="hit" if similar else "miss")
+        if cached:
+            self.tracer.annotate(source="cache")
+            answer = cached[0]
+        elif similar:
+            self.tracer.annotate(source="semantic_cache")
+            answer = similar
+        elif not self.budgeter.allows(self.tokens_used):
+            self.tracer.annotate(budget="exhausted")
+            answer = "[TOKEN BUDGET] I can't answer new questions right now, but the reading itself is ready."
+        else:
+            self.tracer.annotate(source="llm")
+            max_tokens = self.budgeter.max_tokens(self.current_voice, "answer", SHORT_ANSWER_MAX_TOKENS)
+            with self.tracer.span("llm.short_answer"):
+                completion = self._call_llm(system_prompt + self.budgeter.length_guidance(self.current_voice, "answer"),
+                                            user_input, max_tokens)
+            self._charge(self.current_voice, "answer", completion)
+            answer = completion.strip()
+            if getattr(completion, 'finish_reason', None) is None or not answer:
+                # An error message, not an answer: shown as one and never cached; the reading stays where it was
+                return f"{answer or '[EMPTY CONTENT ERROR] The guide returned no answer.'}\n\n**Please try another command or quit.**"
+            if self.reading_cache is not None:
+                self.reading_cache.put(cache_key, [answer])
+            if self.semantic_cache is not None:
+                self.semantic_cache.put(plant_row.plant, plant_row.voice, semantic_kind, user_input, answer,
+                                        self.catalogue_version)
+
+        return answer + "\n\n**Continue reading this plant's story?**"
+
+
+    def _answer_from_catalogue(self, user_input: str) -> str:
+        """
+        Answers a cross-plant question by searching the catalogue locally; only questions that
+        need explaining ("how", "why", "compare") go to the LLM, with just the top matching rows.
+        A search that finds nothing is reported as such, never as the plants lacking something.
+        """
+        with self.tracer.span("catalogue.search"):
+            terms = catalogue_terms(user_input)
+            safety = any(term in CATALOGUE_SAFETY_WORDS for term in terms)
+            narrate = any(term in CATALOGUE_NARRATION_WORDS for term in terms)
+            query = [term for term in terms if term not in CATALOGUE_SAFETY_WORDS
+                     and term not in CATALOGUE_NARRATION_WORDS and term not in CATALOGUE_VAGUE_WORDS]
+            matches = self.catalogue_search.search(query, ("Contraindications",) if safety else None) if query else []
+            # A weak match on one common word is not an answer
+            matches = [match for match in matches if match.score >= CATALOGUE_MIN_SCORE]
+        self.tracer.annotate(source="catalogue", catalogue_matches=len(matches))
+
+        if self.current_reading_step > 0 and self.expanded_readings:
+            follow_up = "\n\n**Continue reading this plant's story?**"
+        else:
+            follow_up = f"\n\n**Shall we continue with {self.current_plant.capitalize()}?**"
+        topic = " ".join(query)
+
+        if narrate and matches and self.budgeter.allows(self.tokens_used):
+            rows = [row for row in (self._get_plant_row(match.plant, self.current_voice)
+                                    for match in matches[:CATALOGUE_NARRATION_ROWS]) if row is not None]
+            system_prompt = build_catalogue_answer_prompt(rows, self.current_voice)
+            cache_key = ReadingCache.make_key(system_prompt, user_input)
+            cached = self.reading_cache.get(cache_key) if self.reading_cache is not None else None
+            if cached:
+                return cached[0] + follow_up
+
+            max_tokens = self.budgeter.max_tokens(self.current_voice, "catalogue", SHORT_ANSWER_MAX_TOKENS)
+            with self.tracer.span("llm.catalogue_answer"):
+                completion = self._call_llm(system_prompt + self.budgeter.length_guidance(self.current_voice, "catalogue"),
+                                            user_input, max_tokens)
+            self._charge(self.current_voice, "catalogue", completion)
+            if getattr(completion, 'finish_reason', None) is not None:
+                answer = completion.strip()
+                if self.reading_cache is not None:
+                    self.reading_cache.put(cache_key, [answer])
+                return answer + follow_up
+            # The LLM failed: fall back to the local answer below
+
+        if safety:
+            # Without a caution naming the topic, show every listed caution rather than implying the plants are safe
+            listed = matches or [
+                CatalogueMatch(plant, 0.0, "Contraindications", text) for plant in self.catalogue_search.plants
+                if (text := self.catalogue_search.field_text(plant, "Contraindications"))
+            ]
+            lines = [f"- **{match.plant.capitalize()}**: {match.text}" for match in listed]
+            others = [plant.capitalize() for plant in self.catalogue_search.plants if plant not in {match.plant for match in listed}]
+            if matches:
+                answer = (f"These plants list a caution about **{topic}**:\n" + "\n".join(lines)
+                          + (f"\n\nI couldn't find a caution about it for {', '.join(others)}, "
+                             f"but that does not mean they are safe for it." if others else ""))
+            elif query:
+                answer = (f"I couldn't find a caution that mentions **{topic}** in our catalogue, which does not "
+                          f"mean these plants are safe for it. These are the cautions our plants list:\n" + "\n".join(lines))
+            else:
+                answer = "These plants list a caution:\n" + "\n".join(lines)
+            return answer + "\n\nThis is not medical advice; please check with a healthcare professional." + follow_up
+
+        if not matches:
+            about = f" about **{topic}**" if topic else " for that"
+            return (f"I couldn't find anything{about} in our catalogue notes. "
+                    f"Ask me about one of the plants by name and I can tell you more." + follow_up)
+        matches = [match for match in matches if match.matched_terms == matches[0].matched_terms]
+        lines = [f"- **{match.plant.capitalize()}** ({match.field}): {match.text}" for match in matches]
+        return f"Plants in our garden that mention **{topic}**:\n" + "\n".join(lines) + follow_up
+
+    def respond(self, user_input: str) -> str:
+        """The main interaction method that executes the logic."""
+        with self.tracer.span("respond"):
+            return self._route_input(user_input)
+
+    def _route_input(self, user_input: str) -> str:
+        """Routes the input to the voice, continue, navigation or redirect handler."""
+        intent = self.intent_classifier.classify(user_input)
+        self.tracer.annotate(intent=intent.kind, intent_confidence=intent.confidence, intent_ambiguous=intent.ambiguous)
+
+        # 0. Initial Greeting / Persona Selection Prompt
+        if self.current_voice is None:
+            if intent.kind == 'select_voice':
+                return self._handle_select_voice(user_input, intent.value)
+            return f"Welcome! Please select your preferred herbalist persona: {', '.join(self.voice_options)}."
+
+        # A plant or voice merely mentioned inside a real question ("is there evidence it helps sleep?")
+        # is not a command: the question goes to the LLM. Another plant named that way is not a reason
+        # to leave this one (and pay for its reading), so the visitor is asked which they meant.
+        if intent.confidence < INTENT_MIN_CONFIDENCE or intent.ambiguous:
+            if intent.kind == 'goto_plant' and intent.value != self.current_plant:
+                return (f"Did you want to visit **{intent.value.capitalize()}**? Say \"{intent.value}\" to go there; "
+                        f"otherwise we'll stay with **{self.current_plant.capitalize()}**.")
+            return self._handle_redirect(user_input)
+
+        # 1. COMMAND: Continue Reading (High Priority); "yes" answers whichever question the guide last asked,
+        # and a bare "next" during a reading means its next part
+        if intent.kind == 'continue' or (intent.kind == 'affirm' and self.current_reading_step > 0):
+            return self._handle_continue_reading(user_input)
+        if intent.kind == 'next_plant' and self.current_reading_step > 0 and normalize_text(user_input) == 'next':
+            return self._handle_continue_reading(user_input)
+
+        # 2. COMMAND: Change Voice
+        if intent.kind == 'select_voice':
+            return self._handle_select_voice(user_input, intent.value)
+
+        # 3. COMMAND: Next Plant or Plant by Name
+        if intent.kind == 'affirm':
+            intent = Intent('next_plant', confidence=intent.confidence)
+        if intent.kind in ('next_plant', 'previous_plant', 'goto_plant'):
+            return self._handle_plant_navigation(user_input, intent)
+
+        # 4. Handle all other inputs (Redirect/Vague Question)
+        # This now routes ALL conversational inputs back to _generate_reading
+        # via _handle_redirect, allowing the LLM prompt to manage the guardrail and content delivery.
+        return self._handle_redirect(user_input)
+
+# ======================================================================
+# 14. PRE-GENERATED READINGS (OFFLINE BATCH)
+# ======================================================================
+
+def pregenerated_artifact_header() -> dict:
+    """First line of the artifact; readings made with other settings are never mixed into it."""
+    return {'type': 'header', 'format_version': PREGENERATED_FORMAT_VERSION, 'model': MODEL_ID, 'temperature': TEMPERATURE}
+
+
+class PregeneratedReadings:
+    """
+    Readings materialized by `python app.py pregenerate`, keyed by (plant, voice).
+    Each record carries the cache key of the prompt it was generated from, so entries
+    made before a catalogue or prompt change are ignored rather than served stale.
+    """
+
+    def __init__(self, path: str, prompt_library: PromptLibrary):
+        self.path = path
+        self.header = None
+        self._parts: dict[tuple[str, str], list[str]] = {}
+
+        if not os.path.exists(path):
+            return
+
+        with open(path, encoding="utf-8") as artifact:
+            for line in artifact:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut off by an interrupted run
+
+                if record.get('type') == 'header':
+                    self.header = record
+                elif record.get('type') == 'reading':
+                    system_prompt = prompt_library.get(record['plant'], record['voice'])
+                    if system_prompt is not None and record['prompt_key'] == ReadingCache.make_key(system_prompt, GENERIC_READING_INPUT):
+                        self._parts[(record['plant'], record['voice'])] = record['parts']
+
+        if self.header != pregenerated_artifact_header():
+            print(f"[PREGENERATED] Ignoring {path}: it was generated with different settings ({self.header}).")
+            self._parts = {}
+
+    def get(self, plant: str, voice: str) -> list[str] | None:
+        return self._parts.get((plant, voice))
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._parts
+
+    def __len__(self) -> int:
+        return len(self._parts)
+
+
+def run_pregeneration(path: str = PREGENERATED_READINGS_PATH, workers: int = 4, retries: int = 3,
+                      fresh: bool = False, batch_size: int = READING_BATCH_SIZE) -> dict:
+    """
+    Generates the generic three-part reading for every (plant, voice) in the catalogue,
+    in parallel, appending each to the JSONL artifact as soon as it is ready. Readings of one
+    voice are requested batch_size at a time in a single LLM call; any that fail are then
+    generated alone, with retries. Re-running resumes: combinations already in the artifact are skipped.
+    """
+
+    plant_data = get_plant_data()
+    prompt_library = PromptLibrary(plant_data)
+
+    if fresh or not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as artifact:
+            artifact.write(json.dumps(pregenerated_artifact_header()) + "\n")
+        existing = None
+    else:
+        existing = PregeneratedReadings(path, prompt_library)
+        if existing.header != pregenerated_artifact_header():
+            print(f"[PREGENERATED] {path} was generated with different settings; re-run with --fresh to replace it.")
+            return {}
+
+        # Terminate a line cut off by an interrupted run, so new records start on their own line
+        with open(path, "rb+") as artifact:
+            if artifact.seek(0, os.SEEK_END) > 0:
+                artifact.seek(-1, os.SEEK_END)
+                if artifact.read(1) != b"\n":
+                    artifact.write(b"\n")
+
+    todo = [record for record in plant_data if existing is None or (record.plant, record.voice) not in existing]
+    print(f"[PREGENERATED] {len(plant_data) - len(todo)} readings already complete, {len(todo)} to generate.")
+
+    write_lock = threading.Lock()
+    started = time.perf_counter()
+
+    def write(record: PlantRecord, parts: list[str]) -> None:
+        line = json.dumps({
+            'type': 'reading', 'plant': record.plant, 'voice': record.voice,
+            'prompt_key': ReadingCache.make_key(prompt_library.get(record.plant, record.voice), GENERIC_READING_INPUT),
+            'parts': parts, 'generated_at': time.time(),
+        })
+        with write_lock, open(path, "a", encoding="utf-8") as artifact:
+            artifact.write(line + "\n")
+
+    def generate(record: PlantRecord) -> bool:
+        system_prompt = prompt_library.get(record.plant, record.voice)
+        for attempt in range(retries + 1):
+            parts = fetch_reading_parts(system_prompt, GENERIC_READING_INPUT, voice=record.voice)
+            if parts:
+                write(record, parts)
+                return True
+            if attempt < retries:
+                time.sleep(min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5))  # Jittered backoff
+
+        print(f"[PREGENERATED] Giving up on ({record.plant}, {record.voice}) after {retries + 1} attempts.")
+        return False
+
+    def generate_batch(records: list[PlantRecord]) -> list[bool]:
+        results = fetch_reading_batch(records, GENERIC_READING_INPUT, prompt_library=prompt_library, fallback=False)
+        for record, parts in zip(records, results):
+            if parts:
+                write(record, parts)
+        return [True if parts else generate(record) for record, parts in zip(records, results)]
+
+    # Batches never mix voices, so each call keeps to one persona
+    batches: list[list[PlantRecord]] = []
+    for record in sorted(todo, key=lambda record: record.voice):
+        if batches and batches[-1][0].voice == record.voice and len(batches[-1]) < batch_size:
+            batches[-1].append(record)
+        else:
+            batches.append([record])
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pregenerate") as pool:
+        results = [result for batch_results in pool.map(generate_batch, batches) for result in batch_results]
+
+    elapsed = time.perf_counter() - started
+    report = {
+        'generated': sum(results),
+        'failed': len(results) - sum(results),
+        'skipped': len(plant_data) - len(todo),
+        'elapsed_s': round(elapsed, 2),
+        'readings_per_minute': round(sum(results) / elapsed * 60, 2) if elapsed else 0.0,
+    }
+    print(f"[PREGENERATED] {json.dumps(report)}")
+    return report
+
+
+# ======================================================================
+# 15. ASYNC AGENT (COALESCED, RATE-LIMITED GENERATION)
+# ======================================================================
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight task whose result all callers share."""
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, coroutine_factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, k=key: self._forget(k, done))
+        else:
+            self.coalesced += 1
+
+        # Shielded, so one caller giving up does not cancel the generation for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+
+class AsyncRateLimiter:
+    """Caps concurrent upstream calls and spaces their starts to a requests-per-minute budget."""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, requests_per_minute: int = LLM_REQUESTS_PER_MINUTE):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_start = 0.0
+        self._schedule_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        try:
+            if self._interval:
+                async with self._schedule_lock:
+                    now = asyncio.get_running_loop().time()
+                    start = max(now, self._next_start)
+                    self._next_start = start + self._interval
+                if start > now:
+                    await asyncio.sleep(start - now)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+
+class AsyncLLMService:
+    """Process-wide async gateway to the LLM: single-flight deduplication in front of a rate limiter."""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+                 turn_workers: int = ASYNC_TURN_WORKERS):
+        self.single_flight = SingleFlight()
+        self.limiter = AsyncRateLimiter(max_concurrency, requests_per_minute)
+        self.upstream_calls = 0
+
+        # Agent turns block while waiting for the loop, so they must never run on the loop's
+        # default executor: asyncio resolves DNS there, and a saturated pool would deadlock
+        self.turn_executor = ThreadPoolExecutor(max_workers=turn_workers, thread_name_prefix="agent-turn")
+
+    async def generate(self, system_prompt: str, user_input: str, max_tokens: int = MAX_TOKENS, json_output: bool = False) -> str:
+        key = f"{ReadingCache.make_key(system_prompt, user_input)}:{max_tokens}:{json_output}"
+        return await self.single_flight.do(key, lambda: self._generate(system_prompt, user_input, max_tokens, json_output))
+
+    async def _generate(self, system_prompt: str, user_input: str, max_tokens: int = MAX_TOKENS, json_output: bool = False) -> str:
+        return await generate_llm_response_async(system_prompt, user_input, max_tokens, json_output,
+                                                 upstream_slot=self.upstream_slot)
+
+    @asynccontextmanager
+    async def upstream_slot(self):
+        """
+        Held around each upstream request, so every attempt, retry and hedge is metered
+        and no slot is held while a call backs off between attempts.
+        """
+        async with self.limiter:
+            self.upstream_calls += 1
+            yield
+
+    @contextmanager
+    def blocking_slot(self, loop: asyncio.AbstractEventLoop):
+        """
+        upstream_slot for synchronous requests on another thread (streamed readings, prefetch
+        jobs): blocks that thread until `loop`, which runs this service, grants a slot.
+        """
+        slot = self.upstream_slot()
+        asyncio.run_coroutine_threadsafe(slot.__aenter__(), loop).result()
+        try:
+            yield
+        finally:
+            asyncio.run_coroutine_threadsafe(slot.__aexit__(None, None, None), loop).result()
+
+
+class AsyncBotanicalGuideAgent(BotanicalGuideAgent):
+    """
+    asyncio front-end to the agent. Routing runs through the regular (synchronous) handlers
+    on a worker thread so the event loop never blocks, while every LLM call is awaited on
+    the loop through the shared AsyncLLMService: identical in-flight generations from many
+    visitors share one upstream request, and upstream concurrency and rate stay capped.
+    Requests that run on other threads (an API turn's streamed reading, prefetch jobs) wait
+    for a slot of the same service before going upstream.
+    """
+
+    def __init__(self, *args, llm_service: AsyncLLMService, **kwargs):
+        kwargs['streaming'] = False  # Parts are delivered whole; live rendering is a UI concern
+        super().__init__(*args, **kwargs)
+        self.llm_service = llm_service
+        self._loop = None
+        self._turn_lock = asyncio.Lock()  # One turn at a time per visitor
+
+    async def respond_async(self, user_input: str) -> str:
+        return await self._run_turn(self.respond, user_input)
+
+    async def _generate_reading_async(self, user_input: str, use_cache: bool = True) -> str:
+        return await self._run_turn(self._generate_reading, user_input, use_cache)
+
+    async def _run_turn(self, handler, *args):
+        async with self._turn_lock:
+            self._loop = asyncio.get_running_loop()
+            # Requests made off the loop (a streamed reading, prefetches) outlive the turn; they share the service's limits
+            self.upstream_slot = functools.partial(self.llm_service.blocking_slot, self._loop)
+            try:
+                return await self._loop.run_in_executor(self.llm_service.turn_executor, handler, *args)
+            finally:
+                self._loop = None
+
+    def _call_llm(self, system_prompt: str, user_input: str, max_tokens: int = MAX_TOKENS, json_output: bool = False) -> str:
+        # Called on the worker thread: hand the request to the event loop and wait for it
+        if self._loop is None:
+            return super()._call_llm(system_prompt, user_input, max_tokens, json_output)
+        future = asyncio.run_coroutine_threadsafe(self.llm_service.generate(system_prompt, user_input, max_tokens, json_output), self._loop)
+        return future.result()
+
+
+# ======================================================================
+# 16. LLM CLIENT (SHARED CONNECTION POOL)
+# ======================================================================
+
+class LLMClientManager:
+    """
+    Owns the process-wide OpenAI client and its pooled httpx transport, so TLS
+    connections to the provider are kept alive and reused across every session.
+    The OpenAI/httpx clients are thread-safe; the lock only guards (re)configuration.
+    """
+
+    def __init__(self, max_connections: int = LLM_POOL_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = LLM_POOL_MAX_KEEPALIVE,
+                 keepalive_expiry: float = LLM_POOL_KEEPALIVE_EXPIRY_SECONDS):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._lock = threading.Lock()
+        self._client = None
+        self._settings = None
+        # httpx async pools are bound to an event loop, so async clients are kept per loop
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _http_client_options(self, is_async: bool = False) -> dict:
+        import httpx # Required for custom timeout and pool configuration
+
+        return {
+            'timeout': httpx.Timeout(LLM_REQUEST_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+            'limits': httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            # HTTP/2 multiplexes concurrent requests over one connection when the h2 package is installed
+            'http2': importlib.util.find_spec("h2") is not None,
+            'event_hooks': http_trace_hooks(is_async),
+        }
+
+    def configure(self, api_key: str, base_url: str = OPENROUTER_BASE_URL) -> None:
+        """Builds the client on first use; later calls with the same settings are no-ops."""
+        with self._lock:
+            if self._settings == (api_key, base_url):
+                return
+
+            from openai import OpenAI
+            import httpx
+
+            # A replaced client is left to in-flight requests and garbage collection rather than closed under them
+            # Retries are handled by ResilientLLM (with fallback and breakers), not by the SDK
+            self._client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0,
+                                  http_client=httpx.Client(**self._http_client_options()))
+            self._async_clients.clear()
+            self._settings = (api_key, base_url)
+
+    def get(self) -> OpenAI:
+        if self._client is None:
+            raise RuntimeError("LLM client is not configured; call configure() with an API key first.")
+        return self._client
+
+    def get_async(self) -> AsyncOpenAI:
+        """The async client for the running event loop, sharing this manager's settings and pool limits."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._settings is None:
+                raise RuntimeError("LLM client is not configured; call configure() with an API key first.")
+
+            async_client = self._async_clients.get(loop)
+            if async_client is None:
+                from openai import AsyncOpenAI
+                import httpx
+
+                api_key, base_url = self._settings
+                async_client = AsyncOpenAI(
+                    base_url=base_url, api_key=api_key, max_retries=0,
+                    http_client=httpx.AsyncClient(**self._http_client_options(is_async=True))
+                )
+                self._async_clients[loop] = async_client
+            return async_client
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = None
+            self._settings = None
+            self._async_clients.clear()
+
+
+@st.cache_resource
+def get_client_manager() -> LLMClientManager:
+    """The single client manager of this process, shared by all sessions and script reruns."""
+    return LLMClientManager()
+
+
+# ======================================================================
+# 17. RESILIENT LLM CALLS (RETRIES, CIRCUIT BREAKERS, FALLBACK, HEDGING)
+# ======================================================================
+
+T = TypeVar("T")
+
+LLMFailureKind = Literal['retry', 'next_model', 'fatal']
+
+
+class CircuitBreaker:
+    """
+    Per-model breaker: opens after `failure_threshold` consecutive failures so calls skip
+    straight to the next model, then lets a single probe through once `cooldown_seconds` pass.
+    """
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD,
+                 cooldown_seconds: float = LLM_BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self) -> None:
+        """Ends an attempt that neither succeeded nor failed (cancelled, interrupted), so a later call may probe."""
+        with self._lock:
+            self._probing = False
+
+
+def llm_failure_kind(error: BaseException) -> LLMFailureKind:
+    """Timeouts, connection errors, 408/409/429 and 5xx are retried; other 4xx move on to the next model."""
+    status = getattr(error, 'status_code', None)
+    if status is None or status in (408, 409, 429) or status >= 500:
+        return 'retry'
+    if status in (401, 402):
+        return 'fatal'  # The key itself is rejected: no model will do better
+    return 'next_model'
+
+
+class ResilientLLM:
+    """
+    Runs one logical LLM call as a series of upstream attempts: each model in order
+    (MODEL_ID, then LLM_FALLBACK_MODELS) is retried with jittered exponential backoff
+    unless its circuit breaker is open, within an overall deadline that also caps each
+    attempt's timeout. With a hedge percentile set, an attempt still running past that
+    percentile of the model's recent latencies gets a duplicate, and the first to finish wins.
+    """
+
+    def __init__(self, models: list[str] | None = None, max_retries: int = LLM_MAX_RETRIES,
+                 deadline_seconds: float = LLM_CALL_DEADLINE_SECONDS, attempt_timeout: float = LLM_ATTEMPT_TIMEOUT_SECONDS,
+                 hedge_percentile: float = LLM_HEDGE_PERCENTILE, hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+                 hedge_workers: int = LLM_POOL_MAX_CONNECTIONS):
+        self.models = models or [MODEL_ID] + [m for m in LLM_FALLBACK_MODELS if m != MODEL_ID]
+        self.max_retries = max_retries
+        self.deadline_seconds = deadline_seconds
+        self.attempt_timeout = attempt_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breakers = {model: CircuitBreaker() for model in self.models}
+        self._latencies: dict[str, deque[float]] = {model: deque(maxlen=LLM_HEDGE_WINDOW) for model in self.models}
+        self._latency_lock = threading.Lock()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="llm-hedge")
+
+    @staticmethod
+    def backoff_delay(attempt: int) -> float:
+        """Full jitter: uniform in [0, min(max, base * 2**attempt)]."""
+        return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    def _plan(self):
+        """(model, breaker) pairs in fallback order, and the deadline for the whole call."""
+        return [(model, self.breakers[model]) for model in self.models], time.monotonic() + self.deadline_seconds
+
+    def _timeout(self, deadline: float) -> float:
+        """An attempt's timeout: the per-attempt limit, or what is left of the call's deadline if less."""
+        return max(0.0, min(self.attempt_timeout, deadline - time.monotonic()))
+
+    def hedge_delay(self, model: str) -> float | None:
+        """Seconds after which an attempt on `model` is hedged, or None (hedging off, or too few latencies known)."""
+        if self.hedge_percentile <= 0:
+            return None
+        with self._latency_lock:
+            latencies = sorted(self._latencies[model])
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100.0))]
+
+    def _observe_latency(self, model: str, seconds: float) -> None:
+        with self._latency_lock:
+            self._latencies[model].append(seconds)
+
+    def _record(self, model: str, error: BaseException | None) -> LLMFailureKind | None:
+        """Updates the model's breaker and the trace; returns how to proceed after a failure."""
+        tracer = get_tracer()
+        if error is None:
+            self.breakers[model].record_success()
+            tracer.annotate(llm_model=model)
+            return None
+        self.breakers[model].record_failure()
+        kind = llm_failure_kind(error)
+        tracer.annotate(llm_error=type(error).__name__)
+        print(f"[LLM RETRY] {model} failed ({kind}): {type(error).__name__} - {error}")
+        return kind
+
+    def call(self, request: Callable[[str, float], T], hedge: bool = True) -> T:
+        """
+        Calls `request(model, timeout)` until one attempt succeeds; raises the last error if none does.
+        Without `hedge` (e.g. for a stream, whose latency is only the time to open it), no duplicate is
+        sent and the attempt's latency is not learned.
+        """
+        last_error: BaseException = RuntimeError("No LLM model available (all circuit breakers are open).")
+        models, deadline = self._plan()
+        for model, breaker in models:
+            for attempt in range(self.max_retries + 1):
+                if time.monotonic() >= deadline or not breaker.allow():
+                    break
+                started, settled = time.monotonic(), False
+                try:
+                    delay = self.hedge_delay(model) if hedge else None
+                    if delay is not None:
+                        result = self._hedged(request, model, deadline, delay)
+                    else:
+                        result = request(model, self._timeout(deadline))
+                    settled = True
+                except Exception as e:
+                    settled = True
+                    last_error = e
+                    kind = self._record(model, e)
+                    if kind == 'fatal':
+                        raise
+                    if kind == 'next_model':
+                        break
+                    if attempt < self.max_retries:
+                        time.sleep(min(self.backoff_delay(attempt), max(0.0, deadline - time.monotonic())))
+                    continue
+                finally:
+                    if not settled:
+                        breaker.release()  # Interrupted: don't leave a half-open probe claimed forever
+                if hedge:
+                    self._observe_latency(model, time.monotonic() - started)
+                self._record(model, None)
+                return result
+        raise last_error
+
+    def _hedged(self, request: Callable[[str, float], T], model: str, deadline: float, delay: float) -> T:
+        tracer = get_tracer()
+        trace = tracer.current()
+
+        def run() -> T:
+            with tracer.attach(trace):
+                return request(model, self._timeout(deadline))
+
+        pending = {self._hedge_pool.submit(run)}
+        done, pending = wait_futures(pending, timeout=delay)
+        if not done and time.monotonic() < deadline:
+            tracer.annotate(llm_hedge="fired")
+            pending.add(self._hedge_pool.submit(run))
+
+        error: BaseException | None = None
+        while done or pending:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()  # The slower duplicate finishes in the background
+                error = future.exception()
+            if not pending:
+                break
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        raise error
+
+    async def call_async(self, request: Callable[[str, float], Awaitable[T]]) -> T:
+        """Async variant of call(); the losing hedged request is cancelled."""
+        last_error: BaseException = RuntimeError("No LLM model available (all circuit breakers are open).")
+        models, deadline = self._plan()
+        for model, breaker in models:
+            for attempt in range(self.max_retries + 1):
+                if time.monotonic() >= deadline or not breaker.allow():
+                    break
+                started, settled = time.monotonic(), False
+                try:
+                    result = await self._hedged_async(request, model, deadline, self.hedge_delay(model))
+                    settled = True
+                except Exception as e:
+                    settled = True
+                    last_error = e
+                    kind = self._record(model, e)
+                    if kind == 'fatal':
+                        raise
+                    if kind == 'next_model':
+                        break
+                    if attempt < self.max_retries:
+                        await asyncio.sleep(min(self.backoff_delay(attempt), max(0.0, deadline - time.monotonic())))
+                    continue
+                finally:
+                    if not settled:
+                        breaker.release()  # Cancelled: don't leave a half-open probe claimed forever
+                self._observe_latency(model, time.monotonic() - started)
+                self._record(model, None)
+                return result
+        raise last_error
+
+    async def _hedged_async(self, request: Callable[[str, float], Awaitable[T]], model: str, deadline: float,
+                            delay: float | None) -> T:
+        pending = {asyncio.ensure_future(request(model, self._timeout(deadline)))}
+        try:
+            if delay is not None:
+                done, pending = await asyncio.wait(pending, timeout=delay)
+                if not done and time.monotonic() < deadline:
+                    get_tracer().annotate(llm_hedge="fired")
+                    pending.add(asyncio.ensure_future(request(model, self._timeout(deadline))))
+            else:
+                done = set()
+
+            error: BaseException | None = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+@st.cache_resource
+def get_resilient_llm() -> ResilientLLM:
+    """Process-wide, so every session sees the same circuit breaker state."""
+    return ResilientLLM()
+
+
+# ======================================================================
+# 18. API INTERACTION FUNCTION
+# ======================================================================
+
+def log_token_usage(usage) -> dict:
+    """Records the prompt/completion token counts of one call on the turn's trace, including prompt tokens served from the provider cache."""
+    if usage is None:
+        return {}
+
+    details = getattr(usage, 'prompt_tokens_details', None)
+    token_counts = {
+        'prompt_tokens': usage.prompt_tokens,
+        'cached_prompt_tokens': (getattr(details, 'cached_tokens', None) or 0) if details else 0,
+        'completion_tokens': usage.completion_tokens,
+    }
+    get_tracer().annotate(**token_counts)
+    return token_counts
+
+
+class LLMText(str):
+    """A completion's text, carrying why it stopped ('stop', 'length', ...) and its token counts."""
+
+    def __new__(cls, text: str, finish_reason: str | None = None, usage: dict | None = None):
+        completion = super().__new__(cls, text)
+        completion.finish_reason = finish_reason
+        completion.usage = usage or {}
+        return completion
+
+
+def json_response_options(json_output: bool) -> dict:
+    """Extra request options for JSON output (honoured by providers that support JSON mode)."""
+    return {'response_format': {"type": "json_object"}} if json_output else {}
+
+
+def generate_llm_response(system_prompt_content: str, user_input: str = "", max_tokens: int = MAX_TOKENS,
+                          json_output: bool = False, upstream_slot=None) -> str:
+    """
+    Sends the system prompt and user input to the chosen LLM for prose generation (structured expansion).
+    upstream_slot, if given, returns a context manager held around each upstream request.
+    """
+
+    def request(model: str, timeout: float):
+        with upstream_slot() if upstream_slot is not None else nullcontext():
+            with get_tracer().span("llm.upstream"):
+                return get_client_manager().get().chat.completions.create(
+                    model=model,
+                    messages=build_messages(system_prompt_content, user_input),
+                    temperature=TEMPERATURE,
+                    max_tokens=max_tokens,
+                    timeout=timeout,
+                    **json_response_options(json_output)
+                )
+
+    try:
+        response = get_resilient_llm().call(request)
+
+        # Log success (only visible in Streamlit Cloud logs)
+        print(f"DEBUG A: LLM API call SUCCESS.")
+        token_counts = log_token_usage(response.usage)
+
+        raw_content = response.choices[0].message.content
+
+        # --- FAIL-SAFE CHECK ---
+        if not raw_content or raw_content.isspace():
+            print(f"[LLM CONTENT FAIL] Model returned empty or blank content for prompt.")
+            return "[EMPTY CONTENT ERROR] The LLM returned a blank response."
+        # ---------------------------
+
+        # Return the raw content
+        return LLMText(raw_content, response.choices[0].finish_reason, token_counts)
+
+    except Exception as e:
+        # Critical failure if the LLM can't generate the reading
+        print(f"\n[CRITICAL LLM ERROR] Failed to expand reading: {type(e).__name__} - {e}")
+        return f"[CRITICAL LLM ERROR] Failed to expand reading: {type(e).__name__} - {e}"
+
+async def generate_llm_response_async(system_prompt_content: str, user_input: str = "", max_tokens: int = MAX_TOKENS,
+                                      json_output: bool = False, upstream_slot=None) -> str:
+    """
+    Async variant of generate_llm_response, on the manager's async client for the running loop.
+    upstream_slot, if given, returns an async context manager held around each upstream request.
+    """
+
+    async def request(model: str, timeout: float):
+        async with upstream_slot() if upstream_slot is not None else nullcontext():
+            with get_tracer().span("llm.upstream"):
+                return await get_client_manager().get_async().chat.completions.create(
+                    model=model,
+                    messages=build_messages(system_prompt_content, user_input),
+                    temperature=TEMPERATURE,
+                    max_tokens=max_tokens,
+                    timeout=timeout,
+                    **json_response_options(json_output)
+                )
+
+    try:
+        response = await get_resilient_llm().call_async(request)
+
+        print(f"DEBUG A: LLM API async call SUCCESS.")
+        token_counts = log_token_usage(response.usage)
+
+        raw_content = response.choices[0].message.content
+
+        # --- FAIL-SAFE CHECK ---
+        if not raw_content or raw_content.isspace():
+            print(f"[LLM CONTENT FAIL] Model returned empty or blank content for prompt.")
+            return "[EMPTY CONTENT ERROR] The LLM returned a blank response."
+
+        return LLMText(raw_content, response.choices[0].finish_reason, token_counts)
+
+    except Exception as e:
+        print(f"\n[CRITICAL LLM ERROR] Failed to expand reading: {type(e).__name__} - {e}")
+        return f"[CRITICAL LLM ERROR] Failed to expand reading: {type(e).__name__} - {e}"
+
+
+def metered_llm_response(system_prompt_content: str, user_input: str = "", max_tokens: int = MAX_TOKENS,
+                         json_output: bool = False, upstream_slot=None) -> str:
+    """generate_llm_response for calls outside a session (prefetch, pregeneration), charged to the global budget."""
+    completion = generate_llm_response(system_prompt_content, user_input, max_tokens, json_output, upstream_slot=upstream_slot)
+    get_token_budgeter().observe(None, None, completion)
+    return completion
+
+
+def reading_parser_for(raw_output: str) -> IncrementalPartParser | IncrementalJSONPartParser:
+    """The JSON parser for JSON output (possibly fenced or truncated), else the Part label parser."""
+    text = raw_output.lstrip()
+    json_like = text.startswith(("{", "```")) or f'"{READING_PART_KEYS[0]}"' in text[:200]
+    return IncrementalJSONPartParser() if json_like else IncrementalPartParser()
+
+
+def parse_reading_parts(raw_output: str) -> list[str]:
+    """
+    Part 1-3 of a complete LLM reading, '' for any that is missing. JSON output is read by
+    field name; prose is split on its Part labels by number.
+    """
+    parser = reading_parser_for(raw_output)
+    parser.feed(raw_output.strip() + "\n")  # A final label line needs its line break
+    parser.finish()
+    return parser.reading_parts()
+
+
+def continue_cut_off_part(open_part: tuple[int, str] | None, system_prompt: str, user_input: str, call=None) -> str | None:
+    """The rest of a part that max_tokens cut off (parser.open_part()), or None if there is nothing to continue."""
+    if open_part is None or not open_part[1]:
+        return None
+
+    index, text = open_part
+    call = call or metered_llm_response
+    with get_tracer().span("llm.continue"):
+        continuation = call(build_continuation_prompt(system_prompt, index, text), user_input,
+                            max(SHORT_ANSWER_MAX_TOKENS, MAX_TOKENS // len(READING_PART_KEYS)), False)
+    if getattr(continuation, 'finish_reason', None) is None:
+        return None  # An error message, not text
+    get_tracer().annotate(truncation="continued")
+    return continuation
+
+
+def complete_reading_parts(raw_output: str, system_prompt: str, user_input: str, call=None) -> list[str]:
+    """
+    Part 1-3 of a reading, with the LLM finishing what the first completion left out: a part
+    cut off by max_tokens is continued, then any parts still missing are re-asked for.
+    """
+    parser = reading_parser_for(raw_output)
+    parser.feed(raw_output.strip())
+    if getattr(raw_output, 'finish_reason', None) == 'length':
+        continuation = continue_cut_off_part(parser.open_part(), system_prompt, user_input, call)
+        if continuation:
+            parser.resume(continuation)
+    parser.feed("\n")  # A final label line needs its line break
+    parser.finish()
+
+    reading_parts = parser.reading_parts()
+    if any(reading_parts) and not all(reading_parts):
+        get_tracer().annotate(repair="attempted")
+        with get_tracer().span("llm.repair"):
+            reading_parts = repair_reading_parts(system_prompt, user_input, reading_parts, call=call)
+    return reading_parts
+
+
+def repair_reading_parts(system_prompt: str, user_input: str, reading_parts: list[str], call=None) -> list[str]:
+    """
+    Re-asks only for the missing parts (as JSON) and fills them in. Parts stay '' if the
+    repair fails too; readings with nothing usable are not repaired (that would be a full regeneration).
+    """
+    missing = sum(1 for part in reading_parts if not part)
+    if not missing or missing == len(reading_parts):
+        return reading_parts
+
+    call = call or metered_llm_response
+    max_tokens = max(SHORT_ANSWER_MAX_TOKENS, MAX_TOKENS * missing // len(reading_parts))
+    repaired = parse_reading_parts(call(build_repair_prompt(system_prompt, reading_parts), user_input, max_tokens, True))
+    print(f"DEBUG A: Repaired {sum(1 for old, new in zip(reading_parts, repaired) if not old and new)} of {missing} missing parts.")
+    return [part or new_part for part, new_part in zip(reading_parts, repaired)]
+
+
+def fill_missing_parts(reading_parts: list[str]) -> list[str]:
+    """The parts to show, MISSING_PART_TEXT standing in for any still missing, so Part 3 is never shown as Part 2."""
+    return [part or MISSING_PART_TEXT for part in reading_parts]
+
+
+def fetch_reading_parts(system_prompt: str, user_input: str, reading_cache: ReadingCache | None = None,
+                        voice: str | None = None, upstream_slot=None) -> list[str] | None:
+    """
+    Generates and parses a reading without touching any agent state (used for prefetching).
+    Returns the three parts, or None if the output did not follow the Part structure (or the
+    global token budget is used up).
+    """
+    budgeter = get_token_budgeter()
+    if not budgeter.allows():
+        return None
+
+    prompt = system_prompt + budgeter.length_guidance(voice, "reading")
+    completion = generate_llm_response(prompt, user_input, budgeter.max_tokens(voice, "reading"), READING_OUTPUT_FORMAT == "json",
+                                       upstream_slot=upstream_slot)
+    budgeter.observe(voice, "reading", completion)
+    reading_parts = complete_reading_parts(completion, prompt, user_input,
+                                           call=functools.partial(metered_llm_response, upstream_slot=upstream_slot))
+    if not all(reading_parts):
+        return None
+
+    if reading_cache is not None:
+        reading_cache.put(ReadingCache.make_key(system_prompt, user_input), reading_parts)
+    return reading_parts
+
+
+BATCH_READING_DELIMITER = re.compile(r"^[\s=*#]*READING\s+(\d+)\b[\s=*#]*$", re.MULTILINE | re.IGNORECASE)
+
+
+def split_batch_readings(raw_output: str, count: int) -> list[str]:
+    """The raw text of each reading in a batch completion, by delimiter number; '' for any that is missing."""
+    readings = [""] * count
+    delimiters = list(BATCH_READING_DELIMITER.finditer(raw_output))
+    for delimiter, following in zip(delimiters, delimiters[1:] + [None]):
+        number = int(delimiter.group(1))
+        if 1 <= number <= count and not readings[number - 1]:
+            readings[number - 1] = raw_output[delimiter.end():following.start() if following else None]
+    return readings
+
+
+def fetch_reading_batch(rows: list[PlantRecord], user_input: str, reading_cache: ReadingCache | None = None,
+                        prompt_library: PromptLibrary | None = None, fallback: bool = True,
+                        upstream_slot=None) -> list[list[str] | None]:
+    """
+    Generates the readings of several records in one LLM call, then splits and parses them per
+    record. Each complete reading is cached under its own single-plant prompt, so it is served
+    exactly as if it had been generated alone. Entries that did not parse (or were cut off by the
+    token limit) are generated one by one with fetch_reading_parts, unless fallback is False.
+    Returns the three parts per record, or None where none could be had.
+    """
+    system_prompts = [
+        prompt_library.get(row.plant, row.voice) if prompt_library is not None else build_system_prompt(row)
+        for row in rows
+    ]
+    if len(rows) == 1:
+        return [fetch_reading_parts(system_prompts[0], user_input, reading_cache, rows[0].voice, upstream_slot)]
+
+    results: list[list[str] | None] = [None] * len(rows)
+    budgeter = get_token_budgeter()
+    if budgeter.allows():
+        voices = {row.voice for row in rows}
+        prompt = build_batch_system_prompt(rows)
+        if len(voices) == 1:
+            prompt += budgeter.length_guidance(rows[0].voice, "reading", per="per reading")
+        max_tokens = sum(budgeter.max_tokens(row.voice, "reading") for row in rows)
+
+        with get_tracer().span("llm.batch"):
+            completion = generate_llm_response(prompt, user_input, max_tokens, False, upstream_slot=upstream_slot)
+        budgeter.observe(None, None, completion)  # One call for several readings: charged, but not a reading length
+
+        if getattr(completion, 'finish_reason', None) is not None:
+            readings = split_batch_readings(completion, len(rows))
+            if completion.finish_reason == 'length':
+                # The last reading that started was cut off mid-way; it is regenerated on its own
+                started = [index for index, reading in enumerate(readings) if reading]
+                if started:
+                    readings[started[-1]] = ""
+            for index, reading in enumerate(readings):
+                reading_parts = parse_reading_parts(reading) if reading else []
+                if reading_parts and all(reading_parts):
+                    results[index] = reading_parts
+                    if reading_cache is not None:
+                        reading_cache.put(ReadingCache.make_key(system_prompts[index], user_input), reading_parts)
+
+    failed = [index for index, parts in enumerate(results) if parts is None]
+    print(f"DEBUG A: Batch of {len(rows)} readings: {len(rows) - len(failed)} parsed, {len(failed)} "
+          f"{'generated one by one' if fallback else 'left out'}.")
+    if fallback:
+        for index in failed:
+            results[index] = fetch_reading_parts(system_prompts[index], user_input, reading_cache, rows[index].voice, upstream_slot)
+    return results
+
+class LLMStreamError(Exception):
+    """A streamed completion failed; the message is the usual "[... ERROR] ..." text for the visitor."""
+
+
+def generate_llm_response_stream(system_prompt_content: str, user_input: str = "", json_output: bool = False,
+                                 max_tokens: int = MAX_TOKENS, on_finish=None, upstream_slot=None):
+    """
+    Streaming variant of generate_llm_response: yields the completion as text deltas. Once the
+    stream ends, on_finish(finish_reason, token_counts) is called if given. A failure (or blank
+    output) is raised as LLMStreamError, never yielded, so it cannot end up inside a Part.
+    An upstream_slot is held by each attempt to open the stream, then until the stream ends.
+    """
+    open_stream = ExitStack()
+
+    def request(model: str, timeout: float):
+        with ExitStack() as attempt:
+            if upstream_slot is not None:
+                attempt.enter_context(upstream_slot())
+            stream = get_client_manager().get().chat.completions.create(
+                model=model,
+                messages=build_messages(system_prompt_content, user_input),
+                temperature=TEMPERATURE,
+                max_tokens=max_tokens,
+                timeout=timeout,
+                **json_response_options(json_output),
+                stream=True,
+                stream_options={"include_usage": True}  # Final chunk carries the token counts
+            )
+            open_stream.push(attempt.pop_all())  # Opened: the slot stays taken while it streams
+            return stream
+
+    stream_started = time.perf_counter()
+    try:
+        # Retries and fallback apply until the stream opens; once text is shown it cannot be replayed
+        stream = get_resilient_llm().call(request, hedge=False)
+
+        print(f"DEBUG A: LLM API stream OPENED.")
+
+        received_content = False
+        finish_reason, token_counts = None, {}
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                token_counts = log_token_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not received_content:
+                    get_tracer().record_span("llm.first_token", (time.perf_counter() - stream_started) * 1000)
+                received_content = True
+                yield delta
+
+    except Exception as e:
+        print(f"\n[CRITICAL LLM ERROR] Failed to stream reading: {type(e).__name__} - {e}")
+        raise LLMStreamError(f"[CRITICAL LLM ERROR] Failed to stream reading: {type(e).__name__} - {e}") from e
+    finally:
+        open_stream.close()  # Frees the upstream slot, also when the consumer stops early
+
+    # --- FAIL-SAFE CHECK ---
+    if not received_content:
+        print(f"[LLM CONTENT FAIL] Model streamed empty content for prompt.")
+        raise LLMStreamError("[EMPTY CONTENT ERROR] The LLM returned a blank response.")
+    if on_finish is not None:
+        on_finish(finish_reason, token_counts)
+
+# ======================================================================
+# 19. BENCHMARK HARNESS (DETERMINISTIC FAKE LLM)
+# ======================================================================
+
+# Recorded visitor behaviour, replayed turn by turn through BotanicalGuideAgent.respond
+BENCH_TOUR_SCRIPTS = {
+    'sequential': ["", "elder", "continue", "continue", "continue", "next plant", "continue", "continue",
+                   "next plant", "continue", "next plant"],
+    'jumper': ["", "child", "continue", "ginger", "continue", "black pepper", "evidence", "continue",
+               "next plant", "cacao"],
+    'chatty': ["", "evidence", "what's the weather like?", "continue", "is this good for sleep?",
+               "next plant", "how much does this cost?", "continue", "continue"],
+}
+
+
+class FakeLLM:
+    """
+    Stand-in for the upstream model with scripted behaviour: a fixed time to first token,
+    a token rate, and seeded rates of malformed (unlabelled) output and upstream errors.
+    """
+
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 50.0, completion_tokens: int = 300,
+                 malformed_rate: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.malformed_rate = malformed_rate
+        self.error_rate = error_rate
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _next_outcome(self) -> str:
+        with self._lock:
+            self.calls += 1
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return 'error'
+        if roll < self.error_rate + self.malformed_rate:
+            return 'malformed'
+        return 'ok'
+
+    # Prompts answered with plain text (a short answer, or the rest of a cut-off part) rather than a reading
+    PLAIN_TEXT_PROMPT_MARKERS = ("CONTINUATION:", "interrupted your reading with a question", "asked a question about the plants")
+
+    def _completion_words(self, system_prompt_content: str, outcome: str, json_output: bool = False) -> list[str]:
+        words_per_part = max(1, self.completion_tokens // 3)
+        if any(marker in system_prompt_content for marker in self.PLAIN_TEXT_PROMPT_MARKERS):
+            return ["lorem"] * words_per_part
+        batch_size = len(re.findall(r"^READING \d+:", system_prompt_content, re.MULTILINE))
+        if batch_size:  # A malformed batch has its last reading unlabelled
+            words = []
+            for number in range(1, batch_size + 1):
+                last = number == batch_size
+                words += [f"\n=== READING {number} ===\n"] + self._completion_words("", outcome if last else 'ok')
+            return words
+        if json_output:  # Malformed JSON is cut off after part2
+            words = ["{"]
+            for key in READING_PART_KEYS[:2] if outcome == 'malformed' else READING_PART_KEYS:
+                words += [f'"{key}": "'] + ["lorem"] * words_per_part + ['",']
+            words[-1] = '"' if outcome == 'malformed' else '"}'
+            return words
+        if outcome == 'malformed':
+            return ["Lorem"] * (words_per_part * 3)
+        words = []
+        for number, title in enumerate(["History and Origin", "Key Features and Uses", "Scientific Details and Context"], 1):
+            words += [f"**Part {number}: {title}**\n"] + ["lorem"] * words_per_part + ["\n\n"]
+        return words
+
+    def _completion(self, system_prompt_content: str, outcome: str, max_tokens: int, json_output: bool) -> LLMText:
+        """The completion, cut off at max_tokens (one word per token) like a real model would."""
+        words = self._completion_words(system_prompt_content, outcome, json_output)
+        usage = {'prompt_tokens': len(system_prompt_content.split()), 'completion_tokens': min(len(words), max_tokens)}
+        return LLMText(" ".join(words[:max_tokens]), 'length' if len(words) > max_tokens else 'stop', usage)
+
+    def generate(self, system_prompt_content: str, user_input: str = "", max_tokens: int = MAX_TOKENS,
+                 json_output: bool = False, upstream_slot=None) -> str:
+        with upstream_slot() if upstream_slot is not None else nullcontext():
+            outcome = self._next_outcome()
+            time.sleep(self.latency)
+            if outcome == 'error':
+                return "[CRITICAL LLM ERROR] Failed to expand reading: FakeLLMError - simulated upstream failure"
+            completion = self._completion(system_prompt_content, outcome, max_tokens, json_output)
+            time.sleep(completion.usage['completion_tokens'] / self.tokens_per_second)
+            return completion
+
+    def generate_stream(self, system_prompt_content: str, user_input: str = "", json_output: bool = False,
+                        max_tokens: int = MAX_TOKENS, on_finish=None, upstream_slot=None):
+        with upstream_slot() if upstream_slot is not None else nullcontext():
+            outcome = self._next_outcome()
+            time.sleep(self.latency)
+            if outcome == 'error':
+                raise LLMStreamError("[CRITICAL LLM ERROR] Failed to stream reading: FakeLLMError - simulated upstream failure")
+            completion = self._completion(system_prompt_content, outcome, max_tokens, json_output)
+            for word in completion.split(" "):
+                time.sleep(1.0 / self.tokens_per_second)
+                yield word + " "
+        if on_finish is not None:
+            on_finish(completion.finish_reason, completion.usage)
+
+    async def generate_async(self, system_prompt_content: str, user_input: str = "", max_tokens: int = MAX_TOKENS,
+                             json_output: bool = False, upstream_slot=None) -> str:
+        async with upstream_slot() if upstream_slot is not None else nullcontext():
+            outcome = self._next_outcome()
+            await asyncio.sleep(self.latency)
+            if outcome == 'error':
+                return "[CRITICAL LLM ERROR] Failed to expand reading: FakeLLMError - simulated upstream failure"
+            completion = self._completion(system_prompt_content, outcome, max_tokens, json_output)
+            await asyncio.sleep(completion.usage['completion_tokens'] / self.tokens_per_second)
+            return completion
+
+
+@contextmanager
+def fake_llm_backend(fake: FakeLLM):
+    """Routes every generate_llm_response* call in this module to the fake for the duration of the block."""
+    module_globals = globals()
+    replacements = {
+        'generate_llm_response': fake.generate,
+        'generate_llm_response_stream': fake.generate_stream,
+        'generate_llm_response_async': fake.generate_async,
+    }
+    originals = {name: module_globals[name] for name in replacements}
+    module_globals.update(replacements)
+    try:
+        yield fake
+    finally:
+        module_globals.update(originals)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile (no interpolation), fine for latency reporting."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_benchmark(fake: FakeLLM, sessions: int = 10, scripts: list[str] | None = None, streaming: bool = False,
+                  use_cache: bool = False, use_prefetch: bool = False) -> dict:
+    """
+    Replays the tour scripts through `sessions` concurrent agents against the fake LLM and
+    reports turn latency percentiles, LLM calls per tour and throughput.
+    """
+
+    scripts = scripts or list(BENCH_TOUR_SCRIPTS)
+    plant_data = load_and_structure_plant_data(DOC_TEXT, PLANT_SEQUENCE, VOICE_MAPPING)
+    prompt_library = PromptLibrary(plant_data)
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        reading_cache = ReadingCache(os.path.join(scratch_dir, "bench_cache.sqlite3")) if use_cache else None
+        semantic_cache = SemanticCache(log_path=None) if use_cache else None
+        prefetcher = ReadingPrefetcher() if use_prefetch else None
+
+        turn_latencies: list[float] = []
+        latency_lock = threading.Lock()
+
+        def run_session(session_index: int) -> None:
+            agent = BotanicalGuideAgent(
+                plant_data, PLANT_SEQUENCE, VOICE_OPTIONS, reading_cache=reading_cache, semantic_cache=semantic_cache,
+                prefetcher=prefetcher, streaming=streaming, prompt_library=prompt_library
+            )
+            for user_input in BENCH_TOUR_SCRIPTS[scripts[session_index % len(scripts)]]:
+                started = time.perf_counter()
+                agent.respond(user_input)
+                elapsed = time.perf_counter() - started
+                with latency_lock:
+                    turn_latencies.append(elapsed)
+
+        with fake_llm_backend(fake):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix="bench-session") as pool:
+                list(pool.map(run_session, range(sessions)))
+            wall_time = time.perf_counter() - started
+
+        if prefetcher is not None:
+            prefetcher.shutdown()
+        if reading_cache is not None:
+            reading_cache.close()
+
+    report = {
+        'sessions': sessions,
+        'turns': len(turn_latencies),
+        'p50_ms': round(percentile(turn_latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(turn_latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(turn_latencies, 99) * 1000, 1),
+        'llm_calls_per_tour': round(fake.calls / sessions, 2),
+        'turns_per_second': round(len(turn_latencies) / wall_time, 2),
+        'wall_time_s': round(wall_time, 2),
+    }
+    print(f"[BENCHMARK] {json.dumps(report)}")
+    return report
+
+
+# ======================================================================
+# 20. CHAT HISTORY (BOUNDED, COMPACTED)
+# ======================================================================
+
+class ChatHistory:
+    """
+    Per-session chat history with bounded cost. The visible tail is a ring buffer of
+    (role, content) tuples; messages pushed out of it are zlib-compressed in pages and only
+    decompressed when the visitor opens the older messages. Beyond `max_messages` the
+    oldest pages are dropped, so memory stays bounded for kiosk sessions that run all day.
+    """
+
+    def __init__(self, visible: int = HISTORY_VISIBLE_MESSAGES, max_messages: int = HISTORY_MAX_MESSAGES,
+                 page_size: int = HISTORY_PAGE_SIZE):
+        self.tail: deque[tuple[str, str]] = deque(maxlen=visible)
+        self.max_messages = max(max_messages, visible)
+        self.page_size = page_size
+        self.dropped = 0
+        self._spilled: list[tuple[str, str]] = []  # Left the tail, not yet compressed
+        self._pages: deque[tuple[int, bytes]] = deque()  # (message count, compressed JSON), oldest first
+        self._paged_count = 0
+
+    def append(self, role: str, content: str) -> None:
+        if len(self.tail) == self.tail.maxlen:
+            self._spill(self.tail[0])
+        self.tail.append((role, content))
+
+    def _spill(self, message: tuple[str, str]) -> None:
+        self._spilled.append(message)
+        if len(self._spilled) >= self.page_size:
+            self._pages.append((len(self._spilled), zlib.compress(json.dumps(self._spilled).encode("utf-8"))))
+            self._paged_count += len(self._spilled)
+            self._spilled = []
+
+        while self._pages and self.older_count + len(self.tail) > self.max_messages:
+            count, _ = self._pages.popleft()
+            self._paged_count -= count
+            self.dropped += count
+
+    @property
+    def older_count(self) -> int:
+        """Messages kept outside the visible tail."""
+        return self._paged_count + len(self._spilled)
+
+    def __len__(self) -> int:
+        return self.older_count + len(self.tail)
+
+    def older(self, limit: int | None = None) -> list[tuple[str, str]]:
+        """The newest `limit` messages before the tail (all if None), oldest first; decompresses only what it needs."""
+        messages = list(self._spilled)
+        for _, page in reversed(self._pages):
+            if limit is not None and len(messages) >= limit:
+                break
+            messages = [tuple(message) for message in json.loads(zlib.decompress(page))] + messages
+        return messages if limit is None else messages[-limit:]
+
+    def to_state(self) -> dict:
+        """JSON-serializable form; compressed pages are kept compressed."""
+        return {
+            'tail': list(self.tail),
+            'spilled': self._spilled,
+            'pages': [(count, base64.b64encode(page).decode("ascii")) for count, page in self._pages],
+            'dropped': self.dropped,
+            'limits': {'visible': self.tail.maxlen, 'max_messages': self.max_messages, 'page_size': self.page_size},
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "ChatHistory":
+        history = cls(**state.get('limits', {}))  # States saved before the limits were kept get the defaults
+        history.tail.extend(tuple(message) for message in state['tail'])
+        history._spilled = [tuple(message) for message in state['spilled']]
+        history._pages = deque((count, base64.b64decode(page)) for count, page in state['pages'])
+        history._paged_count = sum(count for count, _ in history._pages)
+        history.dropped = state['dropped']
+        return history
+
+
+# ======================================================================
+# 21. SESSION STORE (MULTI-WORKER DEPLOYMENT)
+# ======================================================================
+
+class SessionStore:
+    """
+    Where a visitor's session (agent state and chat history, as a JSON-serializable dict)
+    lives between turns. This base class keeps sessions in the current process, which is
+    enough for a single worker; subclasses share them between workers, so any worker behind
+    a load balancer can serve the next turn and sessions survive restarts.
+    """
+
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._sessions: dict[str, tuple[float, dict]] = {}
+
+    def load(self, session_id: str) -> dict | None:
+        """The saved session, or None if it is unknown or expired."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        if entry is None or time.time() - entry[0] > self.ttl_seconds:
+            return None
+        return entry[1]
+
+    def save(self, session_id: str, state: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = (now, state)
+            for expired in [key for key, (saved_at, _) in self._sessions.items() if now - saved_at > self.ttl_seconds]:
+                del self._sessions[expired]
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in a SQLite file shared by every worker process that opens it (WAL mode, so
+    readers never block the writer). Sessions are independent, so concurrent writes to
+    different sessions only contend for the file lock briefly; the last write of a session wins.
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH, ttl_seconds: int = SESSION_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT NOT NULL, saved_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_saved_at ON sessions (saved_at)")
+        self._conn.commit()
+
+    def load(self, session_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state FROM sessions WHERE id = ? AND saved_at >= ?", (session_id, time.time() - self.ttl_seconds)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, session_id: str, state: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, state, saved_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(state), now)
+            )
+            self._conn.execute("DELETE FROM sessions WHERE saved_at < ?", (now - self.ttl_seconds,))
+            self._conn.commit()
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def session_state_payload(agent: BotanicalGuideAgent, history: ChatHistory, revision: int) -> dict:
+    """What a session store holds for one visitor."""
+    return {'revision': revision, 'agent': asdict(agent.export_state()), 'history': history.to_state()}
+
+# ======================================================================
+# 22. HTTP API (HEADLESS, ASYNC)
+# ======================================================================
+
+class APIError(Exception):
+    """An error answered to the client as {"error": message} with the given HTTP status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class GuideAPI:
+    """
+    The agent as a JSON-over-HTTP service on one asyncio event loop, without Streamlit's
+    per-interaction script reruns:
+
+        POST   /sessions                 start a tour (returns the session id and greeting)
+        POST   /sessions/{id}/respond    {"input": "..."}; send Accept: text/event-stream to
+                                         receive Part 1 as server-sent "partial" events
+        POST   /sessions/{id}/continue   shorthand for the input "continue"
+        GET    /sessions/{id}            the saved agent state
+        DELETE /sessions/{id}
+        GET    /health, GET /metrics
+
+    Sessions live in a SessionStore (shared with the Streamlit app and other workers when
+    SESSION_STORE_PATH is set); recently used agents stay in memory and are only rebuilt
+    from the store when another process has served the session since. Turns of one session
+    are serialized by a per-session lock; turns of different sessions run concurrently.
+    """
+
+    def __init__(self, session_store: SessionStore | None = None, llm_service: AsyncLLMService | None = None,
+                 max_live_sessions: int = API_MAX_LIVE_SESSIONS):
+        self.session_store = session_store or get_session_store() or SessionStore()
+        self.llm_service = llm_service or AsyncLLMService()
+        self.tracer = get_tracer()
+        self.max_live_sessions = max_live_sessions
+        self._live: dict[str, tuple[int, AsyncBotanicalGuideAgent, ChatHistory]] = {}  # Least recently used first
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def _new_agent(self) -> AsyncBotanicalGuideAgent:
+        plant_data = get_plant_data()
+        catalogue = get_plant_catalogue()
+        prompt_library = get_prompt_library(catalogue.version, plant_data)
+        return AsyncBotanicalGuideAgent(
+            plant_data, catalogue.plant_sequence, catalogue.voice_options, llm_service=self.llm_service,
+            reading_cache=get_reading_cache(), semantic_cache=get_semantic_cache(), prefetcher=get_prefetcher(),
+            prompt_library=prompt_library,
+            pregenerated=get_pregenerated_readings(catalogue.version, prompt_library),
+            intent_classifier=get_intent_classifier(catalogue.version, catalogue), tracer=self.tracer,
+            catalogue_version=catalogue.version
+        )
+
+    def _lock_for(self, session_id: str) -> asyncio.Lock:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    def _remember(self, session_id: str, revision: int, agent: AsyncBotanicalGuideAgent, history: ChatHistory) -> None:
+        self._live.pop(session_id, None)
+        self._live[session_id] = (revision, agent, history)
+        while len(self._live) > self.max_live_sessions:
+            self._live.pop(next(iter(self._live)))
+
+    async def _checkout(self, session_id: str) -> tuple[int, AsyncBotanicalGuideAgent, ChatHistory]:
+        """The session's agent: the in-memory one if it is current, else rebuilt from the store."""
+        saved = await asyncio.to_thread(self.session_store.load, session_id)
+        if saved is None:
+            self._live.pop(session_id, None)
+            raise APIError(404, f"Unknown or expired session: {session_id}")
+
+        live = self._live.get(session_id)
+        if live is not None and live[0] == saved['revision']:
+            return live
+
+        agent = self._new_agent()
+        agent.restore_state(AgentState(**saved['agent']))
+        return saved['revision'], agent, ChatHistory.from_state(saved['history'])
+
+    def _turn(self, agent: AsyncBotanicalGuideAgent, user_input: str, on_partial=None) -> str:
+        """Runs on the agent's turn worker; streams Part 1 to on_partial if given."""
+        agent.streaming = on_partial is not None
+        agent.stream_handler = on_partial
+        try:
+            with self.tracer.turn("api.turn"):
+                return agent.respond(user_input)
+        finally:
+            agent.streaming = False
+            agent.stream_handler = None
+
+    async def _save(self, session_id: str, revision: int, agent: AsyncBotanicalGuideAgent, history: ChatHistory) -> None:
+        await asyncio.to_thread(self.session_store.save, session_id, session_state_payload(agent, history, revision))
+        self._remember(session_id, revision, agent, history)
+
+    @staticmethod
+    def _turn_payload(session_id: str, revision: int, response: str, agent: AsyncBotanicalGuideAgent) -> dict:
+        state = agent.export_state()
+        return {
+            'session_id': session_id, 'revision': revision, 'response': response,
+            'voice': state.voice, 'plant': state.plant, 'reading_step': state.reading_step,
+        }
+
+    async def create_session(self) -> dict:
+        session_id = uuid.uuid4().hex
+        agent, history = self._new_agent(), ChatHistory()
+        greeting = await agent._run_turn(self._turn, agent, "")
+        history.append("agent", greeting)
+        await self._save(session_id, 0, agent, history)
+        return self._turn_payload(session_id, 0, greeting, agent)
+
+    async def respond(self, session_id: str, user_input: str, on_partial=None) -> dict:
+        async with self._lock_for(session_id):
+            revision, agent, history = await self._checkout(session_id)
+            history.append("user", user_input)
+            response = await agent._run_turn(self._turn, agent, user_input, on_partial)
+            history.append("agent", response)
+            await self._save(session_id, revision + 1, agent, history)
+            return self._turn_payload(session_id, revision + 1, response, agent)
+
+    async def get_state(self, session_id: str) -> dict:
+        saved = await asyncio.to_thread(self.session_store.load, session_id)
+        if saved is None:
+            raise APIError(404, f"Unknown or expired session: {session_id}")
+        return {'session_id': session_id, 'revision': saved['revision'], **saved['agent']}
+
+    async def delete_session(self, session_id: str) -> dict:
+        async with self._lock_for(session_id):
+            await asyncio.to_thread(self.session_store.delete, session_id)
+            self._live.pop(session_id, None)
+        return {'session_id': session_id, 'deleted': True}
+
+    # --- HTTP ---
+    async def dispatch(self, method: str, path: str, body: dict) -> tuple[int, dict]:
+        """Routes one JSON request; returns (status, payload)."""
+        segments = [segment for segment in path.split("/") if segment]
+
+        if method == "GET" and segments == ["health"]:
+            return 200, {'status': 'ok', 'live_sessions': len(self._live)}
+        if method == "GET" and segments == ["metrics"]:
+            return 200, {**self.tracer.snapshot(), 'tokens': get_token_budgeter().stats(),
+                         'semantic_cache': get_semantic_cache().stats()}
+        if segments == ["sessions"] and method == "POST":
+            return 201, await self.create_session()
+        if len(segments) == 2 and segments[0] == "sessions":
+            if method == "GET":
+                return 200, await self.get_state(segments[1])
+            if method == "DELETE":
+                return 200, await self.delete_session(segments[1])
+        if len(segments) == 3 and segments[0] == "sessions" and method == "POST":
+            if segments[2] in ("respond", "continue"):
+                return 200, await self.respond(segments[1], self.turn_input(segments[2], body))
+
+        raise APIError(404, f"No route for {method} {path}")
+
+    @staticmethod
+    def turn_input(action: str, body: dict) -> str:
+        if action == "continue":
+            return "continue"
+        user_input = body.get("input")
+        if not isinstance(user_input, str):
+            raise APIError(400, 'Expected a JSON body with a string "input" field.')
+        return user_input
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """One HTTP/1.1 connection: keep-alive JSON requests, or a single server-sent-events response."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                    length = int(headers.get("content-length", 0))
+                    if length > API_MAX_BODY_BYTES:
+                        raise APIError(413, "Request body too large.")
+                    raw_body = await reader.readexactly(length) if length else b""
+                    body = json.loads(raw_body) if raw_body.strip() else {}
+                    if not isinstance(body, dict):
+                        raise APIError(400, "Expected a JSON object.")
+                except (ValueError, UnicodeDecodeError) as e:
+                    await self._write_json(writer, 400, {'error': f"Malformed request: {e}"}, keep_alive=False)
+                    break
+                except APIError as e:
+                    await self._write_json(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    break
+
+                path = target.partition("?")[0]
+                keep_alive = headers.get("connection", "").lower() != "close"
+                segments = [segment for segment in path.split("/") if segment]
+                if ("text/event-stream" in headers.get("accept", "") and method == "POST"
+                        and len(segments) == 3 and segments[0] == "sessions"):
+                    await self._stream_turn(writer, segments[1], segments[2], body)
+                    break  # The event stream is delimited by closing the connection
+
+                try:
+                    status, payload = await self.dispatch(method, path, body)
+                except APIError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception as e:
+                    print(f"[API ERROR] {method} {path}: {type(e).__name__} - {e}")
+                    status, payload = 500, {'error': "Internal error."}
+                await self._write_json(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The client went away
+        finally:
+            writer.close()
+
+    async def _stream_turn(self, writer: asyncio.StreamWriter, session_id: str, action: str, body: dict) -> None:
+        """Answers a turn as server-sent events: "partial" while Part 1 streams in, then "response" (or "error")."""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+        )
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def run() -> None:
+            try:
+                payload = await self.respond(session_id, self.turn_input(action, body),
+                                             on_partial=lambda text: loop.call_soon_threadsafe(events.put_nowait, ("partial", {'text': text})))
+                events.put_nowait(("response", payload))
+            except APIError as e:
+                events.put_nowait(("error", {'status': e.status, 'error': str(e)}))
+            except Exception as e:
+                print(f"[API ERROR] streamed turn {session_id}: {type(e).__name__} - {e}")
+                events.put_nowait(("error", {'status': 500, 'error': "Internal error."}))
+
+        turn = asyncio.create_task(run())
+        while True:
+            event, payload = await events.get()
+            writer.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+            await writer.drain()
+            if event != "partial":
+                break
+        await turn
+
+    @staticmethod
+    async def _write_json(writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool = True) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+            + data
+        )
+        await writer.drain()
+
+
+async def serve_api(host: str = "127.0.0.1", port: int = 8080, api: GuideAPI | None = None) -> None:
+    """Runs the headless API until cancelled."""
+    api = api or GuideAPI()
+    server = await asyncio.start_server(api.serve_connection, host, port)
+    print(f"Botanical Guide API listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+# ======================================================================
+# 23. STREAMLIT UI RUNNER
+# ======================================================================
+
+@st.cache_resource
+def get_reading_cache() -> ReadingCache:
+    """One persistent reading cache per process, shared by every session."""
+    return ReadingCache()
+
+
+@st.cache_resource
+def get_plant_catalogue() -> PlantCatalogue:
+    """The plant catalogue (PLANT_CATALOGUE_PATH, or the built-in DOC_TEXT), shared read-only by every session."""
+    return PlantCatalogue(PLANT_CATALOGUE_PATH or None)
+
+
+def get_plant_data() -> PlantIndex:
+    """The current catalogue index; the source is only re-read (changed entries only) after it changes."""
+    return get_plant_catalogue().refresh()
+
+
+# Resources derived from the catalogue are keyed by its version, so a reload rebuilds them
+@st.cache_resource(max_entries=2)
+def get_prompt_library(catalogue_version: int, _plant_data: PlantIndex) -> PromptLibrary:
+    """System prompt prefixes per (plant, voice), built once per catalogue version and shared by every session."""
+    return PromptLibrary(_plant_data)
+
+
+@st.cache_resource(max_entries=2)
+def get_intent_classifier(catalogue_version: int, _catalogue: PlantCatalogue) -> IntentClassifier:
+    """The compiled alias patterns, shared by every session."""
+    return IntentClassifier(_catalogue.plant_sequence, _catalogue.voice_options, _catalogue.index)
+
+
+@st.cache_resource(max_entries=2)
+def get_pregenerated_readings(catalogue_version: int, _prompt_library: PromptLibrary) -> PregeneratedReadings:
+    """Readings from the offline artifact (empty if it has not been generated)."""
+    return PregeneratedReadings(PREGENERATED_READINGS_PATH, _prompt_library)
+
+
+@st.cache_resource
+def get_prefetcher() -> ReadingPrefetcher:
+    """One bounded prefetch pool per process, so concurrent sessions share its worker limit."""
+    return ReadingPrefetcher()
+
+
+@st.cache_resource
+def get_session_store() -> SessionStore | None:
+    """The shared session store in multi-worker mode (SESSION_STORE_PATH set), else None."""
+    return SQLiteSessionStore(SESSION_STORE_PATH) if SESSION_STORE_PATH else None
+
+
+def render_metrics_page(tracer: Tracer) -> None:
+    """In-process metrics (open the app with ?page=metrics): span latency histograms and outcome counters."""
+    st.title("📈 Performance Metrics")
+    snapshot = tracer.snapshot()
+
+    rows = ["| Span | Count | Mean (ms) | p50 (ms) | p95 (ms) | p99 (ms) |", "|---|---|---|---|---|---|"]
+    for name, stats in snapshot['spans'].items():
+        rows.append(f"| {name} | {stats['count']} | {stats['mean_ms']} | ≤{stats['p50_ms']:g} | ≤{stats['p95_ms']:g} | ≤{stats['p99_ms']:g} |")
+    st.markdown("\n".join(rows))
+
+    st.subheader("Outcomes")
+    st.json(snapshot['counters'])
+
+    st.subheader("Token budgets")
+    st.json(get_token_budgeter().stats())
+
+    st.subheader("Semantic cache")
+    st.json(get_semantic_cache().stats())
+
+    st.subheader("Histograms")
+    for name, stats in snapshot['spans'].items():
+        with st.expander(name):
+            st.json(stats['buckets'])
+
+
+def run_streamlit_app():
+    # 1. Configuration and Title
+    st.set_page_config(page_title="Botanical Guide Agent", layout="centered")
+    tracer = get_tracer()
+    if st.query_params.get("page") == "metrics":
+        render_metrics_page(tracer)
+        return
+    st.title("🌿 Interactive Botanical Guide")
+    st.markdown("---")
+
+    # 2. API Key Loading (using Streamlit's secrets for security)
+    try:
+        openrouter_key = st.secrets["OPENROUTER_API_KEY"]
+    except KeyError:
+        st.error("API Key not found in Streamlit Secrets. Please configure `OPENROUTER_API_KEY`.")
+        return
+
+    # CRITICAL: Configure the shared, pooled client with the loaded secret (no-op once configured)
+    get_client_manager().configure(api_key=openrouter_key)
+
+    # 3. Initialization and Agent Setup
+    # In multi-worker mode the session id travels in the URL, so any worker (or a restarted one) can resume it
+    session_store = get_session_store()
+    saved_session = None
+    if session_store is not None:
+        if "session" not in st.query_params:
+            st.query_params["session"] = uuid.uuid4().hex
+        session_id = st.query_params["session"]
+        saved_session = session_store.load(session_id)
+        if saved_session is not None and saved_session['revision'] != st.session_state.get('revision'):
+            st.session_state.pop('agent', None)  # Another worker has served this session since: resume its state
+
+    if 'agent' not in st.session_state:
+
+        # Initialize the per-session agent state on top of the shared, process-wide resources
+        PLANT_DATA = get_plant_data()
+        catalogue = get_plant_catalogue()
+        prompt_library = get_prompt_library(catalogue.version, PLANT_DATA)
+        st.session_state.agent = BotanicalGuideAgent(
+            PLANT_DATA, catalogue.plant_sequence, catalogue.voice_options,
+            reading_cache=get_reading_cache(), semantic_cache=get_semantic_cache(), prefetcher=get_prefetcher(), streaming=True,
+            prompt_library=prompt_library, pregenerated=get_pregenerated_readings(catalogue.version, prompt_library),
+            intent_classifier=get_intent_classifier(catalogue.version, catalogue), catalogue_version=catalogue.version
+        )
+        st.session_state.older_shown = 0
+        if saved_session is not None:
+            st.session_state.agent.restore_state(AgentState(**saved_session['agent']))
+            st.session_state.history = ChatHistory.from_state(saved_session['history'])
+            st.session_state.revision = saved_session['revision']
+        else:
+            st.session_state.history = ChatHistory()
+            st.session_state.history.append("agent", st.session_state.agent.respond(""))
+            st.session_state.revision = 0
+            if session_store is not None:
+                session_store.save(session_id, session_state_payload(st.session_state.agent, st.session_state.history, 0))
+
+    # 4. Display Chat History (only the tail; older messages are decompressed on request)
+    history = st.session_state.history
+    with tracer.span("render.history"):
+        if history.older_count:
+            with st.expander(f"Older messages ({history.older_count})"):
+                if st.session_state.older_shown < history.older_count and st.button("Load older messages"):
+                    st.session_state.older_shown += HISTORY_PAGE_SIZE
+                for role, content in history.older(st.session_state.older_shown) if st.session_state.older_shown else ():
+                    with st.chat_message(role):
+                        st.markdown(content)
+                if history.dropped:
+                    st.caption(f"{history.dropped} earlier messages are no longer kept.")
+
+        for role, content in history.tail:
+            with st.chat_message(role):
+                st.markdown(content)
+
+    # 5. Handle User Input
+    if prompt := st.chat_input("Enter your command (e.g., 'elder', 'continue', 'next plant', 'ginger')..."):
+        # Add user prompt to history
+        history.append("user", prompt)
+
+        # Display user message immediately
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        # Get agent response
+        with st.chat_message("agent"):
+            # Part 1 is rendered token by token while it streams in, then replaced by the full response
+            placeholder = st.empty()
+            st.session_state.agent.stream_handler = lambda text: placeholder.markdown(text + " ▌")
+            with tracer.turn("turn"):
+                try:
+                    # The agent's respond method handles all the logic and LLM calls
+                    response = st.session_state.agent.respond(prompt)
+                finally:
+                    st.session_state.agent.stream_handler = None
+                with tracer.span("render"):
+                    placeholder.markdown(response)
+
+            # Update history with agent's response
+            history.append("agent", response)
+
+        if session_store is not None:
+            st.session_state.revision += 1
+            session_store.save(session_id, session_state_payload(st.session_state.agent, history, st.session_state.revision))
+
+# ======================================================================
+# 24. COMMAND-LINE ENTRY POINTS
+# ======================================================================
+
+# Runs in a fresh interpreter so every measurement is a true cold start
+STARTUP_BENCH_SNIPPET = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+plant_data = app.load_and_structure_plant_data(app.DOC_TEXT, app.PLANT_SEQUENCE, app.VOICE_MAPPING)
+prompt_library = app.PromptLibrary(plant_data)
+agent = app.BotanicalGuideAgent(plant_data, app.PLANT_SEQUENCE, app.VOICE_OPTIONS, prompt_library=prompt_library)
+agent.respond("")
+t2 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'setup_ms': (t2 - t1) * 1000,
+    'heavy_modules': [m for m in ('pandas', 'openai', 'httpx') if m in sys.modules],
+}))
+"""
+
+
+def run_startup_benchmark(runs: int = 5) -> dict:
+    """Measures module import time and first-session setup time over several cold interpreter starts."""
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-c", STARTUP_BENCH_SNIPPET],
+            cwd=app_dir, capture_output=True, text=True, check=True
+        )
+        samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    report = {
+        'runs': runs,
+        'import_ms_median': statistics.median(s['import_ms'] for s in samples),
+        'import_ms_max': max(s['import_ms'] for s in samples),
+        'setup_ms_median': statistics.median(s['setup_ms'] for s in samples),
+        'heavy_modules_loaded': samples[-1]['heavy_modules'],
+    }
+    print(f"[STARTUP BENCHMARK] {json.dumps(report, indent=2)}")
+    return report
+
+
+STUB_READING = (
+    "**Part 1: History and Origin**\nA stub reading about where this plant comes from.\n\n"
+    "**Part 2: Key Features and Uses**\nA stub reading about how this plant is used.\n\n"
+    "**Part 3: Scientific Details and Context**\nA stub reading about what research says."
+)
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint (plain and streamed) for local testing."""
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse by the client pool is observable
+
+    def setup(self):
+        super().setup()
+        with self.server.stats_lock:
+            self.server.stats['connections'] += 1
+
+    def do_GET(self):
+        # /stats: how many connections were opened for how many requests
+        with self.server.stats_lock:
+            self._send_json(dict(self.server.stats))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server.stats_lock:
+            self.server.stats['requests'] += 1
+        time.sleep(self.server.latency)
+
+        usage = {'prompt_tokens': 400, 'completion_tokens': 120, 'total_tokens': 520}
+        if not body.get("stream"):
+            self._send_json({
+                'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': body.get("model", MODEL_ID),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': STUB_READING}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = STUB_READING.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == len(words) - 1 else word + " "
+            self._send_event({'id': 'stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': MODEL_ID,
+                              'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]})
+        self._send_event({'id': 'stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': MODEL_ID,
+                          'choices': [], 'usage': usage})
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+    def _send_json(self, payload: dict) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, payload: dict) -> None:
+        self._send_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+    def _send_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output readable
+
+
+def make_stub_llm_server(host: str = "127.0.0.1", port: int = 8765, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Builds (but does not start) the stub server; point OPENROUTER_BASE_URL at http://host:port/v1."""
+    server = ThreadingHTTPServer((host, port), StubLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.stats = {'connections': 0, 'requests': 0}
+    server.stats_lock = threading.Lock()
+    return server
+
+
+def configure_client_from_env() -> bool:
+    """Configures the shared LLM client from OPENROUTER_API_KEY (and OPENROUTER_BASE_URL) for CLI use."""
+    api_key = os.environ.get("OPENROUTER_API_KEY")
+    if not api_key:
+        print("[CONFIG ERROR] Set OPENROUTER_API_KEY (and optionally OPENROUTER_BASE_URL) in the environment.")
+        return False
+    get_client_manager().configure(api_key=api_key, base_url=OPENROUTER_BASE_URL)
+    return True
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Command-line tools that run outside the Streamlit server."""
+
+    parser = argparse.ArgumentParser(description="Botanical Guide Agent tools (use `streamlit run app.py` for the app).")
+    commands = parser.add_subparsers(dest="command")
+
+    check_catalogue = commands.add_parser("check-catalogue", help="Validate a plant catalogue and list every bad entry.")
+    check_catalogue.add_argument("path", nargs="?", default=PLANT_CATALOGUE_PATH or None,
+                                 help="A .txt, .jsonl or .csv catalogue (default: PLANT_CATALOGUE_PATH, else the built-in one).")
+
+    bench_startup = commands.add_parser("bench-startup", help="Measure cold import and first-session setup time.")
+    bench_startup.add_argument("--runs", type=int, default=5)
+
+    eval_semantic = commands.add_parser("eval-semantic-cache", help="Replay a logged question corpus and report semantic cache hit rates.")
+    eval_semantic.add_argument("corpus", nargs="?", default=QUESTION_LOG_PATH or None,
+                               help="JSONL of {plant, voice, kind, question[, group]} (default: QUESTION_LOG_PATH).")
+    eval_semantic.add_argument("--threshold", type=float, action="append",
+                               help=f"Similarity threshold(s) to compare (default: {SEMANTIC_CACHE_THRESHOLD}).")
+
+    serve_api_command = commands.add_parser("serve-api", help="Serve the agent as an async HTTP/JSON (and SSE) API.")
+    serve_api_command.add_argument("--host", default="127.0.0.1")
+    serve_api_command.add_argument("--port", type=int, default=8080)
+
+    stub_llm = commands.add_parser("stub-llm", help="Serve a local OpenAI-compatible stub for offline testing.")
+    stub_llm.add_argument("--host", default="127.0.0.1")
+    stub_llm.add_argument("--port", type=int, default=8765)
+    stub_llm.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering.")
+
+    pregenerate = commands.add_parser("pregenerate", help="Materialize every (plant, voice) reading to a JSONL artifact.")
+    pregenerate.add_argument("--output", default=PREGENERATED_READINGS_PATH)
+    pregenerate.add_argument("--workers", type=int, default=4)
+    pregenerate.add_argument("--retries", type=int, default=3)
+    pregenerate.add_argument("--fresh", action="store_true", help="Discard the existing artifact instead of resuming.")
+    pregenerate.add_argument("--batch-size", type=int, default=READING_BATCH_SIZE, help="Readings per LLM call (1 = one call each).")
+
+    bench = commands.add_parser("bench", help="Replay recorded tours against a deterministic fake LLM.")
+    bench.add_argument("--sessions", type=int, default=10, help="Concurrent visitor sessions.")
+    bench.add_argument("--script", choices=sorted(BENCH_TOUR_SCRIPTS), action="append", help="Tour script(s) to replay (default: all).")
+    bench.add_argument("--latency", type=float, default=0.5, help="Seconds to first token.")
+    bench.add_argument("--token-rate", type=float, default=50.0, help="Completion tokens per second.")
+    bench.add_argument("--completion-tokens", type=int, default=300)
+    bench.add_argument("--malformed-rate", type=float, default=0.0)
+    bench.add_argument("--error-rate", type=float, default=0.0)
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--streaming", action="store_true")
+    bench.add_argument("--cache", action="store_true", help="Use a (temporary) reading cache and a semantic cache.")
+    bench.add_argument("--prefetch", action="store_true", help="Prefetch the next plant in the background.")
+
+    args = parser.parse_args(argv)
+    if args.command == "bench":
+        fake = FakeLLM(args.latency, args.token_rate, args.completion_tokens, args.malformed_rate, args.error_rate, args.seed)
+        run_benchmark(fake, args.sessions, args.script, args.streaming, args.cache, args.prefetch)
+    elif args.command == "pregenerate":
+        if not configure_client_from_env():
+            sys.exit(1)
+        run_pregeneration(args.output, args.workers, args.retries, args.fresh, args.batch_size)
+    elif args.command == "check-catalogue":
+        catalogue = PlantCatalogue(args.path)
+        catalogue.MAX_PRINTED_ISSUES = sys.maxsize  # List every issue, not just the first few
+        catalogue.refresh()
+        print(f"Plants: {len(catalogue.plant_sequence)}; voices: {', '.join(catalogue.voice_options)}")
+        if not len(catalogue.index):
+            sys.exit(1)
+    elif args.command == "bench-startup":
+        run_startup_benchmark(args.runs)
+    elif args.command == "eval-semantic-cache":
+        if not args.corpus:
+            print("[CONFIG ERROR] Pass a question corpus, or set QUESTION_LOG_PATH to one.")
+            sys.exit(1)
+        evaluate_semantic_cache(args.corpus, args.threshold or [SEMANTIC_CACHE_THRESHOLD])
+    elif args.command == "serve-api":
+        if not configure_client_from_env():
+            sys.exit(1)
+        try:
+            asyncio.run(serve_api(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "stub-llm":
+        server = make_stub_llm_server(args.host, args.port, args.latency)
+        print(f"Stub LLM listening; set OPENROUTER_BASE_URL=http://{args.host}:{args.port}/v1")
+        server.serve_forever()
+    else:
+        parser.print_help()
 
-            # Update history with agent's response
-            st.session_state.messages.append({"role": "agent", "content": response})
 
 # Run the app function when the script starts
 if __name__ == "__main__":
-    run_streamlit_app()
+    if st.runtime.exists():
+        run_streamlit_app()
+    else:
+        main()
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TRACE_LOG_PATH", "")
+
+import app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def plant_data():
+    return app.load_and_structure_plant_data(app.DOC_TEXT, app.PLANT_SEQUENCE, app.VOICE_MAPPING)
+
+
+@pytest.fixture
+def fake_llm():
+    """A FakeLLM with no latency, routed to by every generate_llm_response* call."""
+    fake = app.FakeLLM(latency=0.0, tokens_per_second=1e9)
+    with app.fake_llm_backend(fake):
+        yield fake
+
+
+@pytest.fixture
+def budgeter(monkeypatch):
+    """A fresh process-wide token budgeter, so tests don't share learned lengths or usage."""
+    budgeter = app.TokenBudgeter()
+    monkeypatch.setattr(app, "get_token_budgeter", lambda: budgeter)
+    return budgeter
+
+
+@pytest.fixture
+def make_agent(plant_data, budgeter):
+    def make(**kwargs):
+        kwargs.setdefault("tracer", app.Tracer(None))
+        return app.BotanicalGuideAgent(plant_data, app.PLANT_SEQUENCE, app.VOICE_OPTIONS, token_budgeter=budgeter, **kwargs)
+    return make
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path, fake_llm, budgeter):
+    reading_cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+    prefetcher = app.ReadingPrefetcher()
+    monkeypatch.setattr(app, "get_reading_cache", lambda: reading_cache)
+    monkeypatch.setattr(app, "get_semantic_cache", lambda: app.SemanticCache())
+    monkeypatch.setattr(app, "get_prefetcher", lambda: prefetcher)
+    monkeypatch.setattr(app, "READING_BATCH_SIZE", 1)
+    api = app.GuideAPI(session_store=app.SessionStore(),
+                       llm_service=app.AsyncLLMService(max_concurrency=1, requests_per_minute=0))
+    yield api
+    prefetcher.shutdown()
+    reading_cache.close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_session_lifecycle(api):
+    async def tour():
+        status, created = await api.dispatch("POST", "/sessions", {})
+        session_id = created["session_id"]
+        turn = await api.dispatch("POST", f"/sessions/{session_id}/respond", {"input": "elder"})
+        more = await api.dispatch("POST", f"/sessions/{session_id}/continue", {})
+        state = await api.dispatch("GET", f"/sessions/{session_id}", {})
+        deleted = await api.dispatch("DELETE", f"/sessions/{session_id}", {})
+        return status, created, turn, more, state, deleted
+
+    status, created, turn, more, state, deleted = run(tour())
+
+    assert status == 201 and "Welcome" in created["response"]
+    assert turn[0] == 200 and turn[1]["voice"] == "elder" and turn[1]["reading_step"] == 1
+    assert more[1]["reading_step"] == 2 and more[1]["revision"] == 2
+    assert state[1]["plant"] == app.PLANT_SEQUENCE[0] and state[1]["revision"] == 2
+    assert deleted == (200, {"session_id": created["session_id"], "deleted": True})
+
+
+@pytest.mark.parametrize("method, path, body, status", [
+    ("GET", "/sessions/missing", {}, 404),
+    ("POST", "/sessions/missing/respond", {"input": "hi"}, 404),
+    ("GET", "/nowhere", {}, 404),
+])
+def test_errors(api, method, path, body, status):
+    with pytest.raises(app.APIError) as error:
+        run(api.dispatch(method, path, body))
+    assert error.value.status == status
+
+
+def test_respond_requires_string_input(api):
+    async def turn():
+        _, created = await api.dispatch("POST", "/sessions", {})
+        await api.dispatch("POST", f"/sessions/{created['session_id']}/respond", {"input": 3})
+
+    with pytest.raises(app.APIError) as error:
+        run(turn())
+    assert error.value.status == 400
+
+
+def test_health_and_metrics(api):
+    assert run(api.dispatch("GET", "/health", {}))[1]["status"] == "ok"
+    status, metrics = run(api.dispatch("GET", "/metrics", {}))
+    assert status == 200 and "tokens" in metrics and "semantic_cache" in metrics
+
+
+def test_streamed_turn_and_prefetch_go_through_the_service(api, fake_llm):
+    partials = []
+
+    async def tour():
+        _, created = await api.dispatch("POST", "/sessions", {})
+        payload = await api.respond(created["session_id"], "elder", on_partial=partials.append)
+        # Wait for the next plant's prefetch, which runs on the prefetch pool after the turn
+        jobs = list(app.get_prefetcher()._jobs.values())
+        await asyncio.to_thread(lambda: [future.result(timeout=5) for future in jobs])
+        return payload
+
+    payload = run(tour())
+
+    assert payload["reading_step"] == 1
+    assert fake_llm.calls == 2  # The streamed reading and the next plant's prefetch
+    assert api.llm_service.upstream_calls == 2
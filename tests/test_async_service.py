@@ -0,0 +1,149 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+class ServerError(Exception):
+    status_code = 503
+
+
+class ScriptedClient:
+    """An async chat client whose first request per prompt fails when asked to, and which tracks concurrency."""
+
+    def __init__(self, fail_first=(), latency=0.05):
+        self.fail_first = set(fail_first)
+        self.latency = latency
+        self.active = 0
+        self.max_active = 0
+        self.finished = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, timeout, **options):
+        prompt = messages[0]["content"]
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.latency)
+            if prompt in self.fail_first:
+                self.fail_first.discard(prompt)
+                raise ServerError("unavailable")
+            self.finished.append(prompt)
+            message = SimpleNamespace(content=f"reading for {prompt}")
+            return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=message, finish_reason="stop")])
+        finally:
+            self.active -= 1
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = ScriptedClient(fail_first={"a"})
+    monkeypatch.setattr(app, "get_client_manager", lambda: SimpleNamespace(get_async=lambda: client))
+    monkeypatch.setattr(app, "get_resilient_llm", lambda: app.ResilientLLM(models=["m"], max_retries=1))
+    monkeypatch.setattr(app.ResilientLLM, "backoff_delay", staticmethod(lambda attempt: 0.3))
+    return client
+
+
+def test_limiter_slot_is_taken_per_attempt_not_held_across_backoff(client):
+    async def run():
+        service = app.AsyncLLMService(max_concurrency=1, requests_per_minute=0)
+        return service, await asyncio.gather(service.generate("a", "hi"), service.generate("b", "hi"))
+
+    service, (first, second) = asyncio.run(run())
+
+    assert first == "reading for a" and second == "reading for b"
+    assert client.finished == ["b", "a"]  # "b" ran while "a" was backing off
+    assert service.upstream_calls == 3  # Both of "a"'s attempts are metered
+    assert client.max_active == 1
+
+
+def test_hedged_request_takes_its_own_slot(client, monkeypatch):
+    client.fail_first.clear()
+    llm = app.ResilientLLM(models=["m"], hedge_percentile=50, hedge_min_samples=1)
+    llm._observe_latency("m", 0.01)
+    monkeypatch.setattr(app, "get_resilient_llm", lambda: llm)
+
+    async def run():
+        service = app.AsyncLLMService(max_concurrency=2, requests_per_minute=0)
+        await service.generate("a", "hi")
+        return service
+
+    service = asyncio.run(run())
+
+    assert service.upstream_calls == 2
+    assert client.max_active == 2
+
+
+def test_concurrent_identical_requests_make_one_llm_call():
+    fake = app.FakeLLM(latency=0.05, tokens_per_second=1e9)
+
+    async def run():
+        service = app.AsyncLLMService(max_concurrency=4, requests_per_minute=0)
+        replies = await asyncio.gather(*(service.generate("same prompt", "hi") for _ in range(8)))
+        return service, replies
+
+    with app.fake_llm_backend(fake):
+        service, replies = asyncio.run(run())
+
+    assert fake.calls == 1
+    assert service.single_flight.coalesced == 7
+    assert len(set(replies)) == 1
+
+
+def test_one_caller_giving_up_does_not_cancel_the_shared_call():
+    fake = app.FakeLLM(latency=0.05, tokens_per_second=1e9)
+
+    async def run():
+        service = app.AsyncLLMService(max_concurrency=1, requests_per_minute=0)
+        impatient = asyncio.ensure_future(service.generate("same prompt", "hi"))
+        patient = asyncio.ensure_future(service.generate("same prompt", "hi"))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        return await patient
+
+    with app.fake_llm_backend(fake):
+        reply = asyncio.run(run())
+
+    assert fake.calls == 1
+    assert not reply.startswith("[")
+
+
+def test_limiter_never_exceeds_its_slots():
+    active = max_active = 0
+
+    async def call(limiter):
+        nonlocal active, max_active
+        async with limiter:
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    async def run():
+        limiter = app.AsyncRateLimiter(max_concurrency=3, requests_per_minute=0)
+        await asyncio.gather(*(call(limiter) for _ in range(12)))
+
+    asyncio.run(run())
+
+    assert max_active == 3
+
+
+def test_limiter_spaces_starts_to_the_rate():
+    async def run():
+        limiter = app.AsyncRateLimiter(max_concurrency=10, requests_per_minute=600)  # One start per 0.1 s
+        loop = asyncio.get_running_loop()
+        starts = []
+
+        async def call():
+            async with limiter:
+                starts.append(loop.time())
+
+        await asyncio.gather(*(call() for _ in range(4)))
+        return starts
+
+    starts = asyncio.run(run())
+
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    assert all(gap >= 0.09 for gap in gaps)
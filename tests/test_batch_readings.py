@@ -0,0 +1,86 @@
+import pytest
+
+import app
+
+
+def reading(name):
+    return (f"**Part 1: History and Origin**\n{name} one.\n**Part 2: Key Features and Uses**\n{name} two.\n"
+            f"**Part 3: Scientific Details and Context**\n{name} three.\n")
+
+
+def batch(*numbered):
+    return "".join(f"=== READING {number} ===\n{reading(name)}" for number, name in numbered)
+
+
+@pytest.fixture
+def rows(plant_data):
+    return [plant_data.get(plant, "elder") for plant in ("cacao", "tea", "mate")]
+
+
+@pytest.fixture
+def llm(monkeypatch, rows):
+    """Answers the batch call with the scripted reply and a single-plant call with a reading named after its plant."""
+    calls = []
+    single_prompts = {app.build_system_prompt(row): row.plant for row in rows}
+
+    def generate(system_prompt, user_input="", max_tokens=app.MAX_TOKENS, json_output=False, upstream_slot=None):
+        calls.append(system_prompt)
+        if system_prompt in single_prompts:
+            return app.LLMText(reading(f"Alone {single_prompts[system_prompt]}"), "stop", {})
+        return app.LLMText(llm.batch_reply, llm.finish_reason, {})
+
+    llm.calls, llm.finish_reason = calls, "stop"
+    monkeypatch.setattr(app, "generate_llm_response", generate)
+    return llm
+
+
+def test_split_follows_the_delimiter_numbers():
+    raw = batch((2, "Tea"), (1, "Cacao"), (2, "Tea again"))
+
+    readings = app.split_batch_readings(raw, 3)
+
+    assert "Cacao one." in readings[0]
+    assert "Tea one." in readings[1] and "again" not in readings[1]  # The first READING 2 wins
+    assert readings[2] == ""
+
+
+def test_reordered_batch_reply_is_matched_by_number(rows, llm, budgeter):
+    llm.batch_reply = batch((3, "Mate"), (1, "Cacao"), (2, "Tea"))
+
+    results = app.fetch_reading_batch(rows, app.GENERIC_READING_INPUT)
+
+    assert [parts[0] for parts in results] == ["Cacao one.", "Tea one.", "Mate one."]
+    assert len(llm.calls) == 1
+
+
+def test_dropped_plant_is_generated_alone(rows, llm, budgeter, tmp_path):
+    llm.batch_reply = batch((1, "Cacao"), (3, "Mate"))
+    cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+
+    results = app.fetch_reading_batch(rows, app.GENERIC_READING_INPUT, reading_cache=cache)
+
+    assert [parts[0] for parts in results] == ["Cacao one.", "Alone tea one.", "Mate one."]
+    assert len(llm.calls) == 2
+    # Each reading is cached under its own single-plant prompt
+    for row, parts in zip(rows, results):
+        assert cache.get(app.ReadingCache.make_key(app.build_system_prompt(row), app.GENERIC_READING_INPUT)) == parts
+    cache.close()
+
+
+def test_dropped_plant_is_left_out_without_fallback(rows, llm, budgeter):
+    llm.batch_reply = batch((2, "Tea"), (1, "Cacao"))
+
+    results = app.fetch_reading_batch(rows, app.GENERIC_READING_INPUT, fallback=False)
+
+    assert results[2] is None
+    assert [parts[0] for parts in results[:2]] == ["Cacao one.", "Tea one."]
+    assert len(llm.calls) == 1
+
+
+def test_reading_cut_off_by_the_token_limit_is_regenerated(rows, llm, budgeter):
+    llm.batch_reply = batch((1, "Cacao"), (2, "Tea"), (3, "Mate"))
+    llm.finish_reason = "length"
+
+    results = app.fetch_reading_batch(rows, app.GENERIC_READING_INPUT)
+
+    assert [parts[0] for parts in results] == ["Cacao one.", "Tea one.", "Alone mate one."]
@@ -0,0 +1,88 @@
+import json
+
+import app
+
+
+def jsonl_entry(name="Ginger", **notes):
+    return json.dumps({"name": name, "latin_name": "Zingiber officinale", "region": "Asia",
+                       "parts_used": "Root", "notes": notes or {"elder": "Warming.", "child": "Spicy root."}})
+
+
+def load(path):
+    catalogue = app.PlantCatalogue(str(path))
+    index = catalogue.refresh()
+    return catalogue, index
+
+
+def test_doc_text_loads_every_plant(plant_data):
+    assert {record.plant for record in plant_data} == set(app.PLANT_SEQUENCE)
+
+
+def test_jsonl_note_values_that_are_not_strings(tmp_path):
+    path = tmp_path / "plants.jsonl"
+    path.write_text("\n".join([
+        jsonl_entry("Ginger", elder=5, child="Spicy root."),
+        jsonl_entry("Cacao", elder=None, child="Chocolate!"),
+    ]) + "\n", encoding="utf-8")
+
+    catalogue, index = load(path)
+
+    assert index.get("ginger", "elder").note == "5"
+    assert index.get("cacao", "elder") is None
+    assert index.get("cacao", "child").note == "Chocolate!"
+    assert any("cacao: missing Elder Herbalist note" in str(issue) for issue in catalogue.issues)
+
+
+def test_non_utf8_bytes_are_reported_not_fatal(tmp_path):
+    for name, content in [
+        ("plants.csv", b"name,latin_name,elder_herbalist\nGinger,Zingiber,Warm\xe9 root\nCacao,Theobroma,Bitter\n"),
+        ("plants.txt", b"1. Ginger\nLatin Name: Zingiber\nElder Herbalist: Warm\xff root\n---\n2. Cacao\nElder Herbalist: Bitter\n"),
+    ]:
+        path = tmp_path / name
+        path.write_bytes(content)
+
+        catalogue, index = load(path)
+
+        assert {record.plant for record in index} == {"ginger", "cacao"}
+        assert any("not valid UTF-8" in issue.message for issue in catalogue.issues)
+
+
+def test_oversized_csv_field_skips_only_that_row(tmp_path):
+    path = tmp_path / "plants.csv"
+    path.write_text(
+        "name,latin_name,elder_herbalist\n"
+        "Ginger,Zingiber,Warm root\n"
+        f"Cacao,Theobroma,\"{'x' * 200_000}\"\n"
+        "Tea,Camellia,Leaves\n",
+        encoding="utf-8",
+    )
+
+    catalogue, index = load(path)
+
+    assert {record.plant for record in index} == {"ginger", "tea"}
+    assert any(issue.position == 3 and "unreadable CSV row" in issue.message for issue in catalogue.issues)
+
+
+def test_malformed_jsonl_line_is_an_issue(tmp_path):
+    path = tmp_path / "plants.jsonl"
+    path.write_text(jsonl_entry() + "\n{not json\n[1, 2]\n", encoding="utf-8")
+
+    catalogue, index = load(path)
+
+    assert [record.plant for record in index] == ["ginger", "ginger"]
+    assert [issue.position for issue in catalogue.issues if "missing" not in issue.message] == [2, 3]
+
+
+def test_name_containing_a_tour_key_is_a_plant_of_its_own(tmp_path):
+    path = tmp_path / "plants.jsonl"
+    path.write_text("\n".join([
+        jsonl_entry("Lemon"),
+        jsonl_entry("Lemon Balm"),
+        jsonl_entry("Ginger Lily"),
+        jsonl_entry("Yerba Maté"),
+    ]) + "\n", encoding="utf-8")
+
+    catalogue, index = load(path)
+
+    assert {record.plant for record in index} == {"lemon", "lemon balm", "ginger lily", "mate"}
+    assert not any("duplicate" in issue.message for issue in catalogue.issues)
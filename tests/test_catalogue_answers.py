@@ -0,0 +1,71 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def agent(make_agent, fake_llm):
+    agent = make_agent()
+    agent.respond("elder")
+    return agent
+
+
+def test_safety_question_without_a_matching_caution_claims_no_absence(agent):
+    answer = agent.respond("which plants are safe for kids?")
+
+    assert "None of our plants" not in answer
+    assert "does not mean these plants are safe" in answer
+    assert "**Frankincense**" in answer  # Every listed caution is shown instead
+    assert "not medical advice" in answer
+
+
+def test_safety_question_hedges_about_plants_without_a_match(agent):
+    answer = agent.respond("which plants should I avoid when pregnant?")
+
+    assert "**Tea**" in answer and "**Frankincense**" in answer
+    assert "No specific caution" not in answer
+    assert "does not mean they are safe" in answer
+
+
+def test_vague_words_alone_do_not_match_a_note(agent):
+    answer = agent.respond("which plants are good for digestion?")
+
+    assert "Plants in our garden that mention **digestion**" in answer
+    assert "**Cardamom**" not in answer  # Its note only shares "good" with the question
+
+
+def test_question_with_no_topic_match_is_reported_as_not_found(agent):
+    answer = agent.respond("which plants are good for astronauts?")
+
+    assert answer.startswith("I couldn't find anything about **astronaut**")
+
+
+def test_weak_matches_are_dropped(agent, monkeypatch):
+    monkeypatch.setattr(app, "CATALOGUE_MIN_SCORE", 100.0)
+
+    answer = agent.respond("which plants have caffeine?")
+
+    assert answer.startswith("I couldn't find anything about **caffeine**")
+
+
+def test_topic_match_still_answers_locally(agent, fake_llm):
+    calls = fake_llm.calls
+
+    answer = agent.respond("which plants have caffeine?")
+
+    assert "**Cacao**" in answer and "**Tea**" in answer and "**Mate**" in answer
+    assert fake_llm.calls == calls
+
+
+@pytest.mark.parametrize("plural, singular", [
+    ("leaves", "leaf"), ("berries", "berry"), ("seeds", "seed"), ("cloves", "clove"), ("knives", "knife"), ("glass", "glass"),
+])
+def test_plurals_fold_to_the_singular(plural, singular):
+    assert app.catalogue_terms(plural) == app.catalogue_terms(singular) == [singular]
+
+
+def test_plural_question_matches_a_singular_field(agent):
+    answer = agent.respond("which plants use the leaves?")
+
+    assert "**Bay leaf** (Parts Used): Leaf" in answer
+    assert "**Tea**" in answer and "**Mate**" in answer
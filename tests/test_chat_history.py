@@ -0,0 +1,52 @@
+import json
+
+import app
+
+
+def messages(count, start=0):
+    return [("user" if i % 2 == 0 else "assistant", f"message {i}") for i in range(start, start + count)]
+
+
+def fill(history, items):
+    for role, content in items:
+        history.append(role, content)
+    return history
+
+
+def test_messages_spill_into_pages_and_the_oldest_are_dropped():
+    sent = messages(25)
+    history = fill(app.ChatHistory(visible=3, max_messages=10, page_size=2), sent)
+
+    assert list(history.tail) == sent[-3:]
+    assert len(history) <= 10
+    assert history.dropped + len(history) == len(sent)
+    assert history.older() + list(history.tail) == sent[history.dropped:]  # Oldest first, nothing reordered
+    assert history.older(limit=3) == sent[-6:-3]
+
+
+def test_state_round_trip_keeps_pages_order_and_limits():
+    sent = messages(25)
+    history = fill(app.ChatHistory(visible=3, max_messages=10, page_size=2), sent)
+
+    restored = app.ChatHistory.from_state(json.loads(json.dumps(history.to_state())))
+
+    assert list(restored.tail) == list(history.tail)
+    assert restored.older() == history.older()
+    assert restored.dropped == history.dropped
+
+    # Both go on spilling, paging and dropping the same way
+    more = messages(9, start=25)
+    fill(history, more)
+    fill(restored, more)
+    assert restored.older() + list(restored.tail) == history.older() + list(history.tail) == (sent + more)[history.dropped:]
+    assert restored.dropped == history.dropped and len(restored) <= 10
+
+
+def test_state_saved_without_limits_gets_the_defaults():
+    state = app.ChatHistory().to_state()
+    del state['limits']
+
+    restored = app.ChatHistory.from_state(state)
+
+    assert restored.tail.maxlen == app.HISTORY_VISIBLE_MESSAGES
+    assert restored.page_size == app.HISTORY_PAGE_SIZE
@@ -0,0 +1,102 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(scope="module")
+def classifier(plant_data):
+    return app.IntentClassifier(app.PLANT_SEQUENCE, app.VOICE_OPTIONS, plant_data)
+
+
+@pytest.mark.parametrize("text, kind, value", [
+    ("continue", "continue", None),
+    ("keep going", "continue", None),
+    ("contnue", "continue", None),
+    ("next plant", "next_plant", None),
+    ("Next plant!", "next_plant", None),
+    ("move on", "next_plant", None),
+    ("yes", "affirm", None),
+    ("yes please, next plant", "next_plant", None),
+    ("no, next plant please", "next_plant", None),
+    ("switch to the kid voice please", "select_voice", "child"),
+    ("the old one", "select_voice", "elder"),
+    ("not the elder, the child voice", "select_voice", "child"),
+    ("tell me more about ginger", "goto_plant", "ginger"),
+    ("what about pepper", "goto_plant", "black pepper"),
+    ("cocoa", "goto_plant", "cacao"),
+    ("next", "next_plant", None),
+    ("back", "previous_plant", None),
+    ("go back", "previous_plant", None),
+    ("previous plant", "previous_plant", None),
+    ("bay leaves", "goto_plant", "bay leaf"),
+])
+def test_commands(classifier, text, kind, value):
+    intent = classifier.classify(text)
+    assert (intent.kind, intent.value) == (kind, value)
+    assert intent.confidence >= app.INTENT_MIN_CONFIDENCE and not intent.ambiguous
+
+
+@pytest.mark.parametrize("text", [
+    "I don't want to continue",
+    "I dont want to contnue",
+    "no more please",
+    "don't move on yet",
+    "not ginger",
+])
+def test_negated_commands_are_not_commands(classifier, text):
+    assert classifier.classify(text).kind == "open"
+
+
+@pytest.mark.parametrize("text", [
+    "does the old one have caffeine",
+    "is there evidence it lowers cholesterol?",
+    "is ginger good for nausea",
+    "how old is this tea?",
+    "is it good for back pain?",
+])
+def test_commands_mentioned_in_questions_are_not_decisive(classifier, text):
+    intent = classifier.classify(text)
+    assert intent.ambiguous or intent.confidence < app.INTENT_MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize("text", ["what is the bay area like?", "my grandmother is old", "is it safe for a young plant?"])
+def test_common_words_are_not_plant_or_voice_names(classifier, text):
+    intent = classifier.classify(text)
+    assert intent.kind == "open" or intent.ambiguous or intent.confidence < app.INTENT_MIN_CONFIDENCE
+
+
+def test_a_plant_named_in_a_question_asks_before_moving(make_agent, fake_llm):
+    agent = make_agent()
+    agent.respond("elder")
+    calls = fake_llm.calls
+
+    reply = agent.respond("is ginger good for nausea")
+
+    assert agent.current_plant == "cacao" and agent.current_reading_step == 1
+    assert fake_llm.calls == calls
+    assert "Ginger" in reply and "Cacao" in reply
+
+
+def test_back_and_next_navigate(make_agent, fake_llm):
+    agent = make_agent()
+    agent.respond("elder")
+    assert "first plant" in agent.respond("previous plant")
+
+    agent.respond("next")
+    assert agent.current_reading_step == 2 and agent.current_plant == "cacao"
+
+    agent.respond("next plant")
+    agent.respond("back")
+    assert agent.current_plant == "cacao" and agent.current_reading_step == 1
+
+
+def test_negated_continue_does_not_advance_the_reading(make_agent, fake_llm):
+    agent = make_agent()
+    agent.respond("child")
+    assert agent.current_reading_step == 1
+
+    agent.respond("I don't want to continue")
+    assert agent.current_reading_step == 1
+
+    agent.respond("does the old one have caffeine")
+    assert agent.current_voice == "child" and agent.current_reading_step == 1
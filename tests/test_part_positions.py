@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import app
+
+SKIPS_PART_TWO = "Part 1: History and Origin\nA.\n\nPart 3: Scientific Details and Context\nC.\n"
+
+
+def scripted_llm(reading, repair):
+    """generate_llm_response stand-in: the reading for the first call, then `repair` for the repair call."""
+    calls = []
+
+    def generate(system_prompt, user_input="", max_tokens=app.MAX_TOKENS, json_output=False, **kwargs):
+        calls.append(system_prompt)
+        return app.LLMText(reading if len(calls) == 1 else repair, "stop", {})
+    return generate, calls
+
+
+def read_through(agent):
+    return [agent.respond("elder"), agent.respond("continue"), agent.respond("continue")]
+
+
+def test_failed_repair_keeps_later_parts_in_place(monkeypatch, make_agent, tmp_path):
+    generate, calls = scripted_llm(SKIPS_PART_TWO, "[CRITICAL LLM ERROR] still down")
+    monkeypatch.setattr(app, "generate_llm_response", generate)
+    cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+    agent = make_agent(reading_cache=cache)
+
+    first, second, third = read_through(agent)
+
+    assert "Part 1/3" in first and "A." in first
+    assert "Part 2/3" in second and app.MISSING_PART_TEXT in second
+    assert "Part 3/3" in third and "C." in third
+    assert len(calls) == 2  # The reading and one repair
+    assert cache.get(agent._reading_key) is None  # An incomplete reading is not cached
+    cache.close()
+
+
+def test_repaired_part_fills_its_own_position(monkeypatch, make_agent):
+    generate, _ = scripted_llm(SKIPS_PART_TWO, json.dumps({"part2": "B."}))
+    monkeypatch.setattr(app, "generate_llm_response", generate)
+
+    _, second, third = read_through(make_agent())
+
+    assert "Part 2/3" in second and "B." in second
+    assert "Part 3/3" in third and "C." in third
+
+
+def test_streamed_parts_wait_for_the_ones_before_them():
+    parser = app.IncrementalPartParser()
+    parser.feed("Part 1: History and Origin\nA.\n\nPart 3: Scientific Details and Context\nC is ")
+
+    assert parser.parts == ["A."]
+    assert parser.active_text() == ""  # Part 3's text is not shown as Part 2's progress
+
+    parser.feed("late.\n")
+    parser.finish()
+    assert parser.parts == ["A."]
+    assert parser.reading_parts() == ["A.", "", "C is late."]
+
+
+@pytest.mark.parametrize("repair, expected", [
+    ("[CRITICAL LLM ERROR] still down", ["A.", app.MISSING_PART_TEXT, "C."]),
+    (json.dumps({"part2": "B."}), ["A.", "B.", "C."]),
+])
+def test_streamed_reading_keeps_positions_after_repair(monkeypatch, repair, expected):
+    def stream(system_prompt, user_input="", json_output=False, max_tokens=app.MAX_TOKENS, on_finish=None, upstream_slot=None):
+        yield SKIPS_PART_TWO
+        on_finish("stop", {})
+
+    monkeypatch.setattr(app, "generate_llm_response_stream", stream)
+    monkeypatch.setattr(app, "generate_llm_response", lambda *args, **kwargs: app.LLMText(repair, "stop", {}))
+
+    reading = app.StreamingReading("prompt", "hi").start()
+    reading._thread.join(5)
+
+    assert reading.parts == expected
@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import Future
+
+import app
+
+
+class InlineExecutor:
+    """Runs each job as it is submitted, so its future is already done when submit() returns."""
+
+    def submit(self, fn):
+        future = Future()
+        future.set_result(fn())
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def run_with_timeout(fn, timeout=5.0):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('value', fn()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "deadlocked"
+    return result.get('value')
+
+
+def test_submit_of_a_job_that_finishes_instantly_does_not_deadlock():
+    prefetcher = app.ReadingPrefetcher(max_workers=1)
+    prefetcher._executor = InlineExecutor()
+
+    future = run_with_timeout(lambda: prefetcher.submit("key", lambda: ["a", "b", "c"]))
+
+    assert future.result() == ["a", "b", "c"]
+    assert "key" not in prefetcher  # Forgotten once done
+
+
+def test_submit_and_release_with_a_real_pool():
+    prefetcher = app.ReadingPrefetcher(max_workers=2)
+    try:
+        futures = [run_with_timeout(lambda i=i: prefetcher.submit(f"key{i}", lambda i=i: i)) for i in range(20)]
+        assert [future.result(timeout=5) for future in futures] == list(range(20))
+        for i in range(20):
+            run_with_timeout(lambda i=i: prefetcher.release(f"key{i}"))
+    finally:
+        prefetcher.shutdown()
+
+
+def test_cached_turn_with_exhausted_budget_schedules_prefetch_and_returns(make_agent, fake_llm, budgeter, tmp_path):
+    reading_cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+    make_agent(reading_cache=reading_cache).respond("elder")  # Caches the first reading
+
+    budgeter.global_budget_per_hour = 1  # Already used up: the prefetch job returns at once
+    prefetcher = app.ReadingPrefetcher()
+    try:
+        agent = make_agent(reading_cache=reading_cache, prefetcher=prefetcher)
+        for _ in range(5):
+            reply = run_with_timeout(lambda: agent.respond("elder"))
+            assert "Latin Name" in reply
+    finally:
+        prefetcher.shutdown()
+        reading_cache.close()
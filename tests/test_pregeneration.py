@@ -0,0 +1,83 @@
+import json
+from collections import Counter
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def artifact(tmp_path):
+    return tmp_path / "pregenerated.jsonl"
+
+
+def reading_lines(path):
+    """The artifact's reading records, without the header or a line cut off by an interruption."""
+    records = []
+    for line in path.read_text(encoding="utf-8").splitlines()[1:]:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+
+def test_interrupted_run_resumes_without_regenerating(artifact, plant_data, fake_llm):
+    app.run_pregeneration(str(artifact), workers=2, retries=0)
+    lines = artifact.read_text(encoding="utf-8").splitlines(keepends=True)
+    # Interrupted after five readings, the sixth cut off mid-line
+    artifact.write_text("".join(lines[:6]) + lines[6][:40], encoding="utf-8")
+
+    report = app.run_pregeneration(str(artifact), workers=2, retries=0)
+
+    assert report['skipped'] == 5
+    assert report['generated'] == len(plant_data) - 5
+    pairs = Counter((record['plant'], record['voice']) for record in reading_lines(artifact))
+    assert set(pairs) == {(record.plant, record.voice) for record in plant_data}
+    assert max(pairs.values()) == 1
+    assert len(app.PregeneratedReadings(str(artifact), app.PromptLibrary(plant_data))) == len(plant_data)
+
+
+def test_batches_keep_to_one_voice(artifact, plant_data, fake_llm, monkeypatch):
+    batches = []
+    fetch_reading_batch = app.fetch_reading_batch
+
+    def recording(records, *args, **kwargs):
+        batches.append([record.voice for record in records])
+        return fetch_reading_batch(records, *args, **kwargs)
+
+    monkeypatch.setattr(app, "fetch_reading_batch", recording)
+
+    report = app.run_pregeneration(str(artifact), workers=2, retries=0, batch_size=4)
+
+    assert report['generated'] == len(plant_data)
+    assert all(len(set(voices)) == 1 and len(voices) <= 4 for voices in batches)
+    assert sum(map(len, batches)) == len(plant_data)
+
+
+def test_readings_for_another_catalogue_are_ignored(artifact, plant_data, fake_llm):
+    app.run_pregeneration(str(artifact), workers=2, retries=0)
+    lines = artifact.read_text(encoding="utf-8").splitlines()
+    stale = json.loads(lines[1])
+    stale['prompt_key'] = app.ReadingCache.make_key("a prompt from an older catalogue", app.GENERIC_READING_INPUT)
+    artifact.write_text("\n".join([lines[0], json.dumps(stale)] + lines[2:]) + "\n", encoding="utf-8")
+
+    readings = app.PregeneratedReadings(str(artifact), app.PromptLibrary(plant_data))
+
+    assert (stale['plant'], stale['voice']) not in readings
+    assert len(readings) == len(plant_data) - 1
+
+    report = app.run_pregeneration(str(artifact), workers=2, retries=0)
+    assert report['generated'] == 1
+
+
+def test_artifact_with_a_stale_header_is_ignored(artifact, plant_data, fake_llm):
+    app.run_pregeneration(str(artifact), workers=2, retries=0)
+    lines = artifact.read_text(encoding="utf-8").splitlines()
+    header = dict(json.loads(lines[0]), format_version=app.PREGENERATED_FORMAT_VERSION - 1)
+    artifact.write_text("\n".join([json.dumps(header)] + lines[1:]) + "\n", encoding="utf-8")
+    calls = fake_llm.calls
+
+    assert len(app.PregeneratedReadings(str(artifact), app.PromptLibrary(plant_data))) == 0
+    assert app.run_pregeneration(str(artifact), workers=2, retries=0) == {}
+    assert fake_llm.calls == calls
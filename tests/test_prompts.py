@@ -0,0 +1,57 @@
+import pytest
+
+import app
+
+
+def test_plant_index_looks_up_every_plant_and_voice(plant_data):
+    assert len(plant_data) == len(app.PLANT_SEQUENCE) * len(app.VOICE_OPTIONS)
+    assert list(plant_data) == list(plant_data.records)
+
+    record = plant_data.get("ginger", "child")
+    assert (record.plant, record.voice, record.latin_name) == ("ginger", "child", "Zingiber officinale")
+    assert plant_data.get("ginger", "pirate") is None
+    assert plant_data.get("lemon balm", "elder") is None
+
+
+def test_plant_index_is_read_only(plant_data):
+    with pytest.raises(TypeError):
+        plant_data._by_key[("ginger", "pirate")] = plant_data.get("ginger", "elder")
+    with pytest.raises(AttributeError):
+        plant_data.extra = 1
+
+
+def test_prompt_library_builds_every_prompt_up_front(plant_data, monkeypatch):
+    library = app.PromptLibrary(plant_data)
+
+    def unexpected(record):
+        raise AssertionError("prompt built during a turn")
+
+    monkeypatch.setattr(app, "build_system_prompt", unexpected)
+
+    assert len(library) == len(plant_data)
+    for record in plant_data:
+        assert library.get(record.plant, record.voice) is library.get(record.plant, record.voice)
+    assert library.get("ginger", "pirate") is None
+
+
+def test_prompt_library_prompts_match_the_builder(plant_data):
+    library = app.PromptLibrary(plant_data)
+    record = plant_data.get("tea", "evidence")
+
+    prompt = library.get("tea", "evidence")
+
+    assert prompt == app.build_system_prompt(record)
+    assert record.note in prompt and "Camellia sinensis" in prompt
+
+
+def test_token_usage_is_traced_not_printed(capsys, monkeypatch):
+    tracer = app.Tracer(None)
+    monkeypatch.setattr(app, "get_tracer", lambda: tracer)
+    usage = type("Usage", (), {'prompt_tokens': 120, 'completion_tokens': 30, 'prompt_tokens_details': None})()
+
+    with tracer.turn("turn") as trace:
+        counts = app.log_token_usage(usage)
+
+    assert counts == {'prompt_tokens': 120, 'cached_prompt_tokens': 0, 'completion_tokens': 30}
+    assert trace.attributes == counts
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,87 @@
+import pytest
+
+import app
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"), **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.close()
+
+
+def test_entries_expire_after_the_ttl(make_cache, clock):
+    cache = make_cache(ttl_seconds=60)
+    cache.put("key", ["One.", "Two.", "Three."])
+
+    clock.now += 60
+    assert cache.contains("key")
+    assert cache.get("key") == ["One.", "Two.", "Three."]
+
+    clock.now += 1
+    assert not cache.contains("key")
+    assert cache.get("key") is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_evicted_at_the_cap(make_cache, clock):
+    cache = make_cache(max_entries=2)
+    cache.put("a", ["A"])
+    clock.now += 1
+    cache.put("b", ["B"])
+    clock.now += 1
+    cache.get("a")  # "b" is now the least recently used
+    clock.now += 1
+    cache.put("c", ["C"])
+
+    assert cache.contains("a") and cache.contains("c")
+    assert not cache.contains("b")
+    assert cache.stats()['entries'] == 2
+
+
+def test_entries_survive_reopening(make_cache):
+    make_cache().put("key", ["Kept."])
+    assert make_cache().get("key") == ["Kept."]
+
+
+def test_stats_count_hits_and_misses(make_cache):
+    cache = make_cache()
+    cache.put("key", ["One."])
+    cache.get("key")
+    cache.get("key")
+    cache.get("other")
+    cache.contains("other")  # Not a lookup
+
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'entries': 1}
+
+
+@pytest.mark.parametrize("failure", [{"error_rate": 1.0}, {"malformed_rate": 1.0}])
+def test_failed_readings_are_not_cached(make_agent, make_cache, failure):
+    cache = make_cache()
+    with app.fake_llm_backend(app.FakeLLM(latency=0.0, tokens_per_second=1e9, **failure)):
+        reply = make_agent(reading_cache=cache).respond("elder")
+
+    assert "Please try another command or quit." in reply
+    assert cache.stats()['entries'] == 0
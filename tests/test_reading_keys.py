@@ -0,0 +1,56 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def reading_cache(tmp_path):
+    cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+    yield cache
+    cache.close()
+
+
+@pytest.mark.parametrize("advance", ["next plant", "Next plant!", "move on", "next one"])
+def test_navigation_phrasings_share_one_cached_reading(make_agent, fake_llm, reading_cache, advance):
+    first = make_agent(reading_cache=reading_cache)
+    first.respond("elder")
+    first.respond("next plant")
+    calls = fake_llm.calls
+
+    second = make_agent(reading_cache=reading_cache)
+    second.respond("elder")
+    second.respond(advance)
+
+    assert fake_llm.calls == calls
+    assert second.current_plant == first.current_plant
+
+
+@pytest.mark.parametrize("advance", ["next plant", "move on", "yes"])
+def test_prefetch_serves_any_navigation_phrasing(make_agent, fake_llm, reading_cache, monkeypatch, advance):
+    monkeypatch.setattr(app, "READING_BATCH_SIZE", 1)
+    prefetcher = app.ReadingPrefetcher()
+    try:
+        agent = make_agent(reading_cache=reading_cache, prefetcher=prefetcher)
+        agent.respond("elder")
+        for _ in range(2):
+            agent.respond("continue")  # Through Part 3 to "Ready for the next plant?"
+        assert agent.current_reading_step == 0
+
+        agent.respond(advance)
+
+        assert agent.current_plant == app.PLANT_SEQUENCE[1]
+        assert fake_llm.calls == 2  # The first reading and the prefetch; the turn itself made no call
+    finally:
+        prefetcher.shutdown()
+
+
+def test_questions_are_still_keyed_by_their_text(make_agent, fake_llm, reading_cache):
+    agent = make_agent(reading_cache=reading_cache)
+    agent.respond("elder")
+    for _ in range(2):
+        agent.respond("continue")
+    calls = fake_llm.calls
+
+    agent.respond("what does it smell like?")
+
+    assert fake_llm.calls == calls + 1
@@ -0,0 +1,70 @@
+import pytest
+
+import app
+
+EXPECTED = ["A is old.", "B is useful.", "C is studied."]
+
+READING_FORMATS = {
+    'bold labels (the prompted format)': (
+        "**Part 1: History and Origin**\nA is old.\n\n**Part 2: Key Features and Uses**\nB is useful.\n\n"
+        "**Part 3: Scientific Details and Context**\nC is studied."
+    ),
+    'text on the label line after a title': (
+        "Part 1: History and Origin - A is old.\nPart 2: Key Features and Uses - B is useful.\n"
+        "Part 3: Scientific Details and Context - C is studied."
+    ),
+    'plain label lines': (
+        "Part 1: History and Origin\nA is old.\nPart 2: Key Features and Uses\nB is useful.\n"
+        "Part 3: Scientific Details and Context\nC is studied."
+    ),
+    'markdown headings': (
+        "### Part 1: History and Origin\nA is old.\n\n### Part 2: Key Features and Uses\nB is useful.\n\n"
+        "### Part 3: Scientific Details and Context\nC is studied.\n"
+    ),
+    'bold headings with the title outside the bold': (
+        "## **Part 1:** History and Origin\nA is old.\n## **Part 2:** Key Features and Uses\nB is useful.\n"
+        "## **Part 3:** Scientific Details and Context\nC is studied."
+    ),
+    'other titles in bold': (
+        "**Part 1: Where It Came From**\nA is old.\n**Part 2: Uses**\nB is useful.\n**Part 3: Science**\nC is studied."
+    ),
+    'labels without titles': "Part 1: A is old.\nPart 2: B is useful.\nPart 3: C is studied.",
+    'labels on one line': (
+        "**Part 1: History and Origin** A is old. **Part 2: Key Features and Uses** B is useful. "
+        "**Part 3: Scientific Details and Context** C is studied."
+    ),
+}
+
+
+@pytest.mark.parametrize("raw", READING_FORMATS.values(), ids=READING_FORMATS.keys())
+def test_parse_reading_parts(raw):
+    assert app.parse_reading_parts(raw) == EXPECTED
+
+
+@pytest.mark.parametrize("raw", READING_FORMATS.values(), ids=READING_FORMATS.keys())
+def test_streamed_parse_matches_whole_parse(raw):
+    parser = app.IncrementalPartParser()
+    for char in raw:
+        parser.feed(char)
+    parser.feed("\n")
+    parser.finish()
+    assert parser.reading_parts() == EXPECTED
+
+
+def test_mention_of_a_part_in_the_text_is_not_a_label():
+    raw = "Part 1: History and Origin\nAs we will see in Part 2 of the story, A is old.\nPart 2: Uses\nB.\nPart 3: Science\nC."
+    assert app.parse_reading_parts(raw) == ["As we will see in Part 2 of the story, A is old.", "B.", "C."]
+
+
+def test_parts_out_of_order_are_placed_by_number():
+    raw = "Part 2: Uses\nB.\nPart 1: History\nA.\nPart 3: Science\nC."
+    assert app.parse_reading_parts(raw) == ["A.", "B.", "C."]
+
+
+def test_unlabelled_text_has_no_parts():
+    assert app.parse_reading_parts("Lorem ipsum dolor sit amet.") == ["", "", ""]
+
+
+def test_json_readings():
+    raw = '```json\n{"part1": "A is old.", "part2": "B is useful.", "part3": "C is studied."}\n```'
+    assert app.parse_reading_parts(raw) == EXPECTED
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def test_timeouts_keep_the_baseline_ceiling():
+    llm = app.ResilientLLM(models=["m"])
+    timeouts = []
+
+    llm.call(lambda model, timeout: timeouts.append(timeout) or "ok")
+
+    assert llm.attempt_timeout == llm.deadline_seconds == app.LLM_REQUEST_TIMEOUT_SECONDS == 120.0
+    assert 119.0 < timeouts[0] <= 120.0
+
+
+def test_attempt_timeout_is_cut_to_the_remaining_deadline(monkeypatch):
+    monkeypatch.setattr(app.ResilientLLM, "backoff_delay", staticmethod(lambda attempt: 0.0))
+    llm = app.ResilientLLM(models=["m"], max_retries=1, deadline_seconds=1.0, attempt_timeout=5.0)
+    timeouts = []
+
+    def request(model, timeout):
+        timeouts.append(timeout)
+        if len(timeouts) == 1:
+            time.sleep(0.3)
+            raise TimeoutError("slow")
+        return "ok"
+
+    assert llm.call(request) == "ok"
+    assert timeouts[0] <= 1.0 and timeouts[1] <= 0.7
+
+
+def test_hedging_is_off_by_default():
+    llm = app.ResilientLLM(models=["m"])
+    calls = []
+    for _ in range(llm.hedge_min_samples + 5):
+        llm.call(lambda model, timeout: calls.append(model) or "ok")
+    calls.clear()
+
+    llm.call(lambda model, timeout: calls.append(model) or time.sleep(0.2) or "slow")
+
+    assert llm.hedge_delay("m") is None
+    assert calls == ["m"]
+
+
+def test_hedge_fires_past_the_observed_latency_percentile():
+    llm = app.ResilientLLM(models=["m"], hedge_percentile=90, hedge_min_samples=5)
+    assert llm.hedge_delay("m") is None  # Nothing observed yet
+    for _ in range(5):
+        llm.call(lambda model, timeout: time.sleep(0.01) or "ok")
+    assert 0.0 < llm.hedge_delay("m") < 0.2
+
+    calls = []
+    first = threading.Event()
+
+    def request(model, timeout):
+        calls.append(model)
+        if len(calls) == 1:
+            first.wait(2.0)  # The first request hangs until the test ends
+            return "first"
+        return "hedge"
+
+    try:
+        assert llm.call(request) == "hedge"
+    finally:
+        first.set()
+    assert len(calls) == 2
+
+
+def half_open_breaker(llm):
+    breaker = llm.breakers["m"]
+    breaker.cooldown_seconds = 0.0
+    breaker.opened_at = time.monotonic() - 1
+    assert breaker.state == "half-open"
+    return breaker
+
+
+def test_interrupted_probe_releases_the_breaker():
+    llm = app.ResilientLLM(models=["m"])
+    breaker = half_open_breaker(llm)
+
+    def interrupted(model, timeout):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        llm.call(interrupted)
+
+    assert breaker.allow()  # A later call may probe again
+
+
+def test_cancelled_async_probe_releases_the_breaker():
+    llm = app.ResilientLLM(models=["m"])
+    breaker = half_open_breaker(llm)
+
+    async def hang(model, timeout):
+        await asyncio.sleep(10)
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(llm.call_async(hang))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert breaker.allow()
@@ -0,0 +1,82 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def cache():
+    return app.SemanticCache(log_path=None)
+
+
+def test_synonyms_share_an_answer(cache):
+    cache.put("tea", "elder", "answer@1", "is it safe for kids?", "answer")
+
+    assert cache.get("tea", "elder", "answer@1", "is it safe for children?") == "answer"
+
+
+@pytest.mark.parametrize("asked, other", [
+    ("will it keep me awake?", "does it have caffeine?"),
+    ("does it help me sleep?", "does it cause insomnia?"),
+])
+def test_related_topics_are_not_folded_together(cache, asked, other):
+    cache.put("tea", "elder", "answer@1", asked, "answer")
+
+    assert cache.get("tea", "elder", "answer@1", other) is None
+
+
+def test_answers_from_another_catalogue_version_are_not_reused(cache):
+    cache.put("tea", "elder", "answer@1", "is it safe for kids?", "old answer", version=1)
+
+    assert cache.get("tea", "elder", "answer@1", "is it safe for kids?", version=2) is None
+    cache.put("tea", "elder", "answer@1", "is it safe for kids?", "new answer", version=2)
+    cache.put("tea", "elder", "answer@1", "is it safe for kids?", "stale answer", version=1)  # Ignored
+
+    assert cache.get("tea", "elder", "answer@1", "is it safe for kids?", version=2) == "new answer"
+    assert cache.get("tea", "elder", "answer@1", "is it safe for kids?", version=1) is None
+    assert cache.stats()["entries"] == 1
+
+
+def test_entries_expire(cache, monkeypatch):
+    cache.ttl_seconds = 60
+    now = app.time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now)
+    cache.put("tea", "elder", "answer@1", "first question", "first")
+    monkeypatch.setattr(app.time, "time", lambda: now + 30)
+    cache.put("tea", "elder", "answer@1", "second question", "second")
+
+    monkeypatch.setattr(app.time, "time", lambda: now + 61)
+    assert cache.get("tea", "elder", "answer@1", "first question") is None
+    assert cache.get("tea", "elder", "answer@1", "second question") == "second"
+    assert cache.stats()["entries"] == 1
+
+
+def test_agent_keys_answers_by_catalogue_version(make_agent, fake_llm, cache):
+    def ask(version):
+        agent = make_agent(semantic_cache=cache, catalogue_version=version)
+        agent.respond("elder")
+        agent.respond("what does it taste like?")
+
+    ask(1)
+    calls = fake_llm.calls
+    ask(1)
+    assert fake_llm.calls == calls + 1  # Only the reading; the answer came from the semantic cache
+    ask(2)
+    assert fake_llm.calls == calls + 3  # A reloaded catalogue: the answer is generated again
+
+
+def test_failed_answer_is_shown_as_an_error_and_not_cached(make_agent, fake_llm, cache, tmp_path):
+    reading_cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+    agent = make_agent(semantic_cache=cache, reading_cache=reading_cache)
+    agent.respond("elder")
+    entries = reading_cache.stats()['entries']
+    fake_llm.error_rate = 1.0
+
+    reply = agent.respond("what does it taste like?")
+
+    assert reply.startswith("[CRITICAL LLM ERROR]")
+    assert "Please try another command or quit." in reply
+    assert "Continue reading" not in reply
+    assert agent.current_reading_step == 1
+    assert cache.stats()["entries"] == 0
+    assert reading_cache.stats()['entries'] == entries
+    reading_cache.close()
@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def stores(tmp_path):
+    """Two workers' handles on one shared session database."""
+    path = str(tmp_path / "sessions.sqlite3")
+    first, second = app.SQLiteSessionStore(path), app.SQLiteSessionStore(path)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def stalled_stream(release):
+    """Streams Part 1, then hangs (its worker went away) until released."""
+    def stream(system_prompt, user_input="", json_output=False, max_tokens=app.MAX_TOKENS, on_finish=None, upstream_slot=None):
+        yield "**Part 1: History and Origin**\nVery old.\n**Part 2: Key Features and Uses**\n"
+        release.wait(5)
+    return stream
+
+
+def test_reading_saved_mid_stream_resumes_on_another_worker(monkeypatch, make_agent, stores):
+    first_store, second_store = stores
+    release = threading.Event()
+    monkeypatch.setattr(app, "generate_llm_response_stream", stalled_stream(release))
+    monkeypatch.setattr(app, "generate_llm_response", lambda *args, **kwargs: app.LLMText(
+        '{"part2": "Regenerated two.", "part3": "Regenerated three."}', "stop", {}))
+
+    try:
+        first = make_agent(streaming=True)
+        first.respond("elder")
+        history = app.ChatHistory()
+        history.append("agent", "Part 1")
+        first_store.save("visitor", app.session_state_payload(first, history, revision=1))
+    finally:
+        release.set()
+
+    saved = second_store.load("visitor")
+    second = make_agent()
+    second.restore_state(app.AgentState(**saved['agent']))
+
+    assert (second.current_voice, second.current_plant, second.current_reading_step) == ("elder", "cacao", 1)
+    assert list(app.ChatHistory.from_state(saved['history']).tail) == [("agent", "Part 1")]
+    assert "Regenerated two." in second.respond("continue")
+    assert "Regenerated three." in second.respond("continue")
+
+
+def test_complete_reading_survives_the_round_trip_without_llm_calls(make_agent, fake_llm, stores):
+    first_store, second_store = stores
+    first = make_agent()
+    first.respond("elder")
+    first.respond("continue")
+    first_store.save("visitor", app.session_state_payload(first, app.ChatHistory(), revision=1))
+    calls = fake_llm.calls
+
+    second = make_agent()
+    second.restore_state(app.AgentState(**second_store.load("visitor")['agent']))
+
+    assert second.export_state() == first.export_state()
+    assert first.expanded_readings[2] in second.respond("continue")
+    assert fake_llm.calls == calls
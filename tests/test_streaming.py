@@ -0,0 +1,65 @@
+import app
+
+
+def failing_stream(*chunks):
+    """A generate_llm_response_stream stand-in that yields chunks, then loses the connection."""
+    def stream(system_prompt, user_input="", json_output=False, max_tokens=app.MAX_TOKENS, on_finish=None, upstream_slot=None):
+        yield from chunks
+        raise app.LLMStreamError("[CRITICAL LLM ERROR] Failed to stream reading: ConnectionError - peer reset")
+    return stream
+
+
+def test_stream_error_is_not_appended_to_the_open_part(monkeypatch):
+    monkeypatch.setattr(app, "generate_llm_response_stream", failing_stream(
+        "**Part 1: History and Origin**\nVery old.\n", "**Part 2: Key Features and Uses**\nUsed for"))
+    monkeypatch.setattr(app, "generate_llm_response", lambda *args, **kwargs: "[CRITICAL LLM ERROR] still down")
+
+    reading = app.StreamingReading("prompt", "hi").start()
+    reading._thread.join(5)
+
+    assert reading.error.startswith("[CRITICAL LLM ERROR]")
+    assert reading.parts == ["Very old.", app.MISSING_PART_TEXT, app.MISSING_PART_TEXT]  # The cut-off Part 2 is dropped
+
+
+def test_failed_stream_is_not_cached(monkeypatch, make_agent, tmp_path):
+    monkeypatch.setattr(app, "generate_llm_response_stream", failing_stream(
+        "**Part 1: History and Origin**\nVery old.\n", "**Part 2: Key Features and Uses**\nUsed for"))
+    monkeypatch.setattr(app, "generate_llm_response", lambda *args, **kwargs: app.LLMText(
+        '{"part2": "Repaired two.", "part3": "Repaired three."}', "stop", {}))
+    reading_cache = app.ReadingCache(str(tmp_path / "cache.sqlite3"))
+    agent = make_agent(reading_cache=reading_cache, streaming=True)
+
+    reply = agent.respond("elder")
+    agent._stream._thread.join(5)
+
+    assert "Very old." in reply
+    assert agent._stream.error is not None
+
+    # The next visitor gets a freshly generated reading, not the one that failed half-way
+    with app.fake_llm_backend(app.FakeLLM(latency=0.0, tokens_per_second=1e9)) as fake:
+        make_agent(reading_cache=reading_cache).respond("elder")
+    assert fake.calls == 1
+    reading_cache.close()
+
+
+def test_stream_error_before_part_one_is_shown(monkeypatch, make_agent):
+    monkeypatch.setattr(app, "generate_llm_response_stream", failing_stream())
+    agent = make_agent(streaming=True)
+
+    reply = agent.respond("elder")
+
+    assert "[CRITICAL LLM ERROR]" in reply
+    assert "STRUCTURE ERROR" not in reply
+    assert "Expanded Reading Part" not in reply
+    assert "Ready for the next plant?" not in reply
+    assert "Please try another command or quit." in reply
+
+
+def test_fake_stream_errors_are_raised():
+    fake = app.FakeLLM(latency=0.0, tokens_per_second=1e9, error_rate=1.0)
+    try:
+        list(fake.generate_stream("prompt"))
+    except app.LLMStreamError:
+        pass
+    else:
+        raise AssertionError("expected LLMStreamError")
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def stub_server():
+    server = app.make_stub_llm_server(port=0)  # An ephemeral port
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client_manager(stub_server, monkeypatch):
+    host, port = stub_server.server_address
+    manager = app.LLMClientManager()
+    manager.configure(api_key="test-key", base_url=f"http://{host}:{port}/v1")
+    monkeypatch.setattr(app, "get_client_manager", lambda: manager)
+    monkeypatch.setattr(app, "get_resilient_llm", lambda: app.ResilientLLM(models=[app.MODEL_ID]))
+    return manager
+
+
+def test_requests_through_the_pooled_client_reuse_one_connection(stub_server, client_manager, budgeter):
+    replies = [app.generate_llm_response("system prompt", f"question {index}") for index in range(3)]
+    streamed = "".join(app.generate_llm_response_stream("system prompt", "streamed question"))
+
+    assert all(reply == app.STUB_READING for reply in replies)
+    assert replies[0].finish_reason == "stop"
+    assert replies[0].usage['completion_tokens'] == 120
+    assert streamed == app.STUB_READING
+    assert stub_server.stats == {'connections': 1, 'requests': 4}
+
+
+def test_async_client_is_pooled_per_event_loop(stub_server, client_manager):
+    async def run():
+        replies = await asyncio.gather(*(app.generate_llm_response_async("system prompt", "hi") for _ in range(2)))
+        replies.append(await app.generate_llm_response_async("system prompt", "again"))
+        return replies, client_manager.get_async() is client_manager.get_async()
+
+    replies, same_client = asyncio.run(run())
+
+    assert all(reply == app.STUB_READING for reply in replies)
+    assert same_client
+    assert stub_server.stats['requests'] == 3
+    assert stub_server.stats['connections'] <= 2  # The concurrent pair at most; the third request reuses one
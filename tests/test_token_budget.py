@@ -0,0 +1,104 @@
+import threading
+
+import app
+
+
+def completion(prompt_tokens=0, completion_tokens=0, finish_reason="stop", text="text"):
+    return app.LLMText(text, finish_reason, {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens})
+
+
+def test_max_tokens_uses_the_default_until_enough_samples():
+    budgeter = app.TokenBudgeter(min_samples=3, headroom=1.25)
+    for _ in range(2):
+        budgeter.observe("elder", "reading", completion(completion_tokens=200))
+
+    assert budgeter.max_tokens("elder", "reading") == app.MAX_TOKENS
+    assert budgeter.length_guidance("elder", "reading") == ""
+
+    budgeter.observe("elder", "reading", completion(completion_tokens=200))
+    assert budgeter.max_tokens("elder", "reading") == 250  # p95 200 x 1.25
+    assert budgeter.length_guidance("elder", "reading") == "\n\nLENGTH: Aim for about 150 words in total."
+    assert budgeter.max_tokens("child", "reading") == app.MAX_TOKENS  # Learned per (voice, kind)
+
+
+def test_max_tokens_is_clamped():
+    budgeter = app.TokenBudgeter(min_samples=1, headroom=1.25)
+    budgeter.observe("elder", "reading", completion(completion_tokens=10_000))
+    budgeter.observe("elder", "answer", completion(completion_tokens=10))
+
+    assert budgeter.max_tokens("elder", "reading", default=800) == 800
+    assert budgeter.max_tokens("elder", "answer") == 64
+
+
+def test_observe_charges_prompt_and_completion_and_counts_truncations():
+    budgeter = app.TokenBudgeter()
+
+    assert budgeter.observe("elder", None, completion(100, 50, finish_reason="length")) == 150
+    assert budgeter.observe("elder", "reading", "[CRITICAL LLM ERROR] no usage") == 0
+
+    assert budgeter.stats()['total_tokens'] == 150
+    assert budgeter.truncations == 1
+    assert budgeter.max_tokens("elder", "reading", default=500) == 500  # Nothing learned from None or an error
+
+
+def test_session_and_hourly_budgets(monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(app.time, "time", lambda: clock[0])
+    budgeter = app.TokenBudgeter(session_budget=1000, global_budget_per_hour=500)
+
+    assert budgeter.allows(999)
+    assert not budgeter.allows(1000)
+
+    budgeter.observe("elder", None, completion(400, 100))
+    assert not budgeter.allows(0)
+
+    clock[0] += 3601
+    assert budgeter.tokens_last_hour() == 0
+    assert budgeter.allows(0)
+
+
+def test_exhausted_session_budget_refuses_a_new_reading(make_agent, budgeter, fake_llm):
+    budgeter.session_budget = 10
+    agent = make_agent()
+    agent.tokens_used = 10
+
+    reply = agent.respond("elder")
+
+    assert "[TOKEN BUDGET]" in reply
+    assert "Please try another command or quit." in reply
+    assert "Expanded Reading Part" not in reply
+    assert fake_llm.calls == 0
+
+
+def test_cut_off_reading_is_continued_and_both_calls_are_charged(make_agent, budgeter, monkeypatch):
+    replies = iter([
+        completion(300, 500, "length", "**Part 1: History and Origin**\nOne.\n**Part 2: Key Features and Uses**\nTwo.\n"
+                                       "**Part 3: Scientific Details and Context**\nThree is cut"),
+        completion(400, 20, "stop", " off here."),
+    ])
+    monkeypatch.setattr(app, "generate_llm_response", lambda *args, **kwargs: next(replies))
+    agent = make_agent()
+
+    agent.respond("elder")
+
+    assert agent.expanded_readings[2] == "Three is cut off here."
+    assert budgeter.truncations == 1
+    assert agent.tokens_used == 1220
+
+
+def test_concurrent_charges_are_not_lost(make_agent):
+    agent = make_agent()
+    barrier = threading.Barrier(8)
+
+    def charge():
+        barrier.wait()
+        for _ in range(500):
+            agent._charge("elder", None, completion(1, 1))
+
+    threads = [threading.Thread(target=charge) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert agent.tokens_used == 8 * 500 * 2
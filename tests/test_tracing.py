@@ -0,0 +1,29 @@
+import json
+
+import app
+
+
+def test_tracer_writes_no_file_by_default(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tracer = app.Tracer()
+    with tracer.turn("turn"):
+        pass
+
+    assert list(tmp_path.iterdir()) == []
+    assert tracer.histograms["turn"].count == 1
+
+
+def test_trace_log_is_rotated_past_its_size_limit(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = app.Tracer(str(path), max_bytes=300)
+
+    for index in range(6):
+        with tracer.turn("turn", index=index):
+            pass
+
+    previous = [json.loads(line) for line in (tmp_path / "traces.jsonl.1").read_text().splitlines()]
+    current = [json.loads(line) for line in path.read_text().splitlines()]
+    indexes = [trace['index'] for trace in previous + current]
+    assert indexes == list(range(6 - len(indexes), 6))  # The newest turns, in order
+    assert path.stat().st_size < 300
+    assert sorted(child.name for child in tmp_path.iterdir()) == ["traces.jsonl", "traces.jsonl.1"]